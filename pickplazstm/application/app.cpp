@@ -343,6 +343,7 @@ void loop() {
 			//feeder number is specified on 'P'    - P = 0..3
 			//feeder direction is specified on 'S' - (S > 0.5) => forward, (s <= 0.5) => backward
 			//eg: M205 P2 S1 => will advance feeder 2 to the next part
+			//the pulse runs in the background, the next command is taken right away
 			do_cmd_feeder(cmd);
 		} else if (cmd.id == 'M' && (cmd.num == 206)) {
 			//system reset.
@@ -585,7 +586,11 @@ static void homeAxleDual(AccelStepperExtended* stepper1, AccelStepperExtended* s
 static void do_cmd_dwell(Gcode_command cmd) {
 	if (cmd.valueT != NaN) {
 		int milliseconds = round(cmd.valueT * 1000.0f);
-		delay(milliseconds);
+		uint32_t endtime = millis() + milliseconds;
+		while (millis() < endtime) {              //block, but keep the feeder pulses running
+			__WFI();
+			job_prelling_handle();
+		}
 	}
 }
 
@@ -757,6 +762,10 @@ static void job_prelling_handle() {
 		input_res1.update();
 		input_res2.update();
 		output_fan.update();
+		feeder0.update();
+		feeder1.update();
+		feeder2.update();
+		feeder3.update();
 		job_prelling = false;
 	}
 }
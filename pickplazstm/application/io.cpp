@@ -140,10 +140,37 @@ bool Prelling_input::get() {
 
 Feeder_automatic::Feeder_automatic(int a_pin) {
 	pin = a_pin;
+	timer = 0;
 }
 
+/**
+ * Start the pulse, the pin is released by update() (1kHz) so the
+ * command loop does not block while the pulse is running.
+ */
 void Feeder_automatic::feed(bool forward) {
+	if (timer) {
+		//pulse still running on this channel, finish it so the pulses stay apart
+		delay(timer);
+		digitalWrite(pin, 0);
+		delay(2);
+	}
     digitalWrite(pin, 1);
-    delay(forward ? 2 : 15);
-    digitalWrite(pin, 0);
+    //update() runs on a 1kHz tick which is not synchronised with this call,
+    //the first tick may come right away. One extra tick keeps the pulse at
+    //least 2ms (forward) or 15ms (backward) long, the feeder decodes the
+    //direction from the pulse width.
+    timer = forward ? 3 : 16;
+}
+
+void Feeder_automatic::update() {
+	if (timer) {
+		timer--;
+		if (timer == 0) {
+		    digitalWrite(pin, 0);
+		}
+	}
+}
+
+bool Feeder_automatic::is_busy() {
+	return timer != 0;
 }
@@ -72,9 +72,12 @@ public:
 class Feeder_automatic {
 private:
 	int pin;
+	uint32_t timer;
 public:
 	Feeder_automatic(int a_pin);
 	void feed(bool forward);
+	void update();
+	bool is_busy();
 };
 
 #endif /* IO_H_ */
@@ -5,15 +5,27 @@ import config_old
 
 TYPE_NUMBER = 1
 
+#margin in mm to the image border in which holes are not trusted
+HOLE_VIEW_MARGIN = 1.0
+#holes further away from the fitted tape line than this (mm) are rejected
+HOLE_LINE_TOLERANCE = 0.4
+#camera stops are skipped while predicted and measured holes agree within this (mm)
+TRACKING_TOLERANCE = 0.15
+#re-measure with the camera at least every n picks
+TRACKING_INTERVAL = 10
+
 
 # Belt feeder.
 # SMD belt is in a 3d printed fixture and pnp head advances its position every
 # time (belt does not move)
 class Belt:
 
-    def __init__(self, eye, picker):
+    def __init__(self, eye, picker, wide_eye=None, config=None):
         self.picker = picker
-        self.hole_finder = hole_finder.HoleFinder(eye)
+        self.hole_finder = hole_finder.HoleFinder(eye, config)
+        #the wide eye sees several holes at once, used to measure ahead
+        self.multi_hole_finder = hole_finder.HoleFinder(wide_eye if wide_eye is not None else eye, config)
+        self.tracker = HoleTracker()
 
     def set_start(self, state, hole_pos):
         x, y = hole_pos
@@ -27,41 +39,27 @@ class Belt:
         state["end"] = [x, y]
         self._recalculate_fields(state)
 
-    def pick(self, state, robot, only_camera=False):
+    def pick(self, state, robot, only_camera=False, symmetry=360):
+        """ symmetry : rotation in degree which maps the part onto itself"""
 
-        p_start = np.array(state["start"])    #the start hole of the belt
         p = np.array(state["current"])        #the current hole of the belt
-        p_end =np.array(state["end"])         #the last hole of the belt
-        p_offset = np.array(state["offset"])  #the pick position offset relative to the hole
-
-        vec = p_end - p  #vector to end
-        dx, dy = vec
-        angle = np.arctan2(dy, dx) #angle to end
-
-        #next hole offset
-        x_pitch = np.cos(angle) * state["pitch"]
-        y_pitch = np.sin(angle) * state["pitch"]
-
-        #calculate pick position
-        #this is done by rotating the x/y offset by the angle
-        rotm = np.array((
-            (np.cos(angle), np.sin(angle)),
-            (-np.sin(angle), np.cos(angle)),
-        ))
-        x, y = (rotm @ p_offset[:, None] + p[:, None])[:, 0]
-        pick_pos = (float(x), float(y))
 
-        #calculate (x/y) for next hole lookup (camera)
-        x = p[0] + x_pitch
-        y = p[1] + y_pitch
+        pick_pos, angle = self._pick_geometry(state)
 
         #setup correct light
         robot.light_topdn(True)
         robot.light_tray(False)
 
-        #drive to the hole and correct its position
-        robot.drive(x, y)
-        x, y = self.hole_finder.find_hole()
+        #the next hole is taken from an earlier capture or predicted by the tracker.
+        #the camera only measures (together with the holes after it) if the
+        #tracker does not trust its prediction.
+        next_index = state["pos"] + 1
+        next_hole = self._predict_next_hole(state)
+        if next_hole is None:
+            next_hole = self._measure_holes(state, robot, next_index, p, angle)
+        else:
+            self.tracker.skip(state)
+        x, y = next_hole
 
         #save the newly found hole position
         state["current"] = [x, y]
@@ -75,12 +73,102 @@ class Belt:
             #vibrations that the parts are flying out.
             state["pos"] += 1
             self._apply_general_pick_slowdown(robot, apply=True)
-            self.picker.pick(robot, pick_pos[0], pick_pos[1], angle + state["rot"], config.PICK_Z_BELT)
+            self.picker.pick(robot, pick_pos[0], pick_pos[1], angle + state["rot"], config_old.PICK_Z_BELT, symmetry=symmetry)
             self._apply_general_pick_slowdown(robot, apply=False)
 
         # self.picker.place(robot, pick_pos[0], pick_pos[1] + 10, 0)
 
 
+    def remeasure(self, state, robot):
+        """
+        measure the current hole again with the camera and forget the cached
+        holes and the tracking, the next pick measures the holes after it anew.
+        raises NoBeltHoleFoundException if the current hole is not found either
+        """
+        robot.light_topdn(True)
+        robot.light_tray(False)
+        robot.drive(*state["current"])
+        x, y = self.hole_finder.find_hole(engine=state.get("engine"))
+        state["current"] = [float(x), float(y)]
+        state.pop("hole_cache", None)
+        state.pop("tracking", None)
+
+    def _pick_geometry(self, state):
+        """ returns pick position and belt angle (radian) of the current hole"""
+        p = np.array(state["current"])        #the current hole of the belt
+        p_end =np.array(state["end"])         #the last hole of the belt
+        p_offset = np.array(state["offset"])  #the pick position offset relative to the hole
+
+        vec = p_end - p  #vector to end
+        dx, dy = vec
+        angle = np.arctan2(dy, dx) #angle to end
+
+        #calculate pick position
+        #this is done by rotating the x/y offset by the angle
+        rotm = np.array((
+            (np.cos(angle), np.sin(angle)),
+            (-np.sin(angle), np.cos(angle)),
+        ))
+        x, y = (rotm @ p_offset[:, None] + p[:, None])[:, 0]
+        return (float(x), float(y)), angle
+
+    def _predict_next_hole(self, state):
+        """ the next hole from the cache or the tracker, None if the camera has to measure it"""
+        if self.tracker.needs_measurement(state):
+            return None
+        next_index = state["pos"] + 1
+        next_hole = self._get_cached_hole(state, next_index)
+        if next_hole is None:
+            next_hole = self.tracker.predict(state, next_index)
+        return next_hole
+
+    def _get_cached_hole(self, state, index):
+        """ return the cached hole position with the given index or None"""
+        cache = state.get("hole_cache")
+        if cache is None:
+            return None
+        i = index - cache["index"]
+        if 0 <= i < len(cache["holes"]):
+            return cache["holes"][i]
+        return None
+
+    def _measure_holes(self, state, robot, index, p, angle):
+        """
+        Capture the holes from index onwards in a single image and cache them.
+
+        p is the (measured) position of hole index-1.
+        returns the position of hole index
+        """
+        eye = self.multi_hole_finder.eye
+        pitch = state["pitch"]
+        direction = np.array((np.cos(angle), np.sin(angle)))
+
+        #number of holes fitting into the view
+        usable = eye.cam_range - 2 * (self.multi_hole_finder.radius + HOLE_VIEW_MARGIN)
+        count = max(1, int(usable // pitch) + 1)
+        count = max(1, min(count, state["capacity"] - index + 1))
+
+        #center the view on the holes to measure
+        x, y = p + direction * pitch * (1 + (count - 1) / 2)
+        robot.drive(x, y)
+        try:
+            holes = self.multi_hole_finder.find_holes(engine=state.get("engine"))
+            predicted = fit_belt_holes(holes, p, direction, pitch, count)
+        except hole_finder.NoBeltHoleFoundException:
+            if not self.tracker.is_trusted(state):
+                raise
+            #a single miss is bridged by the prediction, next pick re-measures
+            print("belt hole not found, using tracker prediction")
+            self.tracker.miss(state)
+            return self.tracker.predict(state, index)
+
+        state["hole_cache"] = {
+            "index": index,
+            "holes": [[float(x), float(y)] for x, y in predicted],
+        }
+        self.tracker.update(state, index, state["hole_cache"]["holes"][0])
+        return state["hole_cache"]["holes"][0]
+
     def recalculate_fields(self, state):
         self._recalculate_fields(state)
 
@@ -109,13 +197,137 @@ class Belt:
         state["pos"] = pos
 
         #re-evaluate current position (without camera)
-        vec = p_end - p_start  #vector to end
-        dx, dy = vec
-        angle = np.arctan2(dy, dx) #angle to end
-        x_current = p_start[0] + np.cos(angle) * pitch * pos
-        y_current = p_start[1] + np.sin(angle) * pitch * pos
+        x_current, y_current = nominal_hole(state, pos)
         state["current"] = [x_current, y_current]
+        #cached holes and tracking are only valid for the old geometry
+        state.pop("hole_cache", None)
+        state.pop("tracking", None)
 
     def _apply_general_pick_slowdown(self, robot, apply):
         z_speed = 0.2 if apply else 1.0
         robot.feedrate_multiplier(x=1.0, y=1.0, z=z_speed, e=1.0*12, a=1.0, b=1.0, c=1.0)
+
+
+class HoleTracker:
+    """
+    Tracks the belt holes of a feeder by comparing the measured holes with
+    the nominal ones from start/end/pitch.
+
+    The learned correction and its last residual are kept in state["tracking"].
+    The prediction is trusted while the residual stays below TRACKING_TOLERANCE,
+    a re-measurement is requested every TRACKING_INTERVAL picks or after a miss.
+    """
+
+    def needs_measurement(self, state):
+        tracking = state.get("tracking")
+        if tracking is None or tracking["missed"]:
+            return True
+        if tracking["since_measure"] >= TRACKING_INTERVAL:
+            return True
+        return not self.is_trusted(state)
+
+    def is_trusted(self, state):
+        tracking = state.get("tracking")
+        if tracking is None or tracking["missed"] or tracking["residual"] is None:
+            return False
+        return tracking["residual"] <= TRACKING_TOLERANCE
+
+    def predict(self, state, index):
+        x, y = nominal_hole(state, index)
+        tracking = state.get("tracking")
+        if tracking is not None:
+            x += tracking["offset"][0]
+            y += tracking["offset"][1]
+        return [float(x), float(y)]
+
+    def update(self, state, index, measured):
+        """ feed a measured hole position into the model"""
+        nominal = np.array(nominal_hole(state, index))
+        offset = np.asarray(measured) - nominal
+        residual = None #first measurement, verify with the next one
+        if "tracking" in state:
+            residual = float(np.linalg.norm(np.asarray(measured) - self.predict(state, index)))
+            print("belt tracking residual=%fmm" % residual)
+        state["tracking"] = {
+            "offset": [float(offset[0]), float(offset[1])],
+            "residual": residual,
+            "since_measure": 0,
+            "missed": False,
+        }
+
+    def skip(self, state):
+        state["tracking"]["since_measure"] += 1
+
+    def miss(self, state):
+        state["tracking"]["missed"] = True
+
+
+def nominal_hole(state, index):
+    """ position of hole index calculated from start, end and pitch only"""
+    p_start = np.array(state["start"])
+    p_end = np.array(state["end"])
+    dx, dy = p_end - p_start
+    angle = np.arctan2(dy, dx) #angle to end
+    x = p_start[0] + np.cos(angle) * state["pitch"] * index
+    y = p_start[1] + np.sin(angle) * state["pitch"] * index
+    return float(x), float(y)
+
+
+def fit_belt_holes(holes, origin, direction, pitch, count):
+    """
+    Fit the tape line and the pitch phase through detected holes.
+
+    holes     : array[n, 2] of detected hole positions (may contain outliers)
+    origin    : position of the hole before the first one to predict
+    direction : unit vector along the belt
+    returns array[count, 2] with the positions of the next count holes
+
+    raises NoBeltHoleFoundException if too few holes are left after the
+    outlier rejection (two if several holes are predicted), or if they are
+    out of phase with the hole at origin
+    """
+    holes = np.asarray(holes, dtype=np.float64).reshape((-1, 2))
+    origin = np.asarray(origin, dtype=np.float64)
+    normal = np.array((-direction[1], direction[0]))
+    required = 2 if count > 1 else 1
+
+    s = (holes - origin) @ direction  #along the belt
+    n = (holes - origin) @ normal     #across the belt
+
+    #holes behind the origin belong to already picked parts
+    keep = s > pitch / 2
+    s, n = s[keep], n[keep]
+    if len(s) == 0:
+        raise hole_finder.NoBeltHoleFoundException("No belt hole found ahead of the current hole")
+
+    #reject everything which is not on the tape line (median is robust against a few outliers)
+    keep = np.abs(n - np.median(n)) < HOLE_LINE_TOLERANCE
+    s, n = s[keep], n[keep]
+    if len(s) < required:
+        raise hole_finder.NoBeltHoleFoundException(f"{len(s)} belt holes on the tape line, {required} required")
+
+    #pitch phase as circular mean of the remainders, then reject the outliers
+    phi = 2 * np.pi * s / pitch
+    phase = np.arctan2(np.mean(np.sin(phi)), np.mean(np.cos(phi))) * pitch / (2 * np.pi)
+    remainder = (s - phase + pitch / 2) % pitch - pitch / 2
+    keep = np.abs(remainder) < HOLE_LINE_TOLERANCE
+    s, n, remainder = s[keep], n[keep], remainder[keep]
+    if len(s) < required:
+        raise hole_finder.NoBeltHoleFoundException(f"{len(s)} belt holes in the pitch, {required} required")
+    phase += np.mean(remainder)
+
+    #origin is a hole, the holes ahead must be whole pitches away from it
+    if abs(phase) > HOLE_LINE_TOLERANCE:
+        raise hole_finder.NoBeltHoleFoundException(f"belt holes {phase:.2f}mm out of phase with the current hole")
+
+    #tape line, the slope is only trusted if it spans more than a pitch
+    if len(s) >= 3 and np.ptp(s) > pitch:
+        slope, offset = np.polyfit(s, n, 1)
+    else:
+        slope, offset = 0.0, np.mean(n)
+
+    #the hole closest to one pitch ahead is the first one
+    first = phase + pitch * round((pitch - phase) / pitch)
+    s_pred = first + pitch * np.arange(count)
+    n_pred = offset + slope * s_pred
+    return origin + s_pred[:, None] * direction + n_pred[:, None] * normal
@@ -0,0 +1,175 @@
+import math
+
+import numpy as np
+import cv2
+
+import clock
+import debug
+
+#seconds to wait after the nozzle stopped above the camera (vibrations, exposure)
+BOTTOM_UP_SETTLE_TIME = 0.6
+#a footprint with sides closer than this ratio is square for the orientation
+SQUARE_RATIO = 1.2
+
+
+class NozzleEmptyException(Exception):
+    pass
+
+
+class BottomUpAligner:
+    """
+    Measures the offset and rotation of the picked part on the nozzle with the
+    upward looking camera, between pick and place.
+
+    Configured by the [bottom_camera] section of config.toml:
+
+        device = 1          # /dev/video? of the upward looking camera
+        x = 200.0           # machine position of the camera center
+        y = 10.0
+        z = -5.0            # nozzle height for the image (optional)
+        res = 30.0          # pixel per mm at that height
+        crop = 12.0         # mm around the nozzle which are analysed
+        flip_x = true       # image x points against machine x
+        flip_y = false
+        inverted = false    # true if the part is darker than the background
+        min_area_mm2 = 0.5  # a smaller blob is the bare nozzle tip
+        max_offset = 2.0    # mm, a part further off is not the picked part
+        distance = 40.0     # mm from the lens to the part at the image height (optional,
+                            # the part size then tells the z drift, see pick.ZHoming)
+
+    The nozzle axis is at the image center unless nozzle_px = [u, v] is given.
+    """
+
+    def __init__(self, camera, config):
+        self.camera = camera
+
+        self.x = config["x"]
+        self.y = config["y"]
+        self.z = config.get("z")
+        self.res = config["res"]
+        self.crop = config.get("crop", 12.0)
+        self.flip_x = config.get("flip_x", True)
+        self.flip_y = config.get("flip_y", False)
+        self.inverted = config.get("inverted", False)
+        self.min_area_mm2 = config.get("min_area_mm2", 0.5)
+        self.max_offset = config.get("max_offset", 2.0)
+        self.nozzle_px = config.get("nozzle_px")
+        self.distance = config.get("distance")
+        #area in mm^2 of the last measured part
+        self.last_area = None
+
+    def measure(self, robot, picker, angle, footprint=None):
+        """
+        drive the nozzle (rotated to angle) over the camera and measure the part.
+        footprint : name in footprints.json, its size and rotation_symmetry tell
+                    how the part has to lie and how far da can be folded
+        returns (dx, dy, da) offset of the part center to the nozzle in mm and
+        its rotation in degree, both in machine coordinates
+        raises NozzleEmptyException if no part is on the nozzle
+        """
+        expected, fold = angle, 180.0
+        if footprint is not None:
+            #the footprint x axis turns with the nozzle, the blob orientation is its long side
+            size = picker.get_footprint_size(footprint)
+            fold = min(fold, picker.get_footprint_symmetry(footprint))
+            if size is not None:
+                if size[1] > size[0]:
+                    expected += 90
+                if max(size) < SQUARE_RATIO * min(size):
+                    #the orientation of a square blob is only known up to 90 degree
+                    fold = min(fold, 90.0)
+
+        robot.drive(x=self.x + picker.DX, y=self.y + picker.DY, e=angle, f=200, r=10.0)
+        robot.drive(e=angle) #finish angle
+        if self.z is not None:
+            robot.drive(z=self.z)
+        robot.light_botup(True)
+        robot.done()
+        clock.sleep(BOTTOM_UP_SETTLE_TIME, "settle")
+
+        image = self.camera.cache.get("image")
+
+        robot.light_botup(False)
+        if self.z is not None:
+            robot.drive(z=0)
+
+        if image is None:
+            raise Exception("bottom camera has no image")
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        debug.record_image("BottomUp", image, detector="bottom_up", res=self.res, crop=self.crop)
+        dx, dy, da, self.last_area = self.analyze(image, expected, fold)
+        return dx, dy, da
+
+    def analyze(self, image, expected=0.0, fold=180.0):
+        """
+        find the part in a grayscale bottom up image
+        expected : degree (like da) of the long side of the part if it lies right
+        fold : da is folded into +-fold/2, at most 180 degree as the blob
+               orientation has no direction
+        returns (dx, dy, da, area) in mm, degree and mm^2 (machine coordinates)
+        """
+        from skimage.measure import label, regionprops
+
+        h, w = image.shape[:2]
+        u0, v0 = self.nozzle_px if self.nozzle_px is not None else (w / 2, h / 2)
+
+        if self.inverted:
+            image = 255 - image
+
+        # Otsu on the whole image, opencv has no masked otsu
+        blur = cv2.GaussianBlur(image, (11, 11), 0)
+        _, binary = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+        size = int(self.crop * self.res / 2)
+        left, top = max(0, int(u0) - size), max(0, int(v0) - size)
+        binary = binary[top:int(v0) + size, left:int(u0) + size]
+
+        #the part is the biggest blob around the nozzle
+        regions = [r for r in regionprops(label(binary)) if r.area >= self.min_area_mm2 * self.res ** 2]
+        if not regions:
+            debug.set_image("BottomUp", binary)
+            raise NozzleEmptyException("No part on the nozzle")
+        props = max(regions, key=lambda r: r.area)
+
+        y, x = props.centroid
+        dx = (x + left - u0) / self.res
+        dy = (y + top - v0) / self.res
+
+        #skimage measures the orientation of the long side from the image rows
+        angle = props.orientation * 180 / math.pi - 90
+
+        if self.flip_x:
+            dx = -dx
+        if self.flip_y:
+            dy = -dy
+        if self.flip_x != self.flip_y:
+            #a mirrored image turns the other way
+            angle = -angle
+
+        fold = min(fold, 180.0)
+        angle = (angle - expected) % fold
+        if angle > fold / 2: angle -= fold
+
+        image = cv2.cvtColor(binary, cv2.COLOR_GRAY2BGR)
+        image = cv2.circle(image, (int(x), int(y)), 2, (0,0,255), 3)
+        image = cv2.circle(image, (int(u0) - left, int(v0) - top), 2, (0,255,0), 3)
+        debug.set_image("BottomUp", image)
+
+        if math.hypot(dx, dy) > self.max_offset:
+            raise NozzleEmptyException(f"Part is {math.hypot(dx, dy):.1f}mm off the nozzle")
+
+        return float(dx), float(dy), float(angle), float(props.area / self.res ** 2)
+
+
+def rotate_offset(dx, dy, da):
+    """
+    the part offset (dx, dy) to the nozzle after the rotation is corrected,
+    i.e. the nozzle turned by -da. The e axis turns against the machine x->y
+    direction (pcb angles are inverted for it), so the offset turns by +da.
+    returns (dx, dy) in mm
+    """
+    a = math.radians(da)
+    return (dx * math.cos(a) - dy * math.sin(a),
+            dx * math.sin(a) + dy * math.cos(a))
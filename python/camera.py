@@ -4,6 +4,8 @@ import threading
 import cv2
 import numpy as np
 
+import clock
+
 def cam(func, device=0, count=10):
     """
     use v42l-ctl to change parameters of the camera.
@@ -104,12 +106,12 @@ class CameraThreadMock:
     def _update(self):
         while not self.thread_exit_request:
             frame = np.random.uniform(0, 255, size=(480,640)).astype(np.uint8)
-            timestamp = time.time()
+            timestamp = clock.time()
             self.cache = {
                 "image" : frame,
                 "timestamp": timestamp
             }
-            time.sleep(0.1)
+            clock.wait(0.1)
 
     def __enter__(self):
         self.thread.start()
@@ -128,3 +130,25 @@ def imshow(frame):
 
 if __name__ == "__main__":
     cam(imshow, device=0, count=1000)
+
+class CameraStillMock:
+    """ Camera replacement which always returns the same (recorded) image"""
+
+    def __init__(self, image=None):
+        self.cache = {}
+        if image is not None:
+            self.set_image(image)
+
+    def set_image(self, image):
+        if isinstance(image, str):
+            image = cv2.imread(image, cv2.IMREAD_GRAYSCALE)
+        self.cache = {
+            "image" : image,
+            "timestamp": clock.time()
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        pass
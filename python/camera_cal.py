@@ -1,23 +1,36 @@
 import pickle
-import time
 import numpy as np
 import cv2
 import calibrator
+import clock
 
 import debug
 import toml
 
-config = toml.load("config.toml")
-#should be the center pos of the aruco matrix in machine coordinates
-calibration_center = config["machine"]["calibration_center"]
-calibration_offset = config["machine"]["calibration_offset"]
-CALIBRATION_POS = (calibration_center[0] + calibration_center[0], calibration_center[1] + calibration_center[1])
-print(CALIBRATION_POS)
-
 aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_100)
 arucoParams = cv2.aruco.DetectorParameters()
 
 
+def get_calibration_pos():
+    """ center pos of the aruco matrix in machine coordinates (from config.toml)"""
+    config = toml.load("config.toml")
+    calibration_center = config["machine"]["calibration_center"]
+    calibration_offset = config["machine"]["calibration_offset"]
+    calibration_pos = (calibration_center[0] + calibration_center[0], calibration_center[1] + calibration_center[1])
+    print(calibration_pos)
+    return calibration_pos
+
+
+def detect_markers(image):
+    """ return (corners, ids) of the aruco markers in a camera image"""
+    if hasattr(cv2.aruco, "ArucoDetector"):
+        detector = cv2.aruco.ArucoDetector(aruco_dict, arucoParams)
+        corners, ids, _rejected = detector.detectMarkers(image)
+    else:
+        corners, ids, _rejected = cv2.aruco.detectMarkers(image, aruco_dict, parameters=arucoParams)
+    return corners, ids
+
+
 def calibrate(robot, camera):
     """
     Drive to calibration board and calibrate
@@ -35,7 +48,7 @@ def calibrate(robot, camera):
         (-1, -1),
         (0, -1),
         (1, -1),
-    ]) * 10 + np.asarray(CALIBRATION_POS)[np.newaxis]
+    ]) * 10 + np.asarray(get_calibration_pos())[np.newaxis]
 
     markers_corners = []
     marker_ids = []
@@ -47,12 +60,12 @@ def calibrate(robot, camera):
         print(x, y)
         robot.drive(x, y)
         robot.done()
-        time.sleep(1.0)  #@0.5s camera image was skewed/blurred
+        clock.sleep(1.0, "settle")  #@0.5s camera image was skewed/blurred
 
+        debug.record_image(f"Calibrate{i}", camera.cache["image"], detector="aruco")
         image = cv2.cvtColor(camera.cache["image"], cv2.COLOR_GRAY2BGR)
 
-        arucoParams = cv2.aruco.DetectorParameters_create()
-        (corners, ids, rejected) = cv2.aruco.detectMarkers(image, aruco_dict, parameters=arucoParams)
+        corners, ids = detect_markers(image)
         image = cv2.aruco.drawDetectedMarkers(image, corners, ids)
 
         markers_corners.append(corners)
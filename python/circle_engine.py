@@ -0,0 +1,185 @@
+"""
+Circle detection engines used by HoleFinder and FiducialDetector.
+
+Every engine implements
+    find(image, radius, r_tol, min_dist, polarity) -> array[n, 3] of (x, y, r) in pixel, best first, or None
+on an already preprocessed grayscale image. polarity is "bright" (bright disc
+on dark background), "dark" or "any".
+
+Hough is the default. The template engine is opt-in ([vision.hole] engine =
+"template"): it matches on an image pyramid and refines every candidate at
+half resolution, which is faster than Hough on the vision_bench frames
+(holes about 1.3x, fiducials about 2x) and gives a sub pixel center.
+Compare them on recorded frames with vision_bench.py --engine hough,template
+before switching.
+"""
+
+import inspect
+
+import numpy as np
+import cv2
+
+
+class HoughEngine:
+    """ cv2.HoughCircles, the original detector. Many false candidates on noisy images with the low param2."""
+
+    name = "hough"
+
+    def __init__(self, param1=50, param2=10):
+        self.param1 = param1
+        self.param2 = param2
+
+    def find(self, image, radius, r_tol, min_dist=0.1, polarity="any"):
+        circles = cv2.HoughCircles(image,cv2.HOUGH_GRADIENT,1,min_dist,
+                            param1=self.param1,param2=self.param2, # 50,20
+                            minRadius=int(radius - r_tol),
+                            maxRadius=int(radius + r_tol))
+        if circles is None:
+            return None
+        return circles[0]
+
+
+class TemplateEngine:
+    """
+    normalised cross correlation against a rendered disc of the known radius.
+    The candidates are searched on an image pyramid level where the disc has a
+    radius of about coarse_radius pixel, and refined at half resolution with a
+    thin ring template in a small window around each of them.
+    """
+
+    name = "template"
+
+    def __init__(self, threshold=0.5, coarse_radius=3.0):
+        self.threshold = threshold
+        self.coarse_radius = coarse_radius
+        self._templates = {}
+
+    def _template(self, radius, ring=None):
+        """ disc with a ring of background around it (default half the radius, at least 2 pixel)"""
+        radius = int(round(radius))
+        ring = max(2, radius // 2) if ring is None else ring
+        if (radius, ring) not in self._templates:
+            size = 2 * (radius + ring) + 1
+            template = np.zeros((size, size), np.uint8)
+            cv2.circle(template, (size // 2, size // 2), radius, 255, -1, lineType=cv2.LINE_AA)
+            self._templates[radius, ring] = template
+        return self._templates[radius, ring]
+
+    def find(self, image, radius, r_tol, min_dist=0.1, polarity="any"):
+        levels = [image]
+        while radius / 2 ** len(levels) >= self.coarse_radius and min(levels[-1].shape[:2]) >= 32:
+            levels.append(cv2.pyrDown(levels[-1]))
+        if len(levels) == 1:
+            peaks = self._match(image, radius, min_dist, polarity, subpixel=True)
+            return None if peaks is None else np.array([(x, y, radius) for x, y, _ in peaks], dtype=np.float32)
+
+        scale = 2 ** (len(levels) - 1)
+        coarse = self._match(levels[-1], radius / scale, min_dist / scale, polarity)
+        if coarse is None:
+            return None
+
+        #the candidate is known to a coarse pixel, a thin ring is enough to center the edge.
+        #the window covers that template and the coarse pixel around the candidate
+        fine = levels[1]
+        factor = scale // 2
+        ring = 2
+        half = int(round(radius / 2)) + ring + factor
+        circles = []
+        for x, y, _ in coarse:
+            #pixel i of a pyrDown level is centered on pixel 2i of the level below
+            cx, cy = int(round(x * factor)), int(round(y * factor))
+            left, top = max(0, cx - half), max(0, cy - half)
+            score, offset = self._score(fine[top:cy + half + 1, left:cx + half + 1], radius / 2, polarity, ring)
+            if score is None:
+                continue
+            _, _, _, (px, py) = cv2.minMaxLoc(score)
+            x = left + offset + px + _subpixel(score, px, py, 1)
+            y = top + offset + py + _subpixel(score, px, py, 0)
+            circles.append((2 * x, 2 * y, radius))
+        if not circles:
+            return None
+        return np.array(circles, dtype=np.float32)
+
+    def _score(self, image, radius, polarity, ring=None):
+        """ correlation map and the offset of its pixels in image, (None, 0) if the image is smaller than the template"""
+        template = self._template(radius, ring)
+        if image.shape[0] < template.shape[0] or image.shape[1] < template.shape[1]:
+            return None, 0
+        score = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+        if polarity == "dark":
+            score = -score
+        elif polarity == "any":
+            score = np.abs(score)
+        return score, template.shape[0] // 2
+
+    def _match(self, image, radius, min_dist, polarity, subpixel=False):
+        """ disc centers as [(x, y, score)] best first, None if there is none"""
+        score, offset = self._score(image, radius, polarity)
+        if score is None:
+            return None
+        #two matches closer than the radius are the same disc
+        peaks = _find_peaks(score, self.threshold, max(min_dist, radius), subpixel)
+        return [(x + offset, y + offset, value) for x, y, value in peaks] or None
+
+
+def _find_peaks(score, threshold, min_dist, subpixel=True):
+    """ local maxima above threshold with non-maximum suppression, as [(x, y, value)] best first"""
+    k = 2 * int(np.ceil(min_dist / 2)) + 1
+    dilated = cv2.dilate(score, cv2.getStructuringElement(cv2.MORPH_RECT, (k, k)))
+    ys, xs = np.nonzero((score >= dilated) & (score >= threshold) & (score > 0))
+    values = score[ys, xs]
+    order = np.argsort(-values)
+
+    peaks = []
+    for i in order:
+        x, y = int(xs[i]), int(ys[i])
+        if any((px - x) ** 2 + (py - y) ** 2 < min_dist ** 2 for px, py, _ in peaks):
+            continue
+        if subpixel:
+            peaks.append((x + _subpixel(score, x, y, 1), y + _subpixel(score, x, y, 0), float(values[i])))
+        else:
+            peaks.append((x, y, float(values[i])))
+    return peaks
+
+
+def _subpixel(score, x, y, axis):
+    """ parabola fit through the peak and its neighbours along axis"""
+    if axis == 1:
+        if x <= 0 or x >= score.shape[1] - 1:
+            return 0.0
+        a, b, c = score[y, x - 1], score[y, x], score[y, x + 1]
+    else:
+        if y <= 0 or y >= score.shape[0] - 1:
+            return 0.0
+        a, b, c = score[y - 1, x], score[y, x], score[y + 1, x]
+    a, b, c = float(a), float(b), float(c) #np.clip on numpy scalars costs more than the fit
+    denominator = a - 2 * b + c
+    if denominator == 0:
+        return 0.0
+    return min(max(0.5 * (a - c) / denominator, -0.5), 0.5)
+
+
+ENGINES = {
+    HoughEngine.name: HoughEngine,
+    TemplateEngine.name: TemplateEngine,
+}
+
+
+def make_engine(name="hough", **params):
+    try:
+        return ENGINES[name](**params)
+    except KeyError:
+        raise ValueError(f"circle engine '{name}' not in {list(ENGINES)}")
+
+
+def make_engine_from_config(section):
+    """
+    engine from a config section like {"engine": "template", "threshold": 0.6, "blur": 5}
+    the engine name and its parameters are popped from section, the rest is left
+    """
+    name = section.pop("engine", "hough")
+    if name not in ENGINES:
+        raise ValueError(f"circle engine '{name}' not in {list(ENGINES)}")
+    parameters = inspect.signature(ENGINES[name]).parameters
+    params = {k: section.pop(k) for k in list(section) if k in parameters}
+    return make_engine(name, **params)
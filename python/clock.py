@@ -0,0 +1,88 @@
+"""
+Time source of the machine code.
+
+Everything that waits for the machine (settling, vacuum, feeders) sleeps
+through this module, so a simulation can replace the wall clock with a
+VirtualClock that advances instantly and books the time per phase
+(simulate_job.py and the mock mode of state.main).
+"""
+
+import threading
+import time as _time
+
+
+class RealClock:
+    """ the wall clock"""
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds, phase=None):
+        if seconds > 0:
+            _time.sleep(seconds)
+
+    def wait(self, seconds):
+        self.sleep(seconds)
+
+
+class VirtualClock:
+    """
+    Simulated time, sleep() returns immediately and only advances the clock.
+
+    The time is booked to the phase given to sleep() (e.g. "settle",
+    "vacuum"), phases holds the total seconds per phase.
+
+    sleep() is for the thread which drives the machine. Background threads
+    (e.g. a camera producing frames) use wait(), which blocks until that
+    thread advanced the clock, but at most as long in real time so they
+    keep running while the machine is idle.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self.phases = {}
+        self.condition = threading.Condition()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds, phase=None):
+        if seconds > 0:
+            with self.condition:
+                self.now += seconds
+                phase = phase or "other"
+                self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+                self.condition.notify_all()
+
+    def wait(self, seconds):
+        with self.condition:
+            target = self.now + seconds
+            self.condition.wait_for(lambda: self.now >= target, timeout=seconds)
+
+
+_clock = RealClock()
+
+
+def get():
+    return _clock
+
+
+def use(clock):
+    """ replace the clock, returns the previous one"""
+    global _clock
+    previous = _clock
+    _clock = clock
+    return previous
+
+
+def time():
+    return _clock.time()
+
+
+def sleep(seconds, phase=None):
+    _clock.sleep(seconds, phase)
+
+
+def wait(seconds):
+    """ sleep of a background thread"""
+    _clock.wait(seconds)
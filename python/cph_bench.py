@@ -0,0 +1,307 @@
+"""
+End-to-end throughput benchmark.
+
+Places the reference boards of test/bom on the simulated machine of
+simulate_job.py: the real StateContext.run_state drives a SimRobot (move
+durations from the M201/M203 settings) and detector stand-ins which succeed
+after a configurable latency. The parts are spread over a fixed feeder layout
+(two-terminal passives on rolls and belts, everything else in trays), so the numbers
+only change with the machine code and the settings.
+
+Reported per board: components per hour, p50/p95 seconds per placement and
+the CPU time of every thread while the job ran. "utilisation" relates the
+CPU time to the machine time of the job, i.e. the load on the host of a
+real run.
+
+usage: python cph_bench.py [board ...] [--latency 0.05] [--latency hole=0.02]
+                           [--speed 120] [--accel 600] [--render]
+                           [--json result.json] [--baseline result.json] [--max-drop 0.05]
+
+board is a directory of test/bom (default all of them).
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+import belt
+import data_manager
+import roll
+import simulate_job
+import tray
+
+BOARD_DIR = "test/bom"
+
+#machine the boards are placed on
+BENCH_CONFIG = {
+    "camera": {"x": 10.0, "y": 10.0, "res": 20, "width": 40, "height": 40},
+    "machine": {"bed_area": [0, 0, 428, 415]},
+    "work_area": {},
+}
+#tray grid (x, y, w, h of the first tray, pitch x/y, columns, rows), the trays of template/context.json
+#moved left so the nozzle reaches the last column
+BENCH_TRAYS = ((36.5, 254.55, 47, 29), (48.5, 29.6), 6, 3)
+#belts run from x start to x end, first belt at y, pitch y between the belts
+BENCH_BELTS = ((86.4, 333.2), 355.0, 12.0, 5)
+BENCH_BELT_PITCH = 4
+BENCH_BELT_OFFSET = [2.0, -3.5]
+#pick positions of the roll feeders, on channel 0, 1, ...
+BENCH_ROLLS = ([35.0, 355.0], [35.0, 375.0])
+
+#footprints of two-terminal passives after data_manager._auto_assign_symbols
+PASSIVE_FOOTPRINT = re.compile(r"^\d{4,5}_[RCL]$")
+
+
+def board_files(directory):
+    """ (bom, pnp) files of a board directory, the pnp file has 'pnp' in its name or is the one without 'bom'"""
+    names = sorted(n for n in os.listdir(directory) if os.path.isfile(os.path.join(directory, n)))
+    pnp = next((n for n in names if "pnp" in n.lower()), None) or next(n for n in names if "bom" not in n.lower())
+    bom = next(n for n in names if n != pnp)
+    return os.path.join(directory, bom), os.path.join(directory, pnp)
+
+
+def _read_lines(path):
+    #same decoding as the upload of the web interface
+    with open(path, "rb") as f:
+        blob = f.read()
+    try:
+        text = blob.decode("utf-8")
+    except UnicodeDecodeError:
+        text = blob.decode("utf-16")
+    return text.replace("\r", "").split("\n")
+
+
+def bench_feeders():
+    """ feeder layout of the benchmark machine, trays, belts and rolls by name"""
+    feeders = {}
+    (x0, y0, w, h), (px, py), columns, rows = BENCH_TRAYS
+    for i in range(columns * rows):
+        x, y = x0 + (i // rows) * px, y0 + (i % rows) * py
+        feeders[f"tray {i}"] = {"type": tray.TYPE_NUMBER, "rot": 0, "state": data_manager.FEEDER_STATE_READY,
+                                "position": [round(x, 2), round(y, 2), w, h]}
+
+    (x_start, x_end), y0, py, count = BENCH_BELTS
+    for i in range(count):
+        y = y0 + i * py
+        feeders[f"belt {i}"] = {"type": belt.TYPE_NUMBER, "rot": 0, "state": data_manager.FEEDER_STATE_READY,
+                                "pitch": BENCH_BELT_PITCH, "start": [x_start, y], "end": [x_end, y],
+                                "offset": list(BENCH_BELT_OFFSET), "position": [x_start, y - 5, x_end - x_start, 10],
+                                "capacity": int((x_end - x_start) // BENCH_BELT_PITCH), "pos": 0,
+                                "current": [x_start, y]}
+
+    for i, pickpos in enumerate(BENCH_ROLLS):
+        x, y = pickpos
+        feeders[f"roll {i}"] = {"type": roll.TYPE_NUMBER, "rot": 0, "state": data_manager.FEEDER_STATE_READY,
+                                "channel": i, "pickpos": list(pickpos), "offset": list(BENCH_BELT_OFFSET),
+                                "position": [x - 5, y - 5, 10, 10]}
+    return feeders
+
+
+def load_board(directory):
+    """
+    context manager with the board of directory on the benchmark feeders
+    returns (context_manager, names of the parts without a free feeder)
+    """
+    bom_file, pnp_file = board_files(directory)
+    context_manager = data_manager.ContextManager()
+    context_manager.context["feeder"] = bench_feeders()
+    context_manager.replace(_read_lines(bom_file), _read_lines(pnp_file))
+
+    feeders = context_manager.context["feeder"]
+    trays = [name for name, f in feeders.items() if f["type"] == tray.TYPE_NUMBER]
+    belts = [name for name, f in feeders.items() if f["type"] == belt.TYPE_NUMBER]
+    rolls = [name for name, f in feeders.items() if f["type"] == roll.TYPE_NUMBER]
+    unassigned = []
+    for part in context_manager.context["bom"]:
+        count = sum(1 for d in part["designators"].values() if data_manager.is_part_ready(part, d))
+        if not count:
+            continue
+        feeder = None
+        if PASSIVE_FOOTPRINT.match(part["footprint"]):
+            #rolls hold any number of parts
+            feeder = rolls[0] if rolls else next((name for name in belts if feeders[name]["capacity"] >= count), None)
+        if feeder is None and trays:
+            #other parts and passives which do not fit on a free belt
+            feeder = trays[0]
+        if feeder is None:
+            part["place"] = False
+            unassigned.extend(part["designators"])
+            continue
+        next(names for names in (trays, belts, rolls) if feeder in names).remove(feeder)
+        part["feeder"] = feeder
+    context_manager.job_queue.rebuild(context_manager.context["bom"])
+    return context_manager, unassigned
+
+
+class ThreadCpu:
+    """
+    CPU seconds of every thread of the process between enter and exit,
+    from /proc/self/task (all threads, also the native ones of numpy/OpenCV)
+    or of the calling thread only where that does not exist.
+    """
+
+    def __init__(self):
+        self.cpu = {}
+        self.wall = 0.0
+
+    @staticmethod
+    def sample():
+        names = {t.native_id: t.name for t in threading.enumerate()}
+        if not os.path.isdir("/proc/self/task"):
+            return {threading.current_thread().name: time.thread_time()}
+        tick = os.sysconf("SC_CLK_TCK")
+        times = {}
+        for tid in os.listdir("/proc/self/task"):
+            try:
+                with open(f"/proc/self/task/{tid}/stat") as f:
+                    stat = f.read()
+            except OSError:
+                continue #thread ended
+            #the name in brackets may contain spaces
+            comm = stat[stat.index("(") + 1:stat.rindex(")")]
+            fields = stat[stat.rindex(")") + 2:].split()
+            name = names.get(int(tid), f"{comm}-{tid}")
+            times[name] = times.get(name, 0.0) + (int(fields[11]) + int(fields[12])) / tick
+        return times
+
+    def __enter__(self):
+        self._start = self.sample()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self._wall
+        end = self.sample()
+        self.cpu = {name: seconds - self._start.get(name, 0.0) for name, seconds in end.items()}
+        return False
+
+
+def bench_board(directory, latency=None, speed=None, accel=None, render=False):
+    """ run the job of one board, returns the result dict"""
+    context_manager, unassigned = load_board(directory)
+    config = BENCH_CONFIG
+    cpu = ThreadCpu()
+    report = simulate_job.simulate_job(context_manager, config, latency, speed, accel, render, monitor=cpu)
+
+    times = np.array(report["placement_times_s"])
+    total = report["total_s"]
+    return {
+        "placements": report["placements"],
+        "placed": report["placed"],
+        "failed": report["failed"],
+        "unassigned": unassigned,
+        "total_s": total,
+        "cph": round(report["placed"] / total * 3600, 1) if total else 0.0,
+        "p50_s": round(float(np.percentile(times, 50)), 3) if times.size else None,
+        "p95_s": round(float(np.percentile(times, 95)), 3) if times.size else None,
+        "phases": report["phases"],
+        "rotation": report["rotation"],
+        "wall_s": round(cpu.wall, 3),
+        "threads": {
+            name: {"cpu_s": round(seconds, 3), "utilisation": round(seconds / total, 4) if total else None}
+            for name, seconds in sorted(cpu.cpu.items()) if seconds > 0
+        },
+        "preflight": report["preflight"],
+        "alert": report["alert"],
+    }
+
+
+def version():
+    """ git description of the checked out code, None outside of a repository"""
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(boards, latency=None, speed=None, accel=None, render=False):
+    results = {
+        "version": version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "settings": {
+            "latency": dict(simulate_job.DEFAULT_LATENCY, **(latency or {})),
+            "speed": dict(simulate_job.DEFAULT_SPEED, **(speed or {})),
+            "accel": dict(simulate_job.DEFAULT_ACCEL, **(accel or {})),
+            "render": render,
+        },
+        "boards": {},
+    }
+    for directory in boards:
+        results["boards"][os.path.basename(os.path.normpath(directory))] = bench_board(directory, latency, speed, accel, render)
+    return results
+
+
+def print_results(results):
+    print(f"version {results['version']}")
+    print(f"{'board':<32}{'placed':>10}{'cph':>10}{'p50':>8}{'p95':>8}{'cpu':>8}")
+    for board, r in results["boards"].items():
+        cpu = sum(t["cpu_s"] for t in r["threads"].values())
+        p50 = f"{r['p50_s']:.2f}" if r["p50_s"] is not None else "-"
+        p95 = f"{r['p95_s']:.2f}" if r["p95_s"] is not None else "-"
+        print(f"{board:<32}{r['placed']:>5}/{r['placements']:<4}{r['cph']:>10.0f}{p50:>8}{p95:>8}{100 * cpu / (r['total_s'] or 1):>7.1f}%")
+        for name, t in r["threads"].items():
+            print(f"{'':<4}{name:<28}{t['cpu_s']:>10.3f}s {100 * (t['utilisation'] or 0):>6.2f}%")
+        if r["unassigned"]:
+            print(f"{'':<4}no feeder: {', '.join(r['unassigned'])}")
+        for problem in r["preflight"]:
+            print(f"{'':<4}preflight: {problem}")
+
+
+def compare(results, baseline, max_drop=0.05):
+    """ returns list of regressions against a baseline result"""
+    regressions = []
+    for board, r in results["boards"].items():
+        b = baseline.get("boards", {}).get(board)
+        if b is None:
+            continue
+        if r["cph"] < b["cph"] * (1 - max_drop):
+            regressions.append(f"{board}: {r['cph']:.0f} cph, baseline {b['cph']:.0f} cph")
+        if r["placed"] < b["placed"]:
+            regressions.append(f"{board}: {r['placed']} placed, baseline {b['placed']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Components per hour of the reference boards on the simulated machine")
+    parser.add_argument("boards", nargs="*", help=f"board directories, default all of {BOARD_DIR}")
+    parser.add_argument("--latency", action="append", help="seconds per detection, for all or as kind=seconds (repeatable)")
+    parser.add_argument("--speed", type=float, help="max xy feedrate in mm/s (M203)")
+    parser.add_argument("--accel", type=float, help="xy acceleration in mm/s^2 (M201)")
+    parser.add_argument("--render", action="store_true", help="run the real detectors on rendered camera images")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="fail if the results regress against this result file")
+    parser.add_argument("--max-drop", type=float, default=0.05, help="allowed relative cph drop against the baseline")
+    args = parser.parse_args(argv)
+
+    boards = args.boards or sorted(os.path.join(BOARD_DIR, d) for d in os.listdir(BOARD_DIR))
+    speed = {"x": args.speed, "y": args.speed} if args.speed else None
+    accel = {"x": args.accel, "y": args.accel} if args.accel else None
+
+    results = benchmark(boards, simulate_job._parse_latency(args.latency), speed, accel, args.render)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_drop)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,6 +3,8 @@ import json
 from importlib import reload
 import pnp_bom_parser
 import os
+import threading
+import collections
 import belt
 
 FEEDER_STATE_DIABLED = 0
@@ -14,6 +16,97 @@ PART_STATE_PLACED = 1
 PART_STATE_ERROR = 2
 PART_STATE_SKIP = 3
 
+
+def is_part_ready(part, partdes):
+    """ True if the designator still has to be placed"""
+    return (part["place"] == True
+        and "x" in partdes
+        and partdes.get("state", PART_STATE_READY) == PART_STATE_READY
+        and partdes["place"]
+        and not part["fiducial"])
+
+
+class JobQueue:
+    """
+    Designators which are ready to be placed, in placing order.
+
+    The ContextManager modifiers patch the queue, so the next part is taken
+    in O(1) instead of scanning the BOM. Parts becoming ready are appended
+    and listed in added, reorder() applies a planned order. Removing a part
+    keeps the order of the others.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._jobs = collections.OrderedDict() # designator -> (part, partdes)
+        #the whole queue was replaced since the last reorder
+        self.changed = False
+        #designators appended since the last reorder
+        self.added = []
+
+    def rebuild(self, bom):
+        with self.lock:
+            self._jobs.clear()
+            for part in bom:
+                for name, partdes in part["designators"].items():
+                    if is_part_ready(part, partdes):
+                        self._jobs[name] = (part, partdes)
+            self.changed = True
+            self.added = []
+
+    def update(self, part, name):
+        """ add or remove one designator after its state changed"""
+        with self.lock:
+            partdes = part["designators"][name]
+            if is_part_ready(part, partdes):
+                if name not in self._jobs:
+                    self._jobs[name] = (part, partdes)
+                    self.added.append(name)
+            else:
+                self._jobs.pop(name, None)
+
+    def update_part(self, part):
+        """ add or remove all designators of a BOM entry"""
+        with self.lock:
+            for name in part["designators"]:
+                self.update(part, name)
+
+    def reorder(self, names):
+        """ place the designators in this order, the ones not listed keep their order at the end"""
+        with self.lock:
+            for name in reversed(names):
+                if name in self._jobs:
+                    self._jobs.move_to_end(name, last=False)
+            self.changed = False
+            self.added = []
+
+    def pop(self):
+        """ returns (designator, part, partdes) of the next designator or (None, None, None)"""
+        with self.lock:
+            while self._jobs:
+                name, (part, partdes) = self._jobs.popitem(last=False)
+                #the state can be changed without the queue, e.g. by _place_part
+                if is_part_ready(part, partdes):
+                    return name, part, partdes
+            return None, None, None
+
+    def peek(self):
+        """ returns (designator, part, partdes) of the next designator without removing it or (None, None, None)"""
+        with self.lock:
+            for name, (part, partdes) in self._jobs.items():
+                if is_part_ready(part, partdes):
+                    return name, part, partdes
+            return None, None, None
+
+    def items(self):
+        """ list of (designator, part, partdes) in placing order"""
+        with self.lock:
+            return [(name, part, partdes) for name, (part, partdes) in self._jobs.items()]
+
+    def __len__(self):
+        return len(self._jobs)
+
+
 class ContextManager:
 
     part_state = ["ready", "placed", "error", "skip"]
@@ -23,6 +116,10 @@ class ContextManager:
 
     def __init__(self):
         self.context = {}
+        self.job_queue = JobQueue()
+        self.designators = {} # designator -> (bom entry, designator dict)
+        #incremented whenever positions or rotations of the BOM change
+        self.bom_version = 0
         self.file_read()
 
     def file_save(self, filename="context"):
@@ -59,6 +156,7 @@ class ContextManager:
             self.context["const"]["part_state"] = self.part_state
             self.context["const"]["feeder_type"] = self.feeder_type
             self.context["const"]["feeder_state"] = self.feeder_state
+        self._rebuild_index()
 
     def get(self):
         return self.context
@@ -68,16 +166,31 @@ class ContextManager:
         reload(pnp_bom_parser)
         self.context["bom"] = pnp_bom_parser.pnp_bom_parse(pnp_str, bom_str)
         self._auto_assign_symbols()
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        """ rebuild everything derived from the BOM, after it was replaced"""
+        self.designators = build_designator_index(self.context.get("bom", []))
+        self.bom_version += 1
+        self.job_queue.rebuild(self.context.get("bom", []))
+
+    def get_part_from_designator(self, designator):
+        """ returns (bom entry, designator dict) or (None, None)"""
+        return self.designators.get(designator, (None, None))
 
 
     def modify_bom_place(self, index, do_place):
         print((index, do_place))
-        self._get_bom_by_index(index)["place"] = do_place
+        part = self._get_bom_by_index(index)
+        part["place"] = do_place
+        self.job_queue.update_part(part)
 
 
     def modify_bom_fiducial(self, index, is_fiducial):
         print((index, is_fiducial))
-        self._get_bom_by_index(index)["fiducial"] = is_fiducial
+        part = self._get_bom_by_index(index)
+        part["fiducial"] = is_fiducial
+        self.job_queue.update_part(part)
 
 
     def modify_bom_foorprint(self, index, footprint):
@@ -98,6 +211,7 @@ class ContextManager:
             bom["rot"] = rot
         else:
             bom["rot"] = rotation
+        self.bom_version += 1
 
 
     def modify_part_state(self, part_id, state=None):
@@ -108,6 +222,7 @@ class ContextManager:
             part["state"] = (part["state"] + 1) % len(self.part_state)
         else:
             part["state"] = state
+        self.job_queue.update(self._get_bom_by_id(part_id), part_id)
 
 
     def modify_feeder_rot(self, feeder_id, rotation=None):
@@ -167,16 +282,17 @@ class ContextManager:
         return self.context["bom"][index]
 
     def _get_bom_by_id(self, designator):
-        for part in self.context["bom"]:
-            if designator in part["designators"]:
-                return part
-        raise Exception("id %s not found in BOM" % designator)
+        try:
+            return self.designators[designator][0]
+        except KeyError:
+            raise Exception("id %s not found in BOM" % designator)
 
     def _get_part_by_id(self, designator):
-        for part in self.context["bom"]:
-            if designator in part["designators"]:
-                return part["designators"][designator]
-        raise Exception("id %s not found in parts" % designator)
+        try:
+            return self.designators[designator][1]
+        except KeyError:
+            raise Exception("id %s not found in parts" % designator)
+
 
     def _get_feeder_by_id(self, id):
         try:
@@ -224,3 +340,12 @@ class ContextManager:
             if size != None and type != None:
                 part["footprint"] = size + "_" + type
 
+
+def build_designator_index(bom):
+    """ designator -> (bom entry, designator dict), the first entry wins like the former BOM scan"""
+    index = {}
+    for part in bom:
+        for name, partdes in part["designators"].items():
+            index.setdefault(name, (part, partdes))
+    return index
+
@@ -1,4 +1,5 @@
 import os
+import json
 
 import cv2
 
@@ -9,6 +10,10 @@ if not os.path.exists(file_dir):
     os.mkdir(file_dir)
 data = {}
 
+#set to a directory to record the raw detector input frames (e.g. for vision_bench.py)
+record_dir = os.getenv("DEBUG_RECORD_DIR")
+record_count = 0
+
 def set_image(name, image):
     cv2.imwrite(f"{file_dir}/{name}.jpg", image)
     data[name] = {
@@ -22,4 +27,29 @@ def set_text(name, text):
         "text" : text,
     }
 
+def record_image(name, image, **meta):
+    """
+    Save a raw detector input frame in the same format as set_image and
+    append it with its metadata to 'annotations.json' in record_dir.
+    The ground truth ("truth") has to be added by hand afterwards.
+    """
+    global record_count
+    if record_dir is None or image is None:
+        return
+    if not os.path.exists(record_dir):
+        os.makedirs(record_dir)
+
+    filename = f"{name}_{os.getpid()}_{record_count}.jpg"
+    record_count += 1
+    cv2.imwrite(f"{record_dir}/{filename}", image)
+
+    annotations_file = f"{record_dir}/annotations.json"
+    annotations = {}
+    if os.path.exists(annotations_file):
+        with open(annotations_file, "r") as f:
+            annotations = json.load(f)
+    annotations[filename] = dict(meta, truth=None)
+    with open(annotations_file, "w") as f:
+        json.dump(annotations, f, indent=4)
+
 #set_text("test1", "please püll")
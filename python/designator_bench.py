@@ -0,0 +1,57 @@
+"""
+Benchmark of the designator lookup of data_manager.
+
+Times the lookup of designators in a synthetic panel BOM with the index of
+the ContextManager (build_designator_index) against scanning the BOM.
+
+usage: python designator_bench.py [--count 500 5000 50000] [--lookups 2000]
+"""
+
+import argparse
+import sys
+import time
+
+import data_manager
+
+
+def benchmark_designator_lookup(count=5000, lookups=2000):
+    """ time designator lookups in a panel with count designators, indexed vs BOM scan (microseconds)"""
+    bom = [{"designators": {f"R{i}_{j}": {"x": "0", "y": "0"} for j in range(10)}} for i in range(count // 10)]
+    names = [name for part in bom for name in part["designators"]]
+    names = [names[(i * 7919) % len(names)] for i in range(lookups)]
+
+    t = time.perf_counter()
+    index = data_manager.build_designator_index(bom)
+    build = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for name in names:
+        index[name]
+    indexed = time.perf_counter() - t
+
+    t = time.perf_counter()
+    for name in names:
+        next(part for part in bom if name in part["designators"])
+    scan = time.perf_counter() - t
+
+    return {
+        "designators": len(index),
+        "build_us": build * 1e6,
+        "indexed_us": indexed / lookups * 1e6,
+        "scan_us": scan / lookups * 1e6,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the designator lookup")
+    parser.add_argument("--count", type=int, nargs="+", default=[500, 5000, 50000], help="designators of the panel")
+    parser.add_argument("--lookups", type=int, default=2000, help="timed lookups per panel")
+    args = parser.parse_args(argv)
+
+    for count in args.count:
+        print(benchmark_designator_lookup(count, args.lookups))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,5 @@
 
-import time
-
+import clock
 import calibrator
 
 class Eye:
@@ -25,7 +24,7 @@ class Eye:
         )
 
         self.robot.done()
-        time.sleep(0.6)
+        clock.sleep(0.6, "settle")
         if 'image' in self.camera.cache:
             image = self.camera.cache["image"]
             image = self.ip.project(image)
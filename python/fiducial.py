@@ -6,14 +6,16 @@ import numpy as np
 
 import debug
 import math
+import circle_engine
+import vision_config
 
 class NoFiducialFoundException(Exception):
     pass
 
 class FiducialMultiDetector:
 
-    def __init__(self, eye, radius_list=[1, 0.7/2]):
-        self.fd = [FiducialDetector(eye, radius=r) for r in radius_list]
+    def __init__(self, eye, radius_list=[1, 0.7/2], config=None):
+        self.fd = [FiducialDetector(eye, radius=r, config=config) for r in radius_list]
         self.eye = eye
         if eye.get_valid_image() is not None:
             self.shape = eye.get_valid_image().shape
@@ -41,32 +43,42 @@ class FiducialMultiDetector:
 
 class FiducialDetector:
 
-    def __init__(self, eye, radius=0.7/2):
+    def __init__(self, eye, radius=0.7/2, config=None):
 
         self.eye = eye
 
         self.radius = radius # 0.7/2
         self.r_tol= 0.2
+        self.blur = 5
+        self.binary_threshold = 50
+
+        #circle detection engine, see circle_engine.py
+        self.engine = circle_engine.HoughEngine()
+        #[vision.fiducial] section of config.toml
+        vision_config.configure(self, config)
 
     def __call__(self):
 
         image = self.eye.get_valid_image()
+        debug.record_image("FiducialDetector", image, detector="fiducial", res=self.eye.res, cam_range=self.eye.cam_range, radius=self.radius)
 
         # image = cv2.medianBlur(image,5)
-        image = cv2.GaussianBlur(image,(5, 5), 1, 1)
+        image = cv2.GaussianBlur(image,(self.blur, self.blur), 1, 1)
 
-        _, image = cv2.threshold(image, 50, 255, cv2.THRESH_BINARY)
+        _, image = cv2.threshold(image, self.binary_threshold, 255, cv2.THRESH_BINARY)
 
-        circles = cv2.HoughCircles(image,cv2.HOUGH_GRADIENT,1,0.1,
-                            param1=50,param2=10, # 50,20
-                            minRadius=int((self.radius - self.r_tol) * self.eye.res),
-                            maxRadius=int((self.radius + self.r_tol) * self.eye.res))
+        #the thresholded fiducial is a bright disc on black
+        circles = self.engine.find(image,
+            radius=self.radius * self.eye.res,
+            r_tol=self.r_tol * self.eye.res,
+            min_dist=0.1,
+            polarity="bright")
 
         image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
 
         if circles is not None:
             circles = np.uint16(np.around(circles))
-            circle = circles[0,0]
+            circle = circles[0]
 
             # draw the outer circle
             image = cv2.circle(image,(circle[0], circle[1]), circle[2], (0,255,0),1)
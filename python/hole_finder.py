@@ -1,6 +1,8 @@
 import cv2
 import numpy as np
 import debug
+import circle_engine
+import vision_config
 
 
 class NoBeltHoleFoundException(Exception):
@@ -10,31 +12,52 @@ class NoBeltHoleFoundException(Exception):
 
 class HoleFinder:
 
-    def __init__(self, eye):
+    def __init__(self, eye, config=None):
         self.eye = eye
 
         self.radius = 1.5/2
         self.r_tol= 0.2
+        self.blur = 5
+
+        #circle detection engine, see circle_engine.py
+        self.engine = circle_engine.HoughEngine()
+        self._engines = {}
+        #[vision.hole] section of config.toml
+        vision_config.configure(self, config)
 
         self.detected_pos = (0,0)
 
+    def get_engine(self, name=None):
+        """ the default engine or one selected by name (e.g. from the feeder settings)"""
+        if name is None or name == self.engine.name:
+            return self.engine
+        if name not in self._engines:
+            self._engines[name] = circle_engine.make_engine(name)
+        return self._engines[name]
+
+    def _detect_circles(self, image, min_dist=0.1, engine=None):
+        """ return all circles as array[n, 3] (x, y, r) in pixel, best first, or None"""
 
-    def find_hole(self):
+        return self.get_engine(engine).find(image,
+            radius=self.radius * self.eye.res,
+            r_tol=self.r_tol * self.eye.res,
+            min_dist=min_dist,
+            polarity="any")
+
+    def find_hole(self, engine=None):
 
         image = self.eye.get_valid_image()
+        debug.record_image("BeltHole", image, detector="hole", res=self.eye.res, cam_range=self.eye.cam_range, radius=self.radius)
 
-        image = cv2.GaussianBlur(image, (5, 5), 1, 1)
+        image = cv2.GaussianBlur(image, (self.blur, self.blur), 1, 1)
 
-        circles = cv2.HoughCircles(image,cv2.HOUGH_GRADIENT,1,0.1,
-                            param1=50,param2=10, # 50,20
-                            minRadius=int((self.radius - self.r_tol) * self.eye.res),
-                            maxRadius=int((self.radius + self.r_tol) * self.eye.res))
+        circles = self._detect_circles(image, engine=engine)
 
         image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
 
         if circles is not None:
             circles = np.uint16(np.around(circles))
-            circle = circles[0,0]
+            circle = circles[0]
 
             # draw the outer circle
             image = cv2.circle(image,(circle[0], circle[1]), circle[2], (0,255,0),1)
@@ -47,4 +70,37 @@ class HoleFinder:
             self.detected_pos = pos
             return pos
 
-        raise NoBeltHoleFoundException("No belt found")
\ No newline at end of file
+        raise NoBeltHoleFoundException("No belt found")
+
+    def find_holes(self, engine=None):
+        """
+        Find every hole in the current view with a single image.
+        engine : name of the circle engine, None for the default
+
+        returns array[n, 2] of hole positions in machine coordinates
+        """
+
+        image = self.eye.get_valid_image()
+        debug.record_image("BeltHoles", image, detector="holes", res=self.eye.res, cam_range=self.eye.cam_range, radius=self.radius)
+
+        image = cv2.GaussianBlur(image, (self.blur, self.blur), 1, 1)
+
+        # holes can not overlap, so everything closer than a diameter is the same hole
+        circles = self._detect_circles(image, min_dist=2 * self.radius * self.eye.res, engine=engine)
+
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+        if circles is None:
+            raise NoBeltHoleFoundException("No belt found")
+
+        positions = []
+        for x, y, r in circles:
+            center = (int(round(x)), int(round(y)))
+            image = cv2.circle(image, center, int(round(r)), (0,255,0), 1)
+            image = cv2.circle(image, center, 2, (0,0,255), 3)
+            positions.append(self.eye.get_pos_from_image_indices(x, y))
+        debug.set_image("BeltHoles", image)
+
+        positions = np.array(positions, dtype=np.float64)
+        self.detected_pos = tuple(positions[0])
+        return positions
@@ -0,0 +1,199 @@
+import math
+import logging
+
+import tray
+
+#light used while picking from a feeder type
+TRAY_LIGHT = "tray"
+TOPDN_LIGHT = "topdn"
+
+
+def feeder_position(feeder):
+    """ rough machine position where the feeder is picked from, None if unknown"""
+    if feeder["type"] == tray.TYPE_NUMBER:
+        if feeder.get("last_found_pos") is not None:
+            return tuple(feeder["last_found_pos"])
+        x, y, w, h = feeder["position"]
+        return (x + w / 2, y + h / 2)
+    for key in ("current", "pickpos"):
+        if feeder.get(key) is not None:
+            return tuple(feeder[key])
+    return None
+
+
+class Job:
+    """ one placement: pick from feeder, place at place_pos (both machine coordinates)"""
+
+    def __init__(self, name, part, partdes, feeder, light, pick_pos, place_pos):
+        self.name = name
+        self.part = part
+        self.partdes = partdes
+        self.feeder = feeder
+        self.light = light
+        self.pick_pos = pick_pos
+        self.place_pos = place_pos
+
+
+class JobPlanner:
+    """
+    Orders the placements of a run to shorten the head travel.
+
+    The jobs are grouped by lighting mode (one switch tray <-> topdn) and by
+    feeder. Every placement is a trip feeder -> board, so inside a group the
+    travel only depends on which placement comes last (the exit towards the
+    next feeder). The group order is found by nearest neighbour and improved
+    with 2-opt, inside a group only the exit placement is chosen.
+
+    Parts added during a run are inserted into the planned order (insert())
+    instead of planning the whole run again.
+    """
+
+    def __init__(self):
+        self.sequence = []
+        self.planned_travel = 0.0
+        self.bom_travel = 0.0
+
+    def plan(self, jobs, start_pos):
+        """ plan the order of jobs (in BOM order) starting at the head position start_pos"""
+        self.bom_travel = travel(jobs, start_pos)
+        self.sequence = self._order(jobs, start_pos)
+        self.planned_travel = travel(self.sequence, start_pos)
+        logging.info(f"job planned: {len(self.sequence)} placements, travel {self.planned_travel:.0f}mm"
+            f" instead of {self.bom_travel:.0f}mm in BOM order ({self.saved():.0f}mm saved)")
+        return self.sequence
+
+    def insert(self, sequence, jobs, start_pos):
+        """
+        add jobs to a planned sequence (the remaining placements in order) from
+        the head position start_pos. A job of a feeder which is already in the
+        sequence goes in front of the placements of that feeder, the placements
+        of a new feeder go between the groups of the same light where they add
+        the least travel. returns the new sequence
+        """
+        groups = []
+        for job in sequence:
+            if groups and (groups[-1][0].light, groups[-1][0].feeder) == (job.light, job.feeder):
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+
+        for job in jobs:
+            group = next((g for g in groups if (g[0].light, g[0].feeder) == (job.light, job.feeder)), None)
+            if group is not None:
+                #the exit placement stays last
+                group.insert(0, job)
+                continue
+            group = [job]
+            same_light = [i for i in range(len(groups) + 1)
+                if (i > 0 and groups[i - 1][0].light == job.light) or (i < len(groups) and groups[i][0].light == job.light)]
+            best = min(same_light or [len(groups)], key=lambda i: _tour_cost(groups[:i] + [group] + groups[i:], start_pos))
+            groups.insert(best, group)
+            #the group in front of it gets another exit
+            for i in range(max(best - 1, 0), best + 1):
+                next_pick = groups[i + 1][0].pick_pos if i + 1 < len(groups) else None
+                groups[i] = _order_group(groups[i], next_pick)
+
+        sequence = [job for group in groups for job in group]
+        logging.info(f"job planned: {len(jobs)} placements inserted, {len(sequence)} remaining")
+        self.sequence = sequence
+        return sequence
+
+    def saved(self):
+        return self.bom_travel - self.planned_travel
+
+    def report(self, remaining):
+        """ JSON safe summary for the web interface"""
+        return {
+            "remaining": remaining,
+            "planned_travel": round(self.planned_travel, 1),
+            "bom_travel": round(self.bom_travel, 1),
+            "saved_travel": round(self.saved(), 1),
+        }
+
+    def _order(self, jobs, start_pos):
+        groups = {}
+        for job in jobs:
+            groups.setdefault((job.light, job.feeder), []).append(job)
+
+        #all groups of one light are done in a block, the block with the
+        #closest feeder first
+        blocks = {}
+        for (light, _feeder), group in groups.items():
+            blocks.setdefault(light, []).append(group)
+        blocks = sorted(blocks.values(), key=lambda b: min(_dist(start_pos, g[0].pick_pos) for g in b))
+
+        sequence = []
+        pos = start_pos
+        for block in blocks:
+            block = _order_groups(block, pos)
+            for i, group in enumerate(block):
+                next_pick = block[i + 1][0].pick_pos if i + 1 < len(block) else None
+                ordered = _order_group(group, next_pick)
+                sequence += ordered
+                pos = ordered[-1].place_pos
+        return sequence
+
+
+def travel(jobs, start_pos):
+    """ head travel in mm of placing jobs in this order"""
+    total = 0
+    pos = start_pos
+    for job in jobs:
+        total += _dist(pos, job.pick_pos) + _dist(job.pick_pos, job.place_pos)
+        pos = job.place_pos
+    return total
+
+
+def _dist(a, b):
+    return math.dist(a, b)
+
+
+def _exit_gain(group, next_pick):
+    """ best saving of ending the group next to next_pick instead of returning to the feeder"""
+    if next_pick is None:
+        return max(_dist(group[0].pick_pos, job.place_pos) for job in group)
+    return max(_dist(group[0].pick_pos, job.place_pos) - _dist(job.place_pos, next_pick) for job in group)
+
+
+def _tour_cost(groups, start_pos):
+    """ travel of the group tour without the constant feeder -> board trips"""
+    cost = _dist(start_pos, groups[0][0].pick_pos)
+    for i, group in enumerate(groups):
+        next_pick = groups[i + 1][0].pick_pos if i + 1 < len(groups) else None
+        cost -= _exit_gain(group, next_pick)
+    return cost
+
+
+def _order_groups(groups, start_pos):
+    """ nearest neighbour tour over the feeders, then 2-opt"""
+    remaining = list(groups)
+    tour = []
+    pos = start_pos
+    while remaining:
+        group = min(remaining, key=lambda g: _dist(pos, g[0].pick_pos))
+        remaining.remove(group)
+        tour.append(group)
+        pos = group[0].pick_pos
+
+    best = _tour_cost(tour, start_pos)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(tour) - 1):
+            for j in range(i + 2, len(tour) + 1):
+                candidate = tour[:i] + tour[i:j][::-1] + tour[j:]
+                cost = _tour_cost(candidate, start_pos)
+                if cost < best - 1e-9:
+                    tour, best = candidate, cost
+                    improved = True
+    return tour
+
+
+def _order_group(group, next_pick):
+    """ placements of one feeder ending at the best exit, the others keep their order"""
+    feeder_pos = group[0].pick_pos
+    if next_pick is None:
+        exit_job = max(group, key=lambda job: _dist(feeder_pos, job.place_pos))
+    else:
+        exit_job = max(group, key=lambda job: _dist(feeder_pos, job.place_pos) - _dist(job.place_pos, next_pick))
+    return [job for job in group if job is not exit_job] + [exit_job]
@@ -0,0 +1,135 @@
+import math
+
+import numpy as np
+import cv2
+
+import debug
+
+#mm overlap between neighbouring tiles. The image border is dropped because
+#the projection leaves it black and it has the most paralax.
+MOSAIC_OVERLAP = 2
+#mosaic images bigger than this are refused (same order as Homography)
+MOSAIC_MAX_PIXELS = 16e6
+#grid size of the part index in mm
+INDEX_CELL_SIZE = 10
+
+
+class Mosaic:
+    """
+    Scans an area of the bed in one serpentine pass and stitches the Eye
+    projections into one image registered in mm.
+
+    Pixel (u, v) of the mosaic is at machine position (x + u/res, y + v/res)
+    with (x, y) being the lower corner of the scanned area.
+    """
+
+    def __init__(self, eye):
+        self.eye = eye
+
+        self.image = None
+        self.origin = (0, 0)
+        self.res = eye.res if eye is not None else 1
+
+    def scan(self, robot, area, res=None, name="Mosaic"):
+        """
+        area : (x, y, width, height) in mm
+        res : pixel per mm of the mosaic (default resolution of the eye)
+        returns the mosaic image
+        """
+        x, y, w, h = area
+        res = self.eye.res if res is None else res
+
+        width = int(round(w * res))
+        height = int(round(h * res))
+        if width * height > MOSAIC_MAX_PIXELS:
+            raise ValueError(f"Mosaic has more than {MOSAIC_MAX_PIXELS:.0f} pixel, lower the resolution")
+
+        #tiles are spread evenly so each one covers less than the usable view
+        step = self.eye.cam_range - 2 * MOSAIC_OVERLAP
+        nx = max(1, int(math.ceil(w / step)))
+        ny = max(1, int(math.ceil(h / step)))
+
+        image = np.zeros((height, width), np.uint8)
+
+        for i in range(nx):
+            rows = range(ny)
+            if i % 2:
+                rows = reversed(rows)
+
+            for j in rows:
+                robot.drive(x + (i + 0.5) * w / nx, y + (j + 0.5) * h / ny)
+                tile = self.eye.get_valid_image()
+                if tile is None:
+                    continue
+
+                u0, u1 = int(round(i * w / nx * res)), int(round((i + 1) * w / nx * res))
+                v0, v1 = int(round(j * h / ny * res)), int(round((j + 1) * h / ny * res))
+                image[v0:v1, u0:u1] = self._warp_tile(tile, (x, y), res, (u0, v0), (u1 - u0, v1 - v0))
+
+        self.image = image
+        self.origin = (x, y)
+        self.res = res
+
+        debug.set_image(name, image)
+        return image
+
+    def _warp_tile(self, tile, origin, res, offset, size):
+        """ resample the tile into the mosaic cell starting at pixel offset"""
+        s = res / self.eye.res
+        cx, cy = self.eye.robot_pos
+        r = self.eye.cam_range / 2
+        m = np.array([
+            [s, 0, (cx - r - origin[0]) * res - offset[0]],
+            [0, s, (cy - r - origin[1]) * res - offset[1]],
+        ], dtype=np.float64)
+        return cv2.warpAffine(tile, m, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def get_pos_from_image_indices(self, index_x, index_y):
+        return (
+            index_x / self.res + self.origin[0],
+            index_y / self.res + self.origin[1],
+        )
+
+    def find_parts(self, picker, footprint=None):
+        """ run the component detection on the mosaic and return a PartIndex"""
+        if self.image is None:
+            raise Exception("scan must be invoked prior to find_parts")
+
+        index = PartIndex()
+        p, a, A, s = picker.find_components(self.image, res=self.res, footprint=footprint)
+        for (px, py), angle, area, score in zip(p, a, A, s):
+            x, y = self.get_pos_from_image_indices(px, py)
+            #area in pixel of the eye, as if detected in a single frame
+            index.add(x, y, angle, area * (picker.eye.res / self.res) ** 2, score)
+        return index
+
+
+class PartIndex:
+    """ Spatial index of detected parts. Entries are [x, y, angle, area, score] in machine coordinates."""
+
+    def __init__(self, cell_size=INDEX_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _key(self, x, y):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def add(self, x, y, angle, area, score=None):
+        entry = [float(x), float(y), float(angle), float(area), score]
+        self.cells.setdefault(self._key(x, y), []).append(entry)
+        return entry
+
+    def __len__(self):
+        return sum(len(c) for c in self.cells.values())
+
+    def query(self, x, y, w, h):
+        """ all entries within the rectangle (x, y, w, h)"""
+        i0, j0 = self._key(x, y)
+        i1, j1 = self._key(x + w, y + h)
+        result = []
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                for e in self.cells.get((i, j), ()):
+                    if x <= e[0] <= x + w and y <= e[1] <= y + h:
+                        result.append(e)
+        return result
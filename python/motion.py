@@ -0,0 +1,31 @@
+"""
+Motion model of the controller, to estimate how long a move takes.
+
+Every axis drives on its own with a trapezoidal (or triangular) speed
+profile, a move is done when the slowest axis arrives (see app.cpp).
+"""
+
+import math
+
+#M203 max feedrates (mm/s, e in degree/s) and M201 accelerations (mm/s^2) after M512
+DEFAULT_SPEED = {"x": 120.0, "y": 120.0, "z": 40.0, "e": 720.0}
+DEFAULT_ACCEL = {"x": 600.0, "y": 600.0, "z": 400.0, "e": 3600.0}
+
+
+def move_time(distance, speed, accel):
+    """ seconds of a trapezoidal (or triangular) move"""
+    if distance <= 0:
+        return 0.0
+    if distance >= speed ** 2 / accel:
+        return distance / speed + speed / accel
+    return 2 * math.sqrt(distance / accel)
+
+
+def travel_time(start, end, speed=None, accel=None):
+    """
+    seconds of an xy move from start to end (x, y)
+    speed/accel : per axis, default are the controller defaults
+    """
+    speed = dict(DEFAULT_SPEED, **(speed or {}))
+    accel = dict(DEFAULT_ACCEL, **(accel or {}))
+    return max(move_time(abs(end[i] - start[i]), speed[axis], accel[axis]) for i, axis in enumerate("xy"))
@@ -1,24 +1,119 @@
 
-import time
+import math
 import json
+import logging
 
 import numpy as np
 import cv2
 
+import clock
 import debug
 import config_old
+import motion
+import vision_config
+
+#sizes of the parts, also used by the web interface
+FOOTPRINT_FILE = "web/footprints.json"
+#a blob whose length or width is off by more than this fraction is not the expected part
+FOOTPRINT_TOLERANCE = 0.35
+#seconds the vacuum line needs to purge with the pump on and the valve released
+VACUUM_PURGE_TIME = 1.0
+#fraction of the estimated travel time trusted to cover the purge
+TRAVEL_ESTIMATE_MARGIN = 0.8
 
 class NoPartFoundException(Exception):
     pass
 
+
+class ZHoming:
+    """
+    Decides when the z axis is homed again between placements.
+
+    Lost z steps change the nozzle height, which shows up in the bottom up
+    images: a part held lower or higher looks bigger or smaller. The apparent
+    size of each footprint right after homing is the reference, the median of
+    the last few ratios gives the height drift. Without drift measurements
+    (no bottom camera or no [bottom_camera] distance) only max_interval
+    applies, and it defaults to the former fixed interval.
+
+    Configured by the [z_homing] section of config.toml:
+
+        max_interval = 25   # placements, home at least this often (0 = only on drift)
+                            # default 25 with drift measurements, 6 without
+        tolerance = 0.3     # mm of estimated drift which triggers a homing
+        samples = 3         # bottom up measurements the drift is the median of
+    """
+
+    DRIFT_INTERVAL = 25
+    BLIND_INTERVAL = 6
+
+    def __init__(self, config=None, measures_drift=False):
+        config = config or {}
+        default_interval = self.DRIFT_INTERVAL if measures_drift else self.BLIND_INTERVAL
+        self.max_interval = config.get("max_interval", default_interval)
+        self.tolerance = config.get("tolerance", 0.3)
+        self.samples = config.get("samples", 3)
+
+        self.placements = 0 # since the last homing
+        self.drift = 0.0 # estimated nozzle height drift in mm
+        self.homes = 0
+        self._reference = {} # footprint -> part area after homing
+        self._ratios = []
+
+    def observe(self, footprint, area, distance):
+        """
+        area of a part in the bottom up image (mm^2 at the image height)
+        distance : mm from the lens to the part at the image height
+        """
+        if area is None or area <= 0 or not distance:
+            return
+        reference = self._reference.setdefault(footprint, area)
+        self._ratios = (self._ratios + [math.sqrt(area / reference)])[-self.samples:]
+        if len(self._ratios) == self.samples:
+            #the apparent size goes with 1/distance
+            self.drift = distance * (1 - 1 / float(np.median(self._ratios)))
+
+    def placed(self):
+        self.placements += 1
+
+    def needs_home(self):
+        if abs(self.drift) > self.tolerance:
+            logging.info(f"z drift {self.drift:.2f}mm after {self.placements} placements, homing z")
+            return True
+        if self.max_interval and self.placements >= self.max_interval:
+            logging.info(f"{self.placements} placements since the last homing, homing z")
+            return True
+        return False
+
+    def homed(self):
+        self.placements = 0
+        self.drift = 0.0
+        self.homes += 1
+        self._reference = {}
+        self._ratios = []
+
 class Picker():
 
-    def __init__(self, eye):
+    def __init__(self, eye, config=None, homing=None, measures_drift=False):
+        """
+        config : [vision.components] section, homing : [z_homing] section of config.toml
+        measures_drift : a bottom camera with known distance reports the part sizes (see ZHoming)
+        """
 
         self.min_area_mm2 = 0.75
+        self.blur = 11
+        self.open_kernel = 5
 
         self.eye = eye
-        self.home_interval = 0
+        self.z_homing = ZHoming(homing, measures_drift)
+        self._footprints = None
+        #footprint names which were warned about as unknown
+        self._unknown_footprints = set()
+        self._symmetries = None
+        #nozzle angle after the last pick or place
+        self.e = 0.0
+        #nozzle rotation in degree, and what the part symmetry saved (see equivalent_angle)
+        self.rotation = {"rotated": 0.0, "saved": 0.0, "skipped": 0}
 
         try:
             with open("user/picker.json", "r") as f:
@@ -33,13 +128,16 @@ class Picker():
                 self.DY = d["DY"]
                 print("picker default calibration")
 
+        #[vision.components] section of config.toml
+        vision_config.configure(self, config)
+
     def _detect_pick_location(self, robot_pos, robot):
 
         robot.light_topdn(False)
         robot.drive(*robot_pos)
         image = self.eye.get_valid_image()
 
-        p, a, _ = self.find_components(image)
+        p, a, _, _ = self.find_components(image)
         if len(p):
             pos = np.array(p[0])
             pos = tuple((pos / self.eye.res) - (self.eye.cam_range/2) + robot_pos)
@@ -48,47 +146,69 @@ class Picker():
 
         return pos[0], pos[1], a[0]
 
-    def pick(self, robot, x, y, angle, pick_depth=config_old.PICK_Z_PLACE, done_time=None):
+    def pick(self, robot, x, y, angle, pick_depth=config_old.PICK_Z_PLACE, done_time=None, symmetry=360):
+        """ symmetry : rotation in degree which maps the part onto itself, see get_footprint_symmetry()"""
         print(f"pick z={pick_depth}")
-        vacuum_time = time.time() + 1
+        angle = self.equivalent_angle(angle, symmetry)
+        #the pump may still run since the last place (see place(keep_vacuum=True)),
+        #then the line purges since the valve release there
         robot.vacuum(True)
+        vacuum_time = getattr(robot, "purge_since", None)
+        vacuum_time = (vacuum_time if vacuum_time is not None else clock.time()) + VACUUM_PURGE_TIME
         robot.valve(False)
-        robot.drive(x=x+self.DX, y=y+self.DY, e=angle, f=200, r=10.0)
+
+        #the nozzle goes down right after the move (without waiting on the host)
+        #if the move surely takes longer than the rest of the purge
+        target = (x + self.DX, y + self.DY)
+        travel = 0.0
+        if getattr(robot, "pos_logger", None) is not None:
+            head = (robot.pos_logger["x"], robot.pos_logger["y"])
+            travel = motion.travel_time(head, target, speed={"x": 200, "y": 200}) * TRAVEL_ESTIMATE_MARGIN
+        wait = done_time is not None or clock.time() + travel < vacuum_time
+
+        robot.drive(x=target[0], y=target[1], e=angle, f=200, r=10.0)
         robot.drive(e=angle) #finish angle
-        robot.done()
-        if done_time != None:
-            #must sleep until done-time is reached
-            t = done_time - time.time()
+        if wait:
+            robot.done()
+            if done_time != None:
+                #must sleep until done-time is reached
+                t = done_time - clock.time()
+                if t > 0:
+                    print("sleeping %fs" % t) #need to wait for something else before pick
+                    clock.sleep(t, "feeder")
+            t = vacuum_time - clock.time()
             if t > 0:
-                print("sleeping %fs" % t) #need to wait for something else before pick
-                time.sleep(t)
-        t = vacuum_time - time.time() 
-        if t > 0:
-            print("sleeping for %fs (vacuum)" % t)
-            time.sleep(t) #need to wait for vacuum line to purge
+                print("sleeping for %fs (vacuum)" % t)
+                clock.sleep(t, "vacuum") #need to wait for vacuum line to purge
         robot.drive(z=pick_depth)
         robot.done()
         robot.valve(True)
         robot.drive(z=0)
+        self.e = angle
         # robot.drive(e=0, r=10.0)
         # robot.drive(e=0, f=200, r=0.75)
 
-    def place(self, robot, x, y, angle, pick_depth=config_old.PICK_Z_PLACE):
+    def place(self, robot, x, y, angle, pick_depth=config_old.PICK_Z_PLACE, keep_vacuum=False):
+        """
+        keep_vacuum : leave the pump running for the next pick, the line purges during the travel
+        """
         print(f"place z={pick_depth}")
         robot.drive(x=x+self.DX, y=y+self.DY, e=angle, f=200, r=10.0)
         robot.drive(e=angle)
         robot.drive(z=pick_depth)
+        self.e = angle
         robot.done()
         robot.valve(False)
-        robot.vacuum(False)
+        if not keep_vacuum:
+            robot.vacuum(False)
         robot.drive(z=0)
 
-        self.home_interval += 1
-        if self.home_interval > 5:
+        self.z_homing.placed()
+        if self.z_homing.needs_home():
             robot.done()
-            self.home_interval = 0
             robot.home('z')
             robot.drive(z=0)
+            self.z_homing.homed()
 
     def calibrate_legacy(self, pos, robot, camera):
 
@@ -163,15 +283,55 @@ class Picker():
 
         print(f"Picker calibration correction : x={correction_x:.3f}, y={correction_y:.3f}, rms_error={rms_error:.3f}")
 
-    def find_components(self, image, lock_angle="both", plot=False):
+    def get_footprint_symmetry(self, footprint):
+        """ rotation in degree which maps a footprint onto itself (180 for R/C), 360 if unknown"""
+        if self._symmetries is None:
+            self._symmetries = load_footprint_symmetries()
+        return self._symmetries.get(str(footprint).upper(), 360)
+
+    def equivalent_angle(self, angle, symmetry=360):
+        """
+        the nozzle angle which turns the part like angle (under its symmetry)
+        with the least rotation from the current nozzle angle, within [-180, 180]
+        unless angle itself is outside. updates the rotation metrics.
+        """
+        steps = int(360 // symmetry)
+        candidates = [angle + k * symmetry for k in range(-steps, steps + 1)]
+        candidates = [a for a in candidates if -180 <= a <= 180 or a == angle]
+        #angle itself wins a tie
+        best = min(candidates, key=lambda a: (abs(a - self.e), a != angle))
+        self.rotation["rotated"] += abs(best - self.e)
+        if best != angle:
+            self.rotation["saved"] += abs(angle - self.e) - abs(best - self.e)
+            self.rotation["skipped"] += 1
+        return best
+
+    def get_footprint_size(self, footprint):
+        """ (length, width) in mm of a footprint name from footprints.json or None if unknown"""
+        if self._footprints is None:
+            self._footprints = load_footprints()
+        size = self._footprints.get(str(footprint).upper())
+        if size is None and footprint not in self._unknown_footprints:
+            self._unknown_footprints.add(footprint)
+            logging.warning(f"footprint '{footprint}' unknown, part size is not checked")
+        return size
+
+    def find_components(self, image, lock_angle="both", plot=False, res=None, footprint=None):
+        """
+        detect the parts in an image of the eye (or a mosaic with resolution res)
+        footprint : name in footprints.json or (x, y) in mm of the expected part.
+                    Blobs of another size are rejected, the best match comes first.
+        returns positions (pixel), angles (degrees), areas (pixel) and footprint
+        match scores (0..1, None without footprint)
+        """
 
         from skimage.measure import label, regionprops
         import math
 
-        blur = cv2.GaussianBlur(image, (11, 11), 0)
+        blur = cv2.GaussianBlur(image, (self.blur, self.blur), 0)
         threshold, binary = cv2.threshold(blur,0,255,cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)
 
-        disk = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+        disk = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (self.open_kernel, self.open_kernel))
         binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, disk)
 
         # Floodfill filter
@@ -198,11 +358,30 @@ class Picker():
         positions = []
         angles = []
         areas = []
+        scores = []
+
+        if res is None:
+            res = self.eye.res
+
+        size = footprint
+        if isinstance(footprint, str):
+            size = self.get_footprint_size(footprint)
+        min_area = self.min_area_mm2
+        if size is not None:
+            #small parts would not pass the general minimum
+            min_area = min(min_area, 0.5 * size[0] * size[1])
 
         for props in regions:
 
-            if props.area < self.min_area_mm2 * (self.eye.res ** 2):
+            if props.area < min_area * (res ** 2):
                 continue
+
+            score = None
+            if size is not None:
+                score = footprint_score(props, res, size)
+                if score is None:
+                    continue
+            scores.append(score)
             areas.append(props.area)
 
             y0, x0 = props.centroid
@@ -244,39 +423,17 @@ class Picker():
         if plot:
             plt.show()
 
+        if size is not None:
+            order = sorted(range(len(scores)), key=lambda i: -scores[i])
+            positions = [positions[i] for i in order]
+            angles = [angles[i] for i in order]
+            areas = [areas[i] for i in order]
+            scores = [scores[i] for i in order]
+
         positions = np.array(positions)
         angles = np.array(angles)
 
-        return positions, angles, areas
-
-    def make_collage(self, robot, camera):
-        # TODO move this somewhere else
-
-        x0, y0 = 103, 125
-
-        mm_step = self.ip.homography.size_mm[0]
-        pix_step = self.ip.homography.size_pix[0]
-
-        s = int(10 * pix_step)
-
-        res = np.empty((s, s), np.uint8)
-
-        for x in range(10):
-            r = range(10)
-
-            if x % 2:
-                r = reversed(r)
-
-            for y in r:
-                robot.drive(x0+x*mm_step, y0+y*mm_step)
-                robot.done()
-                time.sleep(0.5)
-
-                image = camera.cache["image"]
-                image = self.ip.project(image)
-                res[y*pix_step:(y+1)*pix_step, x*pix_step:(x+1)*pix_step] = image
-
-        cv2.imwrite(f"collage.jpg", res)
+        return positions, angles, areas, scores
 
     def _plot_search_positions(self, search_positions, feeder):
         import matplotlib.pyplot as plt
@@ -293,6 +450,51 @@ class Picker():
         plt.savefig("plot.png")
         plt.close()
 
+def load_footprints(path=FOOTPRINT_FILE):
+    """ returns {NAME: (length, width)} in mm for every footprint and its alternative names"""
+    with open(path, "r") as f:
+        footprints = json.load(f)
+
+    sizes = {}
+    for name, footprint in footprints.items():
+        if "x" not in footprint or "y" not in footprint:
+            continue
+        size = (float(footprint["x"]), float(footprint["y"]))
+        for n in [name] + footprint.get("alt", []):
+            sizes[n.upper()] = size
+    return sizes
+
+def load_footprint_symmetries(path=FOOTPRINT_FILE):
+    """ returns {NAME: degree} of the footprints with a rotation_symmetry and their alternative names"""
+    with open(path, "r") as f:
+        footprints = json.load(f)
+
+    symmetries = {}
+    for name, footprint in footprints.items():
+        if "rotation_symmetry" not in footprint:
+            continue
+        for n in [name] + footprint.get("alt", []):
+            symmetries[n.upper()] = float(footprint["rotation_symmetry"])
+    return symmetries
+
+def footprint_score(props, res, size):
+    """
+    how well a region matches the footprint size (x, y) in mm.
+    returns 1 for a perfect match down to 0 at FOOTPRINT_TOLERANCE, None if it does not match
+    """
+    #a filled rectangle of length l has a major axis (4 standard deviations) of l * 4/sqrt(12)
+    length = props.major_axis_length * math.sqrt(12) / 4 / res
+    width = props.minor_axis_length * math.sqrt(12) / 4 / res
+    expected_length, expected_width = max(size), min(size)
+
+    error = max(
+        abs(length - expected_length) / expected_length,
+        abs(width - expected_width) / expected_width,
+    )
+    if error > FOOTPRINT_TOLERANCE:
+        return None
+    return 1 - error / FOOTPRINT_TOLERANCE
+
 def taubin(p):
     """
     Circle fit by Taubin
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class PlacementTable:
+    """
+    Robot coordinates and angles of every designator on the PCB.
+
+    All designators are transformed in one vectorised operation and only
+    again when the fiducial transform or the BOM changes, so the run loop
+    only does a dictionary lookup.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.index = {}
+        self.xy = np.zeros((0, 2))
+        self.angles = np.zeros((0,))
+
+        self._transform = None
+        self._bom = None
+        self._version = None
+
+    def refresh(self, bom, transform, version=None):
+        """ recompute if the BOM (object or version) or the transform changed. returns True if recomputed"""
+        if bom is self._bom and list(transform) == self._transform and version == self._version:
+            return False
+
+        names, pcb, rot = [], [], []
+        for part in bom:
+            for name, partdes in part["designators"].items():
+                if "x" not in partdes:
+                    continue
+                names.append(name)
+                pcb.append((float(partdes["x"]), float(partdes["y"])))
+                rot.append(float(partdes.get("rot", 0)) + float(part.get("rot", 0)))
+
+        self.names = names
+        #the first of duplicate designators wins, like in the designator index
+        self.index = {}
+        for i, name in enumerate(names):
+            self.index.setdefault(name, i)
+        self.xy, self.angles = pcb2robot(transform, np.array(pcb).reshape((-1, 2)), np.array(rot))
+
+        self._transform = list(transform)
+        self._bom = bom
+        self._version = version
+        return True
+
+    def get(self, name):
+        """ (x, y, angle) in robot coordinates and degree"""
+        i = self.index[name]
+        return float(self.xy[i, 0]), float(self.xy[i, 1]), float(self.angles[i])
+
+    def out_of_bounds(self, x_bounds, y_bounds, offset=(0, 0)):
+        """ designators whose position (plus offset, e.g. the nozzle offset) is outside the bounds"""
+        x = self.xy[:, 0] + offset[0]
+        y = self.xy[:, 1] + offset[1]
+        outside = (x < x_bounds[0]) | (x > x_bounds[1]) | (y < y_bounds[0]) | (y > y_bounds[1])
+        return [self.names[i] for i in np.flatnonzero(outside)]
+
+
+def pcb2robot(transform, xy, angles):
+    """
+    transform points array[n, 2] and angles array[n] (degree) from PCB to robot coordinates
+    transform is the affine transform as used by the cairo context [xx, yx, xy, yy, x0, y0]
+    """
+    m = np.array(transform, dtype=np.float64).reshape((3, 2)).T
+    xy = xy @ m[:, :2].T + m[:, 2]
+
+    #the angle follows a unit vector through the linear part (handles mirroring)
+    a = np.radians(angles)
+    direction = np.stack((np.cos(a), np.sin(a)), axis=-1) @ m[:, :2].T
+    angles = np.degrees(np.arctan2(direction[:, 1], direction[:, 0]))
+    return xy, angles
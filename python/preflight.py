@@ -0,0 +1,108 @@
+import math
+
+import numpy as np
+
+import data_manager
+import tray
+import belt
+import roll
+
+#designators listed per problem in the alert, the rest is counted
+PREFLIGHT_MAX_NAMES = 10
+
+
+def check(context, jobs, placements, x_bounds, y_bounds, offset=(0, 0)):
+    """
+    Check a job before the machine moves.
+
+    jobs : list of (designator, part, partdes) to place
+    placements : PlacementTable with the current transform
+    offset : nozzle offset (picker DX/DY) added to every pick and place
+    returns (problems, warnings), the job can run if there are no problems.
+    Parts without a feeder are left for hand placement, they are only a warning.
+    """
+    problems = []
+    warnings = []
+
+    def outside(x, y, offset=offset):
+        x, y = x + offset[0], y + offset[1]
+        return x < x_bounds[0] or x > x_bounds[1] or y < y_bounds[0] or y > y_bounds[1]
+
+    #placements, the nozzle is driven there
+    unreachable = [name for name, part, _partdes in jobs if part.get("feeder") and outside(*placements.get(name)[:2])]
+    if unreachable:
+        problems.append(_names(f"{len(unreachable)} placements outside of the bounds", unreachable))
+
+    #feeders
+    by_feeder = {}
+    for name, part, _partdes in jobs:
+        by_feeder.setdefault(part.get("feeder"), []).append(name)
+
+    for feeder_name, names in by_feeder.items():
+        if not feeder_name:
+            warnings.append(_names(f"{len(names)} parts without feeder are not placed", names))
+            continue
+        feeder = context["feeder"].get(feeder_name)
+        if feeder is None:
+            problems.append(_names(f"feeder '{feeder_name}' does not exist", names))
+            continue
+
+        state = feeder.get("state", data_manager.FEEDER_STATE_READY)
+        if state == data_manager.FEEDER_STATE_DIABLED:
+            problems.append(_names(f"feeder '{feeder_name}' is disabled", names))
+        elif state == data_manager.FEEDER_STATE_EMPTY:
+            problems.append(_names(f"feeder '{feeder_name}' is empty", names))
+
+        try:
+            camera, picks = feeder_positions(feeder, len(names))
+        except KeyError as e:
+            problems.append(_names(f"feeder '{feeder_name}' is not set up (missing {e})", names))
+            continue
+        if feeder["type"] == belt.TYPE_NUMBER:
+            left = feeder["capacity"] - feeder.get("pos", 0)
+            if len(names) > left:
+                problems.append(f"feeder '{feeder_name}' has {left} parts left, {len(names)} are needed")
+        if any(outside(x, y, (0, 0)) for x, y in camera):
+            problems.append(f"feeder '{feeder_name}' is outside of the bounds")
+        elif any(outside(x, y) for x, y in picks):
+            problems.append(f"feeder '{feeder_name}' is picked outside of the bounds")
+
+    return problems, warnings
+
+
+def feeder_positions(feeder, count):
+    """
+    machine positions a feeder is looked at and picked from (without the nozzle offset)
+    for the next count parts. returns (camera, picks), raises KeyError if a setting is missing
+    """
+    if feeder["type"] == tray.TYPE_NUMBER:
+        #parts can be anywhere in the tray
+        x, y, w, h = feeder["position"]
+        corners = [(x, y), (x + w, y), (x, y + h), (x + w, y + h)]
+        return corners, corners
+
+    if feeder["type"] == belt.TYPE_NUMBER:
+        #same geometry as Belt.pick, the offset turns with the belt direction
+        dx, dy = np.array(feeder["end"]) - np.array(feeder["start"])
+        angle = math.atan2(dy, dx)
+        ox, oy = feeder["offset"]
+        ox, oy = math.cos(angle) * ox + math.sin(angle) * oy, -math.sin(angle) * ox + math.cos(angle) * oy
+        pos = feeder.get("pos", 0)
+        holes = [belt.nominal_hole(feeder, i) for i in (pos, min(pos + count, feeder["capacity"]))]
+        return holes, [(x + ox, y + oy) for x, y in holes]
+
+    if feeder["type"] == roll.TYPE_NUMBER:
+        if "channel" not in feeder:
+            raise KeyError("channel")
+        x, y = feeder["pickpos"]
+        ox, oy = feeder["offset"]
+        return [(x, y)], [(x + ox, y + oy)]
+
+    raise KeyError("type")
+
+
+def _names(message, names):
+    listed = ", ".join(names[:PREFLIGHT_MAX_NAMES])
+    if len(names) > PREFLIGHT_MAX_NAMES:
+        listed += f" and {len(names) - PREFLIGHT_MAX_NAMES} more"
+    return f"{message}: {listed}"
@@ -1,20 +1,27 @@
-import time
+import clock
 import hole_finder
+import motion
 import numpy as np
 import config_old
 
 
 TYPE_NUMBER = 2
 
+#seconds the backing tape needs to settle after an advance
+ADVANCE_SETTLE_TIME = 1.0
+#seconds of the lift after a pick, from the deepest pick depth
+LIFT_TIME = motion.move_time(-min(config_old.PICK_Z_TRAY, config_old.PICK_Z_BELT, config_old.PICK_Z_ROLL),
+                             motion.DEFAULT_SPEED["z"], motion.DEFAULT_ACCEL["z"])
+
 # Roll Feeder
 # SMD belt is unrolled from a roll and a motor pulls away the backing
 # tape and exposes one part. pnp head can then pick it up on always the
 # same location.
 class Roll:
 
-    def __init__(self, eye, picker):
+    def __init__(self, eye, picker, config=None):
         self.picker = picker
-        self.hole_finder = hole_finder.HoleFinder(eye)
+        self.hole_finder = hole_finder.HoleFinder(eye, config)
 
     def set_pickpos(self, state, hole_pos):
         x, y = hole_pos
@@ -23,31 +30,54 @@ class Roll:
     def set_channel(self, state, channel):
         state["channel"] = channel
 
-    def pick(self, state, robot, only_camera=False):
+    def pick(self, state, robot, only_camera=False, symmetry=360):
+        """ symmetry : rotation in degree which maps the part onto itself"""
         #setup correct light
         robot.light_topdn(True)
         robot.light_tray(False)
 
-        done_time = time.time() + 1.0
-        self.advance(state, robot)
+        advanced_at = state.pop("advanced_at", None)
+        if state.pop("advanced", False):
+            #advanced ahead by prepare(), only the rest of the settle time is left.
+            #without a time (e.g. saved by an older version) it has settled long ago
+            done_time = (advanced_at if advanced_at is not None else -ADVANCE_SETTLE_TIME) + ADVANCE_SETTLE_TIME
+        else:
+            done_time = clock.time() + ADVANCE_SETTLE_TIME
+            self.advance(state, robot)
 
         #drive to the hole and correct its position
         robot.drive(state["pickpos"][0], state["pickpos"][1])
-        t = done_time - time.time()
+        t = done_time - clock.time()
         if t > 0:
             print("sleeping %fs" % t) #need to wait for something else before pick
-            time.sleep(t)
-        x, y = self.hole_finder.find_hole()
+            clock.sleep(t, "feeder")
+        x, y = self.hole_finder.find_hole(engine=state.get("engine"))
 
         x = x + state["offset"][0]
         y = y + state["offset"][1]
 
         if only_camera == False:
             #normal case
-            self.picker.pick(robot, x, y, state["rot"], config_old.PICK_Z_ROLL)
+            self.picker.pick(robot, x, y, state["rot"], config_old.PICK_Z_ROLL, symmetry=symmetry)
         else:
             robot.drive(x, y)
 
+    def prepare(self, state, robot):
+        """
+        advance the next part ahead of pick(), right after the current pick.
+        the flag and the time of the pulse are kept in the feeder state, so the
+        next pick does not advance again even if the run was interrupted in between.
+        The time is estimated with LIFT_TIME, without a lift pending the next pick
+        only waits a little longer.
+        """
+        if state.get("advanced", False):
+            return
+        #the controller takes the pulse when the lift of the pick has arrived,
+        #the host does not wait for it. The settle time starts after the lift.
+        self.advance(state, robot)
+        state["advanced_at"] = clock.time() + LIFT_TIME
+        state["advanced"] = True
+
     def advance(self, state, robot):
         robot.feeder_advance(state["channel"])
         if "pos" in state:
@@ -57,6 +87,9 @@ class Roll:
 
     def retract(self, state, robot):
         robot.feeder_advance(state["channel"], direction_forward=False)
+        #a part advanced by prepare() is pulled back
+        state.pop("advanced", None)
+        state.pop("advanced_at", None)
         if "pos" in state:
             state["pos"] -= 1
         else:
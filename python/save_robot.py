@@ -1,3 +1,4 @@
+import clock
 import pick_plaz_robot
 
 
@@ -15,6 +16,10 @@ class SaveRobot(pick_plaz_robot.Robot):
         self.y_bounds = (0, 350)
 
         self.pos_logger = pos_logger
+        #clock time the vacuum line started to purge (pump on, valve released), None otherwise
+        self.purge_since = None
+        self._pump = False
+        self._valve = False
 
     @staticmethod
     def __check_range(x, start_stop):
@@ -44,6 +49,22 @@ class SaveRobot(pick_plaz_robot.Robot):
 
         return super().drive(x=x, y=y, z=z, e=e, b=b, c=c, f=f, r=r)
 
+    def vacuum(self, enable):
+        self._pump = bool(enable)
+        self._update_purge()
+        return super().vacuum(enable)
+
+    def valve(self, enable):
+        self._valve = bool(enable)
+        self._update_purge()
+        return super().valve(enable)
+
+    def _update_purge(self):
+        if not self._pump or self._valve:
+            self.purge_since = None
+        elif self.purge_since is None:
+            self.purge_since = clock.time()
+
 
 def manage_robot(self):
     self.vacuum(False)
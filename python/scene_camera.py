@@ -0,0 +1,303 @@
+"""
+Simulated camera which renders what the real camera would see.
+
+The Scene holds the machine bed in machine coordinates (mm): the PCB with
+its fiducials, the belt tapes with their holes, the roll feeder holes, the
+parts lying in the trays and the ArUco calibration board. The SceneCamera
+renders it at the current robot position through the inverse of the camera
+calibration (lens distortion included), so the real detectors, the Eye
+projection and even the camera calibration work on its images.
+"""
+
+import pickle
+
+import numpy as np
+import cv2
+
+import belt
+import clock
+import markerboard
+import pick
+import placement
+import roll
+import tray
+
+#gray values of the scene
+BED_VALUE = 25
+BOARD_VALUE = 40
+COPPER_VALUE = 220
+TAPE_VALUE = 200
+HOLE_VALUE = 20
+TRAY_VALUE = 230
+PART_VALUE = 20
+PAPER_VALUE = 230
+MARKER_VALUE = 20
+
+#mm
+FIDUCIAL_RADIUS = 1.0
+HOLE_RADIUS = 1.5 / 2
+BOARD_MARGIN = 3.0
+#the tape reaches this far to both sides of the hole line, the parts are on the positive side
+TAPE_WIDTH = (-2.0, 6.25)
+#parts put into a tray in addition to the ones the BOM needs
+TRAY_SPARE_PARTS = 5
+TRAY_PART_GAP = 2.0
+#(length, width) in mm of parts with an unknown footprint
+DEFAULT_PART_SIZE = (1.6, 0.8)
+#a picked part must be within this distance (mm) of the nozzle
+PICK_TOLERANCE = 1.0
+
+#pixel per mm of the scene rendering, about twice the camera resolution
+RENDER_RES = 50
+#fixed point bits for subpixel drawing
+SHIFT = 4
+
+
+def load_calibration():
+    """ the camera calibration the machine uses (cal.pkl, else default_cal.pkl)"""
+    try:
+        with open("cal.pkl", "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        with open("default_cal.pkl", "rb") as f:
+            return pickle.load(f)
+
+
+def _rectangle(x, y, length, width, angle):
+    """ corners of a rectangle centered at x, y turned by angle (degree)"""
+    a = np.radians(angle)
+    r = np.array(((np.cos(a), -np.sin(a)), (np.sin(a), np.cos(a))))
+    corners = np.array(((-1, -1), (1, -1), (1, 1), (-1, 1))) * (length / 2, width / 2)
+    return corners @ r.T + (x, y)
+
+
+class Scene:
+    """
+    Everything the camera can see, in machine coordinates.
+
+    The shapes are drawn in the order they were added. Tray parts are kept
+    separately as [x, y, angle, length, width] because they are picked up.
+    """
+
+    def __init__(self, context, cal, seed=0):
+        self.shapes = [] # (kind, geometry, value)
+        self.bboxes = np.zeros((0, 4))
+        self.parts = {} # tray name -> list of parts
+        self.version = 0
+        #(DX, DY) between the nozzle and the camera, set to the picker calibration
+        self.nozzle_offset = (0.0, 0.0)
+        self.pick_errors = []
+
+        self.rng = np.random.default_rng(seed)
+        self._footprints = pick.load_footprints()
+
+        self.add_markerboard(cal)
+        for name, feeder in context["feeder"].items():
+            if feeder.get("type") == belt.TYPE_NUMBER and "start" in feeder and "capacity" in feeder:
+                self.add_belt(feeder)
+            elif feeder.get("type") == roll.TYPE_NUMBER and "pickpos" in feeder:
+                self.add_roll(feeder)
+            elif feeder.get("type") == tray.TYPE_NUMBER and "position" in feeder:
+                self.add_tray(name, feeder, context.get("bom", []))
+
+    def _add(self, kind, geometry, value):
+        if kind == "circle":
+            x, y, r = geometry
+            bbox = (x - r, y - r, x + r, y + r)
+        else:
+            geometry = np.asarray(geometry, dtype=np.float64)
+            bbox = (*geometry.min(axis=0), *geometry.max(axis=0))
+        self.shapes.append((kind, geometry, value))
+        self.bboxes = np.vstack((self.bboxes, bbox))
+        self.version += 1
+
+    def add_markerboard(self, cal):
+        """ the ArUco board where the calibration has seen it"""
+        warp = cal.warp_mat
+        to_machine = lambda points: np.asarray(points) @ warp[:2, :2].T + warp[:2, 2]
+
+        size = markerboard.marker_size
+        x0, y0 = markerboard.positions.min(axis=0) - 1
+        x1, y1 = markerboard.positions.max(axis=0) + size + 1
+        self._add("poly", to_machine(((x0, y0), (x1, y0), (x1, y1), (x0, y1))), PAPER_VALUE)
+
+        aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_100)
+        cell = size / 6
+        for marker_id, (mx, my) in zip(markerboard.ids, markerboard.positions):
+            bits = cv2.aruco.generateImageMarker(aruco_dict, int(marker_id), 6)
+            for cy, cx in zip(*np.nonzero(bits == 0)):
+                x, y = mx + cx * cell, my + cy * cell
+                self._add("poly", to_machine(((x, y), (x + cell, y), (x + cell, y + cell), (x, y + cell))), MARKER_VALUE)
+
+    def add_pcb(self, bom, transform):
+        """ the board outline and the fiducials of the BOM placed by transform (PCB to machine)"""
+        fiducials, designators = [], []
+        for part in bom:
+            for partdes in part["designators"].values():
+                if "x" not in partdes:
+                    continue
+                designators.append((float(partdes["x"]), float(partdes["y"])))
+                if part.get("fiducial"):
+                    fiducials.append(designators[-1])
+        if not designators:
+            return
+
+        (x0, y0), (x1, y1) = np.min(designators, axis=0) - BOARD_MARGIN, np.max(designators, axis=0) + BOARD_MARGIN
+        outline = np.array(((x0, y0), (x1, y0), (x1, y1), (x0, y1)))
+        outline, _ = placement.pcb2robot(transform, outline, np.zeros(4))
+        self._add("poly", outline, BOARD_VALUE)
+
+        if fiducials:
+            fiducials, _ = placement.pcb2robot(transform, np.array(fiducials), np.zeros(len(fiducials)))
+            for x, y in fiducials:
+                self._add("circle", (x, y, FIDUCIAL_RADIUS), COPPER_VALUE)
+
+    def add_belt(self, feeder):
+        """ the tape from start to end with all its holes"""
+        start, end = np.array(feeder["start"]), np.array(feeder["end"])
+        direction = (end - start) / np.linalg.norm(end - start)
+        normal = np.array((-direction[1], direction[0]))
+        #the parts (pick offset) are on the positive side of the tape
+        offset = feeder.get("offset", (0, 1))
+        side = 1 if offset[1] >= 0 else -1
+        first = start - direction * feeder["pitch"]
+        last = end + direction * feeder["pitch"]
+        a, b = (side * w for w in TAPE_WIDTH)
+        self._add("poly", (first + normal * a, last + normal * a, last + normal * b, first + normal * b), TAPE_VALUE)
+        for i in range(feeder["capacity"] + 1):
+            x, y = belt.nominal_hole(feeder, i)
+            self._add("circle", (x, y, HOLE_RADIUS), HOLE_VALUE)
+
+    def add_roll(self, feeder):
+        """ the tape around the single hole at the pick position"""
+        x, y = feeder["pickpos"]
+        self._add("poly", _rectangle(x, y + 2, 6, 8, 0), TAPE_VALUE)
+        self._add("circle", (x, y, HOLE_RADIUS), HOLE_VALUE)
+
+    def add_tray(self, name, feeder, bom):
+        """ the backlit tray with the parts of the BOM (and some spares) lying on a loose grid"""
+        x, y, w, h = feeder["position"]
+        self._add("poly", ((x, y), (x + w, y), (x + w, y + h), (x, y + h)), TRAY_VALUE)
+
+        count, size = TRAY_SPARE_PARTS, DEFAULT_PART_SIZE
+        for part in bom:
+            if part.get("feeder") == name:
+                count += len(part["designators"])
+                size = self._footprints.get(str(part.get("footprint")).upper(), size)
+
+        spacing = max(size) + TRAY_PART_GAP
+        columns, rows = int((w - TRAY_PART_GAP) // spacing), int((h - TRAY_PART_GAP) // spacing)
+        cells = [(c, r) for r in range(rows) for c in range(columns)][:count]
+        jitter = (spacing - max(size)) / 4
+        self.parts[name] = [[
+            float(x + TRAY_PART_GAP / 2 + (c + 0.5) * spacing + self.rng.uniform(-jitter, jitter)),
+            float(y + TRAY_PART_GAP / 2 + (r + 0.5) * spacing + self.rng.uniform(-jitter, jitter)),
+            float(self.rng.uniform(-20, 20)), size[0], size[1]] for c, r in cells]
+        self.version += 1
+
+    def pick_up(self, x, y):
+        """
+        the nozzle (machine position x, y) picks up the closest tray part
+        returns the distance of the part to the nozzle axis or None if no part was there
+        """
+        x, y = x - self.nozzle_offset[0], y - self.nozzle_offset[1]
+        best = None
+        for parts in self.parts.values():
+            for i, p in enumerate(parts):
+                d = np.hypot(p[0] - x, p[1] - y)
+                if d <= PICK_TOLERANCE and (best is None or d < best[0]):
+                    best = (d, parts, i)
+        if best is None:
+            return None
+        d, parts, i = best
+        del parts[i]
+        self.pick_errors.append(float(d))
+        self.version += 1
+        return float(d)
+
+    def render(self, x0, y0, w, h, res=RENDER_RES):
+        """ top down image of the area (x0, y0, w, h) in machine coordinates"""
+        image = np.full((int(np.ceil(h * res)), int(np.ceil(w * res))), BED_VALUE, dtype=np.uint8)
+        scale = res * (1 << SHIFT)
+        to_pix = lambda points: np.round((np.asarray(points) - (x0, y0)) * scale).astype(np.int32)
+
+        b = self.bboxes
+        visible = np.flatnonzero((b[:, 2] >= x0) & (b[:, 0] <= x0 + w) & (b[:, 3] >= y0) & (b[:, 1] <= y0 + h))
+        for i in visible:
+            kind, geometry, value = self.shapes[i]
+            if kind == "circle":
+                x, y, r = geometry
+                cv2.circle(image, tuple(int(v) for v in to_pix((x, y))), int(round(r * scale)), value, -1, cv2.LINE_AA, SHIFT)
+            else:
+                cv2.fillPoly(image, [to_pix(geometry)], value, cv2.LINE_AA, SHIFT)
+
+        for parts in self.parts.values():
+            for x, y, angle, length, width in parts:
+                if x0 - length < x < x0 + w + length and y0 - length < y < y0 + h + length:
+                    cv2.fillPoly(image, [to_pix(_rectangle(x, y, length, width, angle))], PART_VALUE, cv2.LINE_AA, SHIFT)
+        return image
+
+
+class SceneCamera:
+    """
+    Drop-in for CameraThread which renders the scene at the robot position
+    (robot.pos_logger) instead of reading a camera. An image is only rendered
+    when it is read and the position or the scene changed.
+    """
+
+    def __init__(self, robot, scene, cal, shape=(480, 640), noise=2.0, seed=0):
+        self.robot = robot
+        self.scene = scene
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        #machine offset (mm) to the robot position seen by every camera pixel,
+        #the inverse of the projection done by calibrator.ImageProjector
+        h, w = shape
+        u, v = np.meshgrid(np.arange(w, dtype=np.float64), np.arange(h, dtype=np.float64))
+        pixels = np.stack((u, v), axis=-1).reshape((-1, 1, 2))
+        criteria = (cv2.TERM_CRITERIA_COUNT | cv2.TERM_CRITERIA_EPS, 100, 1e-10)
+        normalized = cv2.undistortPoints(pixels, cal.intrinsic, cal.dist_coeffs, None, np.eye(3), criteria=criteria).reshape((-1, 2))
+        t_mat = np.eye(3)
+        t_mat[:2, 2] = -cal.bot_pos
+        m = t_mat @ cal.warp_mat @ np.linalg.inv(cal.extrinsic[:3, [0, 1, 3]])
+        q = m @ np.concatenate((normalized, np.ones((len(normalized), 1))), axis=1).T
+        offsets = (q[:2] / q[2]).T.reshape((h, w, 2))
+
+        #the rendered area around the robot position and the remap into it
+        self.view_min = offsets.reshape((-1, 2)).min(axis=0) - 1
+        self.view_size = offsets.reshape((-1, 2)).max(axis=0) + 1 - self.view_min
+        self.map_x = ((offsets[..., 0] - self.view_min[0]) * RENDER_RES).astype(np.float32)
+        self.map_y = ((offsets[..., 1] - self.view_min[1]) * RENDER_RES).astype(np.float32)
+
+        self._key = None
+        self._cache = {}
+
+    @property
+    def cache(self):
+        pos = self.robot.pos_logger
+        if pos is None:
+            return {}
+        key = (pos["x"], pos["y"], self.scene.version)
+        if key != self._key:
+            self._key = key
+            self._cache = {
+                "image": self.render(pos["x"], pos["y"]),
+                "timestamp": clock.time(),
+            }
+        return self._cache
+
+    def render(self, x, y):
+        """ camera image with the camera at machine position x, y"""
+        (x0, y0), (w, h) = self.view_min + (x, y), self.view_size
+        top_down = self.scene.render(x0, y0, w, h)
+        image = cv2.remap(top_down, self.map_x, self.map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=BED_VALUE)
+        if self.noise:
+            image = np.clip(image + self.rng.normal(0, self.noise, image.shape), 0, 255).astype(np.uint8)
+        return image
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        pass
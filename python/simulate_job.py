@@ -0,0 +1,412 @@
+"""
+Dry run of a job to predict its cycle time.
+
+Runs the real StateContext.run_state on a robot stand-in which charges the
+move durations of a trapezoidal motion model (like the queue of the
+controller) and on detector stand-ins which find the ideal result after a
+configurable latency. Nothing sleeps, the time is taken on a virtual clock
+(see clock.py) and broken down per phase:
+
+    travel    xy moves (with the rotation on the way)
+    rotate    rotation only moves
+    pick_z    nozzle down and up at pick and place
+    home      homing (z is re-homed every few placements)
+    settle    waiting for the image to settle
+    vision    detection latency
+    vacuum    waiting for the vacuum line to purge
+    feeder    feeder advances
+
+usage: python simulate_job.py [--context user/context/context.json] [--config config.toml]
+                              [--latency 0.05] [--latency hole=0.02] [--render] [--json sim.json]
+                              [--force]
+
+Like "play", a job with preflight problems is not run (exit code 1), --force
+runs it anyway.
+"""
+
+import argparse
+import contextlib
+import json
+import queue
+import sys
+
+import numpy as np
+import toml
+
+import belt
+import camera
+import clock
+import data_manager
+import debug
+import roll
+import save_robot
+import scene_camera
+import state
+from hole_finder import NoBeltHoleFoundException
+from motion import DEFAULT_SPEED, DEFAULT_ACCEL, move_time
+
+#seconds the controller is busy with one feeder pulse (M205), the pulse runs in the background
+FEEDER_ADVANCE_TIME = 0.0
+#seconds of a full homing (G28)
+HOME_TIME = 4.0
+#seconds of the homing switch approach after driving to z=0
+HOME_Z_TIME = 0.5
+
+#seconds per detection
+DEFAULT_LATENCY = {"hole": 0.02, "holes": 0.03, "components": 0.05, "bottom_up": 0.03}
+#(length, width) in mm of tray parts without a known footprint
+DEFAULT_PART_SIZE = (1.6, 0.8)
+
+PHASES = ["travel", "rotate", "pick_z", "home", "settle", "vision", "vacuum", "feeder"]
+
+
+class SimRobot(save_robot.SaveRobot):
+    """
+    SaveRobot with a simulated controller.
+
+    Commands are queued like on the controller: each one starts when the
+    previous one has finished, done() waits on the virtual clock until the
+    queue is empty and books the waited time to the phases of the commands.
+    The speeds follow the M201/M203 settings and the feedrate multipliers.
+    """
+
+    def __init__(self, sim_clock, speed=None, accel=None, pos_logger=None):
+        super().__init__(None, pos_logger)
+        #the mock constructor replaced these with dummies
+        del self.done
+        del self.flush
+
+        self.clock = sim_clock
+        self.default_speed = dict(DEFAULT_SPEED, **(speed or {}))
+        self.default_accel = dict(DEFAULT_ACCEL, **(accel or {}))
+        self.pos = {"x": 0.0, "y": 0.0, "z": 0.0, "e": 0.0}
+
+        self.busy_until = 0.0
+        self.segments = [] # (start, end, phase) of the queued commands
+        self.commands = 0
+        #scene_camera.Scene whose tray parts are picked up by the nozzle
+        self.scene = None
+
+        self._reset_settings()
+
+    def _reset_settings(self):
+        self.speed = dict(self.default_speed)
+        self.accel = dict(self.default_accel)
+        self.multiplier = {axis: 1.0 for axis in self.speed}
+
+    def _queue(self, duration, phase):
+        start = max(self.clock.time(), self.busy_until)
+        self.busy_until = start + duration
+        self.segments.append((start, self.busy_until, phase))
+        self.commands += 1
+
+    def drive(self, x=None, y=None, z=None, e=None, a=None, b=None, c=None, f=None, r=None):
+        super().drive(x=x, y=y, z=z, e=e, a=a, b=b, c=c, f=f, r=r)
+
+        durations = {}
+        for axis, target in (("x", x), ("y", y), ("z", z), ("e", e)):
+            if target is None:
+                continue
+            speed = (f if f is not None else self.speed[axis]) * self.multiplier[axis]
+            durations[axis] = move_time(abs(target - self.pos[axis]), speed, self.accel[axis])
+            self.pos[axis] = float(target)
+
+        if durations.get("x", 0) > 0 or durations.get("y", 0) > 0:
+            phase = "travel"
+        elif durations.get("z", 0) > 0:
+            phase = "pick_z"
+        else:
+            phase = "rotate"
+        self._queue(max(durations.values(), default=0.0), phase)
+        return self
+
+    def home(self, axis=None):
+        super().home(axis)
+        if axis is None:
+            self.pos.update(x=0.0, y=0.0, z=0.0)
+            self._queue(HOME_TIME, "home")
+        else:
+            for a in axis:
+                if a in self.pos:
+                    self.pos[a] = 0.0
+            self._queue(HOME_Z_TIME, "home")
+        return self
+
+    def feeder_advance(self, channel, direction_forward=True):
+        super().feeder_advance(channel, direction_forward)
+        self._queue(FEEDER_ADVANCE_TIME, "feeder")
+        return self
+
+    def dwell(self, timeout_milliseconds):
+        super().dwell(timeout_milliseconds)
+        #same rounding as the G4T command sent to the controller
+        self._queue(timeout_milliseconds // 1000, "other")
+        return self
+
+    def acceleration(self, **axes):
+        super().acceleration(**axes)
+        self.accel.update({k: v for k, v in axes.items() if k in self.accel and v is not None})
+        return self
+
+    def max_feedrate(self, **axes):
+        super().max_feedrate(**axes)
+        self.speed.update({k: v for k, v in axes.items() if k in self.speed and v is not None})
+        return self
+
+    def feedrate_multiplier(self, **axes):
+        super().feedrate_multiplier(**axes)
+        self.multiplier.update({k: v for k, v in axes.items() if k in self.multiplier and v is not None})
+        return self
+
+    def valve(self, enable):
+        super().valve(enable)
+        if enable and self.scene is not None and self.pos["z"] < 0:
+            self.scene.pick_up(self.pos["x"], self.pos["y"])
+        return self
+
+    def default_settings(self):
+        super().default_settings()
+        self._reset_settings()
+        return self
+
+    def done(self):
+        for start, end, phase in self.segments:
+            now = self.clock.time()
+            if end > now:
+                self.clock.sleep(end - max(start, now), phase)
+        self.segments = []
+        return self
+
+    def flush(self):
+        return self.done()
+
+
+class SimVision:
+    """
+    Detector stand-ins for a perfect scene: the nominal belt holes and roll
+    pick positions of the feeders, a part in the middle of every tray image
+    and a centered part on the nozzle. Each detection books its latency to
+    the "vision" phase.
+
+    With render=True the real detectors run on the images of a SceneCamera
+    and only the latency is added.
+    """
+
+    def __init__(self, sim_clock, context, latency=None, render=False):
+        self.clock = sim_clock
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.render = render
+        self.detections = {kind: 0 for kind in self.latency}
+
+        holes = []
+        for feeder in context["feeder"].values():
+            if feeder.get("type") == belt.TYPE_NUMBER and "start" in feeder and "capacity" in feeder:
+                holes += [belt.nominal_hole(feeder, i) for i in range(feeder["capacity"] + 1)]
+            elif feeder.get("type") == roll.TYPE_NUMBER and "pickpos" in feeder:
+                holes.append(tuple(feeder["pickpos"]))
+        self.holes = np.array(holes, dtype=np.float64).reshape((-1, 2))
+
+    def _replace(self, obj, name, kind, stand_in, rendered=True):
+        """ book the latency of kind on every call of obj.name, which is replaced by stand_in unless rendering"""
+        detect = getattr(obj, name) if self.render and rendered else stand_in
+        def timed(*args, **kwargs):
+            self.detections[kind] += 1
+            self.clock.sleep(self.latency[kind], "vision")
+            return detect(*args, **kwargs)
+        setattr(obj, name, timed)
+
+    def _holes_in_view(self, finder):
+        eye = finder.eye
+        center = np.array(eye.robot_pos)
+        inside = np.all(np.abs(self.holes - center) <= eye.cam_range / 2 - finder.radius, axis=1)
+        holes = self.holes[inside]
+        return holes[np.argsort(np.linalg.norm(holes - center, axis=1))]
+
+    def install(self, context):
+        """ replace the detectors of a StateContext"""
+        for finder in (context.hole_finder, context.belt.hole_finder, context.belt.multi_hole_finder, context.roll.hole_finder):
+            self._install_hole_finder(finder)
+
+        picker = context.picker
+        def find_components(image, lock_angle="both", plot=False, res=None, footprint=None):
+            size = picker.get_footprint_size(footprint) if footprint is not None else None
+            res = res if res is not None else picker.eye.res
+            length, width = size if size is not None else DEFAULT_PART_SIZE
+            h, w = image.shape[:2]
+            return np.array([(w / 2, h / 2)]), np.array([0.0]), [length * width * res ** 2], [1.0 if size is not None else None]
+        self._replace(picker, "find_components", "components", find_components)
+
+        if context.bottom_up is not None:
+            aligner = context.bottom_up
+            aligner.camera.set_image(np.zeros((480, 640), dtype=np.uint8))
+            analyze = lambda image, expected=0.0, fold=180.0: (0.0, 0.0, 0.0, DEFAULT_PART_SIZE[0] * DEFAULT_PART_SIZE[1])
+            #the bottom camera is not rendered, the part is always centered
+            self._replace(aligner, "analyze", "bottom_up", analyze, rendered=False)
+
+    def _install_hole_finder(self, finder):
+        def find_holes(engine=None):
+            finder.eye.get_valid_image()
+            holes = self._holes_in_view(finder)
+            if not len(holes):
+                raise NoBeltHoleFoundException("No belt found")
+            finder.detected_pos = tuple(holes[0])
+            return holes
+
+        def find_hole(engine=None):
+            finder.eye.get_valid_image()
+            holes = self._holes_in_view(finder)
+            if not len(holes):
+                raise NoBeltHoleFoundException("No belt found")
+            finder.detected_pos = (float(holes[0][0]), float(holes[0][1]))
+            return finder.detected_pos
+
+        self._replace(finder, "find_hole", "hole", find_hole)
+        self._replace(finder, "find_holes", "holes", find_holes)
+
+
+def simulate_job(context_manager, config, latency=None, speed=None, accel=None, render=False, monitor=None,
+                 force=False):
+    """
+    Place all ready parts of the context like "play" would, on a virtual clock.
+    The context is modified (part states, feeder positions) but not saved.
+
+    render : run the real detectors on a SceneCamera (see scene_camera.py)
+             instead of the ideal stand-ins
+    monitor : context manager entered around the run of the job only
+              (e.g. cph_bench.ThreadCpu)
+    force : run the job even if the preflight found problems, otherwise
+            nothing is placed and the problems are in the report
+    returns a JSON safe report
+    """
+    sim_clock = clock.VirtualClock()
+    previous = clock.use(sim_clock)
+    debug.record_dir = None
+    try:
+        robot = SimRobot(sim_clock, speed, accel)
+        if render:
+            cal = scene_camera.load_calibration()
+            scene = scene_camera.Scene(context_manager.get(), cal)
+            camera_mock = scene_camera.SceneCamera(robot, scene, cal)
+        else:
+            camera_mock = camera.CameraStillMock(np.zeros((480, 640), dtype=np.uint8))
+        context = state.StateContext(robot, camera_mock, context_manager.get(), context_manager, queue.Queue(), None, config)
+        if render:
+            scene.add_pcb(context_manager.get()["bom"], context.nav["pcb"]["transform"])
+            scene.nozzle_offset = (context.picker.DX, context.picker.DY)
+            robot.scene = scene
+        vision = SimVision(sim_clock, context_manager.get(), latency, render)
+        vision.install(context)
+        robot.pos.update(x=float(context.nav["camera"]["x"]), y=float(context.nav["camera"]["y"]))
+
+        context._reset_error_parts()
+        preflight_ok = context._preflight()
+        context._plan_job()
+        jobs = context_manager.job_queue.items()
+
+        start = sim_clock.time()
+        placement_times = []
+        with monitor if monitor is not None else contextlib.nullcontext():
+            #like "play", a job with preflight problems does not start
+            step = context.run_state if preflight_ok or force else None
+            while step == context.run_state:
+                t, remaining = sim_clock.time(), len(context_manager.job_queue)
+                step = step()
+                if len(context_manager.job_queue) < remaining:
+                    placement_times.append(sim_clock.time() - t)
+        total = sim_clock.time() - start
+    finally:
+        clock.use(previous)
+
+    placed = sum(1 for _name, _part, partdes in jobs if partdes["state"] == data_manager.PART_STATE_PLACED)
+    phases = {phase: round(sim_clock.phases.get(phase, 0.0), 3) for phase in PHASES}
+    phases.update({k: round(v, 3) for k, v in sim_clock.phases.items() if k not in phases})
+    report = {
+        "placements": len(jobs),
+        "placed": placed,
+        "failed": len(jobs) - placed,
+        "total_s": round(total, 3),
+        "per_placement_s": round(total / placed, 3) if placed else None,
+        "phases": phases,
+        "placement_times_s": [round(t, 3) for t in placement_times],
+        "detections": vision.detections,
+        "robot_commands": robot.commands,
+        "z_homes": context.picker.z_homing.homes,
+        "rotation": {k: round(v, 1) for k, v in context.picker.rotation.items()},
+        "planned_travel_mm": context.job_planner.report(0)["planned_travel"],
+        "preflight": context.nav.get("preflight", []) if not preflight_ok else [],
+        "alert": context.nav.get("alert", {}).get("msg"),
+    }
+    if render:
+        #distance of the picked tray parts to the nozzle axis
+        errors = scene.pick_errors
+        report["tray_pick_error_mm"] = {
+            "count": len(errors),
+            "mean": round(float(np.mean(errors)), 4) if errors else None,
+            "max": round(float(np.max(errors)), 4) if errors else None,
+        }
+    return report
+
+
+def load_context(path=None):
+    """ context manager with the current job (or the one in path)"""
+    context_manager = data_manager.ContextManager()
+    if path is not None:
+        context_manager.context.clear()
+        context_manager._file_read_internal(path)
+    return context_manager
+
+
+def print_report(report):
+    print(f"{report['placed']}/{report['placements']} placed in {report['total_s']:.1f}s"
+          + (f" ({report['per_placement_s']:.2f}s per placement)" if report["placed"] else ""))
+    total = report["total_s"] or 1.0
+    for phase, seconds in report["phases"].items():
+        print(f"{phase:>10}{seconds:>10.1f}s{100 * seconds / total:>7.1f}%")
+    for problem in report["preflight"]:
+        print(f"preflight: {problem}")
+    if "tray_pick_error_mm" in report:
+        e = report["tray_pick_error_mm"]
+        if e["count"]:
+            print(f"tray picks {e['count']}, nozzle error mean {e['mean']:.3f}mm max {e['max']:.3f}mm")
+    if report["alert"]:
+        print(f"alert: {report['alert']}")
+
+
+def _parse_latency(values):
+    latency = {}
+    for value in values or []:
+        if "=" in value:
+            kind, seconds = value.split("=", 1)
+            if kind not in DEFAULT_LATENCY:
+                raise ValueError(f"unknown detection '{kind}', one of {', '.join(DEFAULT_LATENCY)}")
+            latency[kind] = float(seconds)
+        else:
+            latency.update({kind: float(value) for kind in DEFAULT_LATENCY})
+    return latency
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Predict the time of a job without moving the machine")
+    parser.add_argument("--context", help="context json of the job, default is the current one")
+    parser.add_argument("--config", default="config.toml", help="machine config")
+    parser.add_argument("--latency", action="append", help="seconds per detection, for all or as kind=seconds (repeatable)")
+    parser.add_argument("--render", action="store_true", help="run the real detectors on rendered camera images")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--force", action="store_true", help="run the job even if the preflight found problems")
+    args = parser.parse_args(argv)
+
+    report = simulate_job(load_context(args.context), toml.load(args.config), _parse_latency(args.latency),
+                          render=args.render, force=args.force)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=4)
+    if report["preflight"] and not args.force:
+        print("job not run, use --force to run it anyway")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import logging
+import contextlib
 import time
 import queue
 import pickle
@@ -20,12 +21,21 @@ import belt
 import tray
 import roll
 import eye
+import mosaic
+import bottom_up
+import scene_camera
+import clock
+import job_planner
+import preflight
+import placement
+import vision_config
 import json
 import config_old
 import toml
 import PCB
 import light
 from dotenv import load_dotenv
+from camera import CameraStillMock, CameraThread, CameraThreadMock
 from hole_finder import NoBeltHoleFoundException
 from hole_finder import HoleFinder
 
@@ -51,16 +61,21 @@ class LiveCam:
             return cam_image
 
 
+#pixel per mm of the bed overview mosaic
+MOSAIC_BED_RES = 5
+
+
 class AbortException(Exception):
     """ All calibration is broken"""
     pass
 
 
 class StateContext:
-    def __init__(self, robot, camera, context, context_manager, event_queue, light):
+    def __init__(self, robot, camera, context, context_manager, event_queue, light, config=None):
 
         logging.debug("Initializing machine parameters. Please ensure you have created the config.toml file.")
-        config = toml.load("config.toml")
+        if config is None:
+            config = toml.load("config.toml")
         print(config)
         self.light = light
         self.robot = robot
@@ -72,6 +87,14 @@ class StateContext:
 
         self.alert_id = 0
         self.do_pause = False
+        self.job_planner = job_planner.JobPlanner()
+        #[run] roll_pre_advance = false advances a roll only when its part is picked
+        self.roll_pre_advance = config.get("run", {}).get("roll_pre_advance", True)
+        #[run] pick_retries: looks at a feeder again (see _research_feeder) before a failed pick counts
+        self.pick_retries = config.get("run", {}).get("pick_retries", 1)
+        #feeder name -> designators which were not placed because it was empty, alerted at the end
+        self.empty_feeders = {}
+        self.placements = placement.PlacementTable()
 
         logging.debug("Initializing navigation parameters.")
         self.nav = {
@@ -132,16 +155,35 @@ class StateContext:
         wide_eye = eye.Eye(self.robot, self.camera, self.cal, res=20, cam_range=20)
         narrow_eye = eye.Eye(self.robot, self.camera, self.cal, res=60, cam_range=5)
 
+        #detector settings, see vision_config.py (tuned by vision_tune.py)
+        vision = vision_config.load(config=config)
+
         self.live_cam = LiveCam(self.camera, self.cal, self.nav["camera"])
-        self.fd = fiducial.FiducialMultiDetector(narrow_eye)
-        self.hole_finder = HoleFinder(narrow_eye)
-        self.picker = pick.Picker(wide_eye)
-        self.belt = belt.Belt(narrow_eye, self.picker)
+        self.fd = fiducial.FiducialMultiDetector(narrow_eye, config=vision.get("fiducial"))
+        self.hole_finder = HoleFinder(narrow_eye, vision.get("hole"))
+
+        #optional upward looking camera to align the part on the nozzle,
+        #it is started and stopped together with the top camera (see run_application)
+        self.bottom_camera = None
+        self.bottom_up = None
+        if "bottom_camera" in config:
+            #the camera argument hides the camera module here
+            if isinstance(self.camera, (CameraThreadMock, CameraStillMock, scene_camera.SceneCamera)):
+                self.bottom_camera = CameraStillMock()
+            else:
+                self.bottom_camera = CameraThread(config["bottom_camera"].get("device", 1))
+            self.bottom_up = bottom_up.BottomUpAligner(self.bottom_camera, config["bottom_camera"])
+
+        measures_drift = self.bottom_up is not None and bool(self.bottom_up.distance)
+        self.picker = pick.Picker(wide_eye, vision.get("components"), config.get("z_homing"), measures_drift)
+        self.belt = belt.Belt(narrow_eye, self.picker, wide_eye, vision.get("hole"))
         self.tray = tray.Tray(self.picker)
-        self.roll = roll.Roll(narrow_eye, self.picker)
+        self.roll = roll.Roll(narrow_eye, self.picker, vision.get("hole"))
+        self.mosaic = mosaic.Mosaic(wide_eye)
 
         if not fiducals_assigned:
             self.center_pcb()
+        self._refresh_placements(check_bounds=True)
 
     def center_pcb(self):
         positions = []
@@ -150,11 +192,16 @@ class StateContext:
                 if "x" in designator:
                     positions.append((float(designator["x"]), float(designator["y"])))
         positions = np.asarray(positions)
+        #the fiducials are reset first, that also resets the transform
+        self._reset_fiducials()
         if positions.size != 0:
-            bed_center = [self.nav["bed"][2] / 2, self.nav["bed"][3] / 2]
-            x, y = -(np.min(positions, axis=0) + np.max(positions, axis=0)) / 2 + bed_center
+            bed_area = self.nav["bed"]["bed_area"]
+            bed_center = [bed_area[2] / 2, bed_area[3] / 2]
+            #the board is mirrored in y, center its bounding box
+            x = bed_center[0] - (np.min(positions[:, 0]) + np.max(positions[:, 0])) / 2
+            y = bed_center[1] + (np.min(positions[:, 1]) + np.max(positions[:, 1])) / 2
             self.nav["pcb"]["transform"] = [1, 0, 0, -1, float(x), float(y)]
-        self._reset_fiducials()
+            self._refresh_placements()
 
     def run(self):
 
@@ -222,21 +269,18 @@ class StateContext:
         x, y = m[:2, :2] @ (x, y) + m[:2, 2]
         return x, y
 
-    def _pcb2robot2(self, x, y, a):
-        m = np.array(self.nav["pcb"]["transform"]).reshape((3, 2)).T
-        a = a * np.pi / 180
-        logging.debug(f"Converted angle to radians: ")
-        x2 = x + np.cos(a)
-        y2 = y + np.sin(a)
-
-        x, y = m[:2, :2] @ (x, y) + m[:2, 2]
-
-        x2, y2 = m[:2, :2] @ (x2, y2) + m[:2, 2]
-
-        a = np.arctan2(y2 - y, x2 - x)
-        a = a * 180 / np.pi
-
-        return x, y, a
+    def _refresh_placements(self, check_bounds=False):
+        """ recompute the robot coordinates of all designators if the transform or BOM changed"""
+        recomputed = self.placements.refresh(self.context["bom"], self.nav["pcb"]["transform"], self.context_manager.bom_version)
+        if recomputed or check_bounds or "out_of_bounds" not in self.nav["pcb"]:
+            #the nozzle is driven to the placement, it must stay within the bounds
+            picker = getattr(self, "picker", None)
+            offset = (picker.DX, picker.DY) if picker is not None else (0, 0)
+            out_of_bounds = self.placements.out_of_bounds(self.robot.x_bounds, self.robot.y_bounds, offset)
+            if out_of_bounds:
+                logging.warning(f"designators outside of the bounds: {', '.join(out_of_bounds)}")
+            self.nav["pcb"]["out_of_bounds"] = out_of_bounds
+        return self.placements
 
     def setup_state(self):
         """ In this state, the user makes machine setup and can freely roam the pick-plaz bed"""
@@ -260,7 +304,6 @@ class StateContext:
                 self.robot.default_settings()
                 self.robot.drive(x, y)
                 logging.debug(f"Robot driven to position: ({x}, {y}).")
-                # p.make_collage(self.robot, self.camera)
 
                 if self.event_queue.empty():
                     #only do the image work if no other command is pending.
@@ -305,8 +348,11 @@ class StateContext:
                 if item["method"] == "play":
                     self.context_manager.file_save()
                     self._reset_error_parts()
-                    logging.info("Playing sequence.")
-                    return self.run_state
+                    self.empty_feeders = {}
+                    if self._preflight():
+                        self._plan_job()
+                        logging.info("Playing sequence.")
+                        return self.run_state
                 elif item["method"] == "home":
                     self.robot.home()
                     self.robot.done()
@@ -362,7 +408,7 @@ class StateContext:
                     part, partdes = self._get_part_from_designator(name)
                     if part != None:
                         try:
-                            self._place_part(part, partdes)
+                            self._place_part(part, partdes, name)
                         except Exception as e:
                             logging.error("An error occurred: %s", e, exc_info=True)
                             self._push_alert(e)
@@ -381,7 +427,7 @@ class StateContext:
                     name = item["param"]
                     feeder = self.context["feeder"][name]
                     if feeder["type"] == tray.TYPE_NUMBER:
-                        self.tray.pick(feeder, self.robot)
+                        self.tray.pick(feeder, self.robot, footprint=self._get_feeder_footprint(name))
                     elif feeder["type"] == belt.TYPE_NUMBER:
                         self.belt.pick(feeder, self.robot)
                     elif feeder["type"] == roll.TYPE_NUMBER:
@@ -394,11 +440,21 @@ class StateContext:
                     name = item["param"]
                     feeder = self.context["feeder"][name]
                     if feeder["type"] == tray.TYPE_NUMBER:
-                        self.tray.pick(feeder, self.robot, only_camera=True)
+                        self.tray.pick(feeder, self.robot, only_camera=True, footprint=self._get_feeder_footprint(name))
                     elif feeder["type"] == belt.TYPE_NUMBER:
                         self.belt.pick(feeder, self.robot, only_camera=True)
                     elif feeder["type"] == roll.TYPE_NUMBER:
                         self.roll.pick(feeder, self.robot, only_camera=True)
+                elif item["method"] == "scan_feeder":
+                    name = item["param"]
+                    feeder = self.context["feeder"][name]
+                    if feeder["type"] == tray.TYPE_NUMBER:
+                        count = self.tray.scan(feeder, self.robot, self.mosaic, self._get_feeder_footprint(name))
+                        self._push_alert(f"Found {count} parts in '{name}'")
+                elif item["method"] == "scan_bed":
+                    x0, x1 = self.robot.x_bounds
+                    y0, y1 = self.robot.y_bounds
+                    self.mosaic.scan(self.robot, (x0, y0, x1 - x0, y1 - y0), res=MOSAIC_BED_RES, name="BedMosaic")
                 elif item["method"] == "reset_board":
                     self._reset_for_new_board()
                 elif item["method"] == "roll_advance":
@@ -432,6 +488,8 @@ class StateContext:
             self._push_alert(e)
         except pick.NoPartFoundException as e:
             self._push_alert(e)
+        except bottom_up.NozzleEmptyException as e:
+            self._push_alert(e)
         except AbortException as e:
             self._push_alert(e)
         except Exception as e:
@@ -446,19 +504,33 @@ class StateContext:
 
         self.nav["state"] = "run"
 
+        next_state = self._run_step()
+        if next_state != self.run_state:
+            #the pump is kept running between the placements
+            self.robot.vacuum(False)
+        return next_state
+
+    def _run_step(self):
+        """ place the next part, returns the next state"""
         try:
             logging.info("get next part information")
-            part, partdes = self._get_next_part_from_bom()
+            name, part, partdes = self._get_next_part()
             if part is None:
-                self._push_alert("Placing finished")
+                self._push_alert("Placing finished" + self._refill_report())
+                self.empty_feeders = {}
                 return self.setup_state
-            self._place_part(part, partdes)
+            #the pump keeps running if another part follows, its line purges on the way
+            keep_vacuum = self.context_manager.job_queue.peek()[0] is not None
+            self._place_part(part, partdes, name, keep_vacuum=keep_vacuum)
 
         except pick.NoPartFoundException as e:
+            #the parts of the other feeders are placed first, the operator refills at the end
+            self._mark_feeder_empty(part, name, e)
+        except bottom_up.NozzleEmptyException as e:
             self._push_alert(e)
             return self.setup_state
         except NoBeltHoleFoundException as e:
-            self.push_alert(e)
+            self._push_alert(e)
             return self.idle_state
         except save_robot.OutOfSaveSpaceException as e:
             self._push_alert(e)
@@ -480,28 +552,31 @@ class StateContext:
             for name, partdes in part["designators"].items():
                 if partdes["state"] == data_manager.PART_STATE_ERROR and partdes["place"] and not part["fiducial"]:
                     partdes["state"] = data_manager.PART_STATE_READY
+                    self.context_manager.job_queue.update(part, name)
 
     def _reset_for_new_board(self):
         for part in self.context["bom"]:
             for name, partdes in part["designators"].items():
                 if partdes["state"] != data_manager.PART_STATE_SKIP:
                     partdes["state"] = data_manager.PART_STATE_READY
+                    self.context_manager.job_queue.update(part, name)
 
     def _get_part_from_designator(self, name):
         """ find part to place only from its designator """
+        return self.context_manager.get_part_from_designator(name)
+
+    def _get_feeder_footprint(self, name):
+        """ footprint of the parts assigned to a feeder, None if there are none"""
         for part in self.context["bom"]:
-            partdes = part["designators"].get(name)
-            if partdes != None:
-                return part, partdes
-        return None, None
+            if part.get("feeder") == name and part.get("footprint"):
+                return part["footprint"]
+        return None
 
-    def _place_part(self, part, partdes):
+    def _place_part(self, part, partdes, name, keep_vacuum=False):
+        """ keep_vacuum : leave the pump running after the place, only the run loop knows a next part follows"""
         self.robot.default_settings()
         partdes["state"] = data_manager.PART_STATE_ERROR
 
-        place_pos = float(partdes["x"]), float(partdes["y"])
-        place_angle = float(partdes["rot"]) + float(part["rot"])
-
         #skip if feeder not defined
         #TODO maybe a bit ugly:
         feeder = part.get("feeder")
@@ -512,28 +587,49 @@ class StateContext:
 
         self._poll_for_pause()
 
+        #rotation which maps the part onto itself, the nozzle turns the shorter way
+        symmetry = self.picker.get_footprint_symmetry(part.get("footprint"))
+
         logging.info("pick part")
-        if feeder["type"] == tray.TYPE_NUMBER:
-            self.tray.pick(feeder, self.robot)
-        elif feeder["type"] == belt.TYPE_NUMBER:
-            self.belt.pick(feeder, self.robot)
-        elif feeder["type"] == roll.TYPE_NUMBER:
-            self.roll.pick(feeder, self.robot)
-        else:
-            raise Exception(f"Feeder type {feeder['type']} unknown")
+        for attempt in range(self.pick_retries + 1):
+            try:
+                self._pick_part(feeder, part, symmetry)
+                break
+            except (pick.NoPartFoundException, NoBeltHoleFoundException) as e:
+                if attempt == self.pick_retries:
+                    raise
+                logging.warning(f"{e}, looking at feeder {part['feeder']} again")
+                if not self._research_feeder(feeder, part):
+                    raise
+
+        if self.roll_pre_advance:
+            self._pre_advance_roll()
 
         self._poll_for_pause()
 
         logging.info("place part")
-        x, y = place_pos
-        x, y, place_angle = self._pcb2robot2(x, y, place_angle)
+        x, y, place_angle = self._refresh_placements().get(name)
         # make sure rotation is minimal
         if place_angle < -180:
             place_angle += 360
         if place_angle > 180:
             place_angle -= 360
         # angle is in pcb coordinates, thus inverted
-        self.picker.place(self.robot, x, y, -place_angle)
+        angle = self.picker.equivalent_angle(-place_angle, symmetry)
+        if self.bottom_up is not None:
+            #measured at the place rotation
+            try:
+                dx, dy, da = self.bottom_up.measure(self.robot, self.picker, angle, part.get("footprint"))
+            except bottom_up.NozzleEmptyException:
+                self.robot.valve(False)
+                self.robot.vacuum(False)
+                raise
+            logging.info(f"bottom up correction x={dx:.3f} y={dy:.3f} a={da:.1f}")
+            self.picker.z_homing.observe(part.get("footprint"), self.bottom_up.last_area, self.bottom_up.distance)
+            #turning the nozzle by -da also turns the offset around the nozzle axis
+            ox, oy = bottom_up.rotate_offset(dx, dy, da)
+            x, y, angle = x - ox, y - oy, angle - da
+        self.picker.place(self.robot, x, y, angle, keep_vacuum=keep_vacuum)
 
         logging.info("update part state")
         partdes["state"] = data_manager.PART_STATE_PLACED
@@ -541,6 +637,79 @@ class StateContext:
         self.robot.default_settings()
         self._poll_for_pause()
 
+    def _pick_part(self, feeder, part, symmetry=360):
+        if feeder["type"] == tray.TYPE_NUMBER:
+            self.tray.pick(feeder, self.robot, footprint=part.get("footprint"))
+        elif feeder["type"] == belt.TYPE_NUMBER:
+            self.belt.pick(feeder, self.robot, symmetry=symmetry)
+        elif feeder["type"] == roll.TYPE_NUMBER:
+            self.roll.pick(feeder, self.robot, symmetry=symmetry)
+        else:
+            raise Exception(f"Feeder type {feeder['type']} unknown")
+
+    def _research_feeder(self, feeder, part):
+        """
+        look at a feeder again after a failed pick, returns True if the pick can be retried.
+        tray: search the views around the last found parts, belt: measure the
+        current hole again, roll: the next pick advances the tape once more
+        """
+        if feeder["type"] == tray.TYPE_NUMBER:
+            return self.tray.search_near(feeder, self.robot, footprint=part.get("footprint")) > 0
+        elif feeder["type"] == belt.TYPE_NUMBER:
+            self.belt.remeasure(feeder, self.robot)
+            return True
+        elif feeder["type"] == roll.TYPE_NUMBER:
+            #pick() popped the advanced flag, so it advances again
+            return True
+        return False
+
+    def _mark_feeder_empty(self, part, name, error):
+        """
+        the feeder of part has no parts left: mark it empty and all its
+        designators which are not placed yet as error, the job goes on
+        with the other feeders
+        """
+        feeder_name = part.get("feeder")
+        logging.warning(f"{error}, feeder {feeder_name} is empty")
+        self.context_manager.modify_feeder_state(feeder_name, data_manager.FEEDER_STATE_EMPTY)
+        names = self.empty_feeders.setdefault(feeder_name, [])
+        names.append(name)
+        for bom_part in self.context["bom"]:
+            if bom_part.get("feeder") != feeder_name:
+                continue
+            for other, partdes in bom_part["designators"].items():
+                if data_manager.is_part_ready(bom_part, partdes):
+                    self.context_manager.modify_part_state(other, data_manager.PART_STATE_ERROR)
+                    names.append(other)
+
+    def _refill_report(self):
+        """ alert text listing the feeders which ran empty during the job, empty if none did"""
+        if not self.empty_feeders:
+            return ""
+        lines = [f"{feeder}: {', '.join(names)}" for feeder, names in self.empty_feeders.items()]
+        return ", refill these feeders and place again:\n" + "\n".join(lines)
+
+    def _pre_advance_roll(self):
+        """
+        Advance the roll of the next part right after the pick lifted off, the
+        tape settles during travel and place. Roll.pick then only waits for the
+        rest of the settle time.
+        """
+        name, feeder = self._get_next_feeder()
+        if feeder is not None and feeder["type"] == roll.TYPE_NUMBER and "channel" in feeder:
+            logging.info(f"pre-advance roll of {name}")
+            self.roll.prepare(feeder, self.robot)
+
+    def _get_next_feeder(self):
+        """ (designator, feeder) of the next part in the job queue, feeder is None if there is no ready one"""
+        name, part, _partdes = self.context_manager.job_queue.peek()
+        if part is None:
+            return name, None
+        feeder = self.context["feeder"].get(part.get("feeder"))
+        if feeder is None or feeder.get("state", data_manager.FEEDER_STATE_READY) != data_manager.FEEDER_STATE_READY:
+            return name, None
+        return name, feeder
+
     def _poll_for_pause(self):
         try:
             item = self.event_queue.get(block=False)
@@ -555,16 +724,68 @@ class StateContext:
         except queue.Empty:
             pass
 
-    def _get_next_part_from_bom(self):
-        """ find next part in bom that is eligable for placing"""
-        for part in self.context["bom"]:
-            if part["place"] == True:
-                for name, partdes in part["designators"].items():
-                    if "x" not in partdes:
-                        continue
-                    if partdes["state"] == data_manager.PART_STATE_READY and partdes["place"] and not part["fiducial"]:
-                        return part, partdes
-        return None, None
+    def _preflight(self):
+        """ check every pick and place of the job before the machine moves, alerts all problems"""
+        jobs = self.context_manager.job_queue.items()
+        problems, warnings = preflight.check(self.context, jobs, self._refresh_placements(),
+            self.robot.x_bounds, self.robot.y_bounds, (self.picker.DX, self.picker.DY))
+        self.nav["preflight"] = problems
+        self.nav["preflight_warnings"] = warnings
+        if problems:
+            logging.warning("preflight failed:\n" + "\n".join(problems + warnings))
+            self._push_alert("Job can not be started:\n" + "\n".join(problems + warnings))
+            return False
+        if warnings:
+            #the job runs, the operator places these parts by hand
+            logging.warning("preflight:\n" + "\n".join(warnings))
+            self._push_alert("\n".join(warnings))
+        return True
+
+    def _plan_job(self):
+        """ plan the placement order of the job queue from the current head position"""
+        queue = self.context_manager.job_queue
+        start_pos = (self.nav["camera"]["x"], self.nav["camera"]["y"])
+        with queue.lock:
+            sequence = self.job_planner.plan(self._make_jobs(queue.items()), start_pos)
+            queue.reorder([job.name for job in sequence])
+        self.nav["job"] = self.job_planner.report(len(queue))
+
+    def _plan_added(self):
+        """ insert the parts added to the job queue since the last plan into the planned order"""
+        queue = self.context_manager.job_queue
+        start_pos = (self.nav["camera"]["x"], self.nav["camera"]["y"])
+        with queue.lock:
+            added = set(queue.added)
+            jobs = self._make_jobs(queue.items())
+            sequence = [job for job in jobs if job.name not in added]
+            sequence = self.job_planner.insert(sequence, [job for job in jobs if job.name in added], start_pos)
+            queue.reorder([job.name for job in sequence])
+
+    def _make_jobs(self, items):
+        """ job_planner.Job of every (designator, part, partdes)"""
+        jobs = []
+        placements = self._refresh_placements()
+        for name, part, partdes in items:
+            feeder = self.context["feeder"].get(part.get("feeder"))
+            #parts without feeder fail in _place_part, they get no travel
+            pick_pos = job_planner.feeder_position(feeder) if feeder is not None else None
+            light = job_planner.TRAY_LIGHT if feeder is not None and feeder["type"] == tray.TYPE_NUMBER else job_planner.TOPDN_LIGHT
+            place_pos = placements.get(name)[:2]
+            jobs.append(job_planner.Job(name, part, partdes, part.get("feeder"), light,
+                pick_pos if pick_pos is not None else place_pos, place_pos))
+        return jobs
+
+    def _get_next_part(self):
+        """ next part of the job queue, parts added during the run are inserted into the planned order"""
+        queue = self.context_manager.job_queue
+        with queue.lock:
+            if queue.changed:
+                self._plan_job()
+            elif queue.added:
+                self._plan_added()
+            name, part, partdes = queue.pop()
+        self.nav["job"] = self.job_planner.report(len(queue))
+        return name, part, partdes
 
     def _push_alert(self, msg, answers=None):
 
@@ -585,6 +806,7 @@ class StateContext:
             "transform_mse": 0.1,
             "fiducials": {},
         }
+        self._refresh_placements()
 
     def _recalculate_fiducial_transform(self):
         try:
@@ -595,6 +817,7 @@ class StateContext:
                 transform, mse = fiducial.get_transform(self.nav["pcb"]["fiducials"], fiducial_designators)
                 self.nav["pcb"]["transform"] = transform
                 self.nav["pcb"]["transform_mse"] = float(mse)
+                self._refresh_placements()
             else:
                 logging.error("No fiducial designators found in BOM")
                 logging.info("No fiducial designators found in BOM")
@@ -637,13 +860,19 @@ FINISH_MESSAGE = "Finished run"
 
 
 def main(mock=False):
+    if mock:
+        #nothing to wait for on a simulated machine
+        clock.use(clock.VirtualClock(time.time()))
     setup_logging()
     setup_directories()
     queue = create_queue()
     robot = connect_robot(mock)
-    camera_thread = connect_camera(mock)
     data_manager = initialize_data()
+    camera_thread = connect_camera(mock, robot, data_manager)
     state_context = initialize_state_context(robot, camera_thread, data_manager, queue, light)
+    if mock:
+        #the board lies where the machine expects it at startup
+        camera_thread.scene.add_pcb(data_manager.get()["bom"], state_context.nav["pcb"]["transform"])
     server = initialize_server(state_context, data_manager, queue)
     run_application(state_context, camera_thread)
     terminate_application(data_manager, robot)
@@ -668,12 +897,15 @@ def connect_robot(mock):
     return save_robot.SaveRobot(None if mock else os.getenv("SERIAL_PORT"))
 
 
-def connect_camera(mock):
+def connect_camera(mock, robot=None, data_manager=None):
     if not mock:
         logging.info(CAMERA_MESSAGE)
         return camera.CameraThread(0)
     else:
-        return camera.CameraThreadMock()
+        #renders the feeders and the calibration board of the current context
+        cal = scene_camera.load_calibration()
+        scene = scene_camera.Scene(data_manager.get(), cal)
+        return scene_camera.SceneCamera(robot, scene, cal)
 
 
 def initialize_data():
@@ -708,7 +940,7 @@ def initialize_server(state_context, data_manager, queue):
 def run_application(state_context, camera_thread):
     try:
         # Assuming camera_thread accommodates context management
-        with camera_thread:
+        with camera_thread, state_context.bottom_camera or contextlib.nullcontext():
             state_context.run()  # Potential Exceptions may originate from here
             logging.info(RUNNING_MESSAGE)
 
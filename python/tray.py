@@ -9,83 +9,203 @@ TYPE_NUMBER = 0
 
 AUTO_DETECT_ZONE_MARGIN = 4
 
+#detections closer than this (mm) are the same part
+INVENTORY_MERGE_DISTANCE = 1.0
+#a known part must be found again within this distance (mm) to be picked
+INVENTORY_VERIFY_TOLERANCE = 1.5
+#give up on the inventory after this many failed verifications in a row
+INVENTORY_MAX_ATTEMPTS = 10
+#order in which the tray is searched, "nearest" or "serpentine"
+SEARCH_ORDER = "nearest"
+#the part size used for the search grid overlap is at most this fraction of the camera range
+MAX_PART_SIZE_FRACTION = 0.5
+
 # Tray feeder.
 # SMD part is on a backlit area. The robot searches for the part using the camera. Rotation is corrected for.
+# Every part seen on the way is kept in feeder["inventory"] as [x, y, angle, area, score] in machine
+# coordinates, so later picks drive straight to a known part and only verify it. score is the
+# footprint match (None if the footprint was not known).
 class Tray:
 
     def __init__(self, picker):
         self.picker = picker
         self.eye = picker.eye #TODO reference directly to self.picker.eye instead of self.eye
 
-    def pick(self, feeder, robot, only_camera=False):
-        pick_pos = self._find_in_tray(feeder, robot)
+    def pick(self, feeder, robot, only_camera=False, footprint=None):
+        """ footprint : name in footprints.json, blobs of another size are not picked"""
+        pick_pos = self._find_in_tray(feeder, robot, footprint)
         # self.nav["detection"]["part"] = pick_pos #TODO remove nav/detection/part
 
         x, y, a, A = pick_pos
         if only_camera:
             robot.drive(x, y)
         else:
+            #the part is gone after this, the inventory must not offer it again
+            self._remove_from_inventory(feeder, (x, y))
             self.apply_area_slowdown(robot, A)
-            self.picker.pick(robot, x, y, a, config.PICK_Z_TRAY)
+            self.picker.pick(robot, x, y, a, config_old.PICK_Z_TRAY, symmetry=self.picker.get_footprint_symmetry(footprint))
 
-    def _find_in_tray(self, feeder, robot):
+    def _find_in_tray(self, feeder, robot, footprint=None):
 
-        r = self.eye.cam_range + AUTO_DETECT_ZONE_MARGIN
+        robot.light_topdn(False)
+        robot.light_tray(True)
 
-        w = feeder["position"][2] - r
-        h = feeder["position"][3] - r
-        xs = feeder["position"][0] + r/2 + np.linspace(0, w, 2 + int(np.floor(w/(r*2/3))))
-        ys = feeder["position"][1] + r/2 + np.linspace(0, h, 2 + int(np.floor(h/(r*2/3))))
-        tray_angle = feeder["rot"] #FIXME not used yet
-        search_positions = np.stack(np.meshgrid(xs, ys), axis=-1).reshape((-1,2))
+        #first try the parts which are already known from earlier images
+        pos = self._pick_from_inventory(feeder, robot, footprint)
 
-        # self._plot_search_positions(search_positions, feeder)
+        #search the tray if nothing known is left
+        if pos is None:
+            self._search_tray(feeder, robot, footprint)
+            pos = self._pick_from_inventory(feeder, robot, footprint)
 
-        robot.light_topdn(False)
-        robot.light_tray(True)
+        if pos is None:
+            raise pick.NoPartFoundException("Could not find part to pick")
 
-        if "last_found_index" in feeder:
-            last_found_index = feeder["last_found_index"]
-            search_positions = np.roll(search_positions, -last_found_index, axis=0)
-        else:
-            last_found_index = 0
+        robot.light_tray(False)
+        robot.light_topdn(True)
+
+        #angle in degrees
+        return pos
+
+    def _search_tray(self, feeder, robot, footprint=None):
+        """ walk the search positions until one image shows parts, all of them go into the inventory"""
+
+        tray_angle = feeder["rot"] #FIXME not used yet
+        feeder.pop("last_found_index", None) #replaced by last_found_pos
+        head_pos = (self.eye.robot.pos_logger["x"], self.eye.robot.pos_logger["y"])
+        search_positions = plan_search_positions(
+            feeder["position"],
+            self.eye.cam_range,
+            head_pos,
+            part_size=feeder.get("part_size", AUTO_DETECT_ZONE_MARGIN),
+            priority_pos=feeder.get("last_found_pos"),
+        )
+
+        # self._plot_search_positions(search_positions, feeder)
 
         for robot_pos in search_positions:
 
             robot.drive(*robot_pos)
-            image = self.eye.get_valid_image()
-
-            p, a, _A = self.picker.find_components(image)
-            if len(p):
+            if self._take_inventory(feeder, footprint=footprint):
+                feeder["last_found_pos"] = [float(robot_pos[0]), float(robot_pos[1])]
                 break
-            last_found_index = last_found_index + 1 % len(search_positions)
-        else:
-            last_found_index = 0
-            raise pick.NoPartFoundException("Could not find part to pick")
+        #last_found_pos is kept after a failed sweep, search_near() looks there again
 
-        feeder["last_found_index"] = last_found_index
+    def _pick_from_inventory(self, feeder, robot, footprint=None):
+        """ verify known parts (closest first) until one is confirmed"""
+        for _ in range(INVENTORY_MAX_ATTEMPTS):
+            entry = self._nearest_in_inventory(feeder)
+            if entry is None:
+                return None
+            pos = self._verify_part(feeder, robot, entry, footprint)
+            if pos is not None:
+                return pos
+        return None
 
-        pos = np.array(p[0])
-        pos = tuple((pos / self.eye.res) - (self.eye.cam_range/2) + robot_pos)
+    def _verify_part(self, feeder, robot, entry, footprint=None):
+        """
+        drive over a known part and measure it again without paralax.
+        returns (x, y, a, A) or None if the part is not there anymore
+        """
+        x, y = entry[0], entry[1]
+        robot.drive(x, y)
+        #the area around the part is measured again, a blob which does not
+        #match the footprint (anymore) is dropped from the inventory
+        self._remove_from_inventory(feeder, (x, y), INVENTORY_VERIFY_TOLERANCE)
+        self._take_inventory(feeder, debug_name="TrayImage", footprint=footprint)
 
-        #drive to part and measure again without paralax
-        robot_pos = pos
-        robot.drive(*pos)
+        found = self._nearest_in_inventory(feeder, (x, y))
+        if found is None or math.dist(found[:2], (x, y)) > INVENTORY_VERIFY_TOLERANCE:
+            #part has moved away or was never there
+            self._remove_from_inventory(feeder, (x, y))
+            return None
+        if len(found) > 4 and found[4] is not None:
+            print(f"footprint match score {found[4]:.2f}")
+        return tuple(found[:4])
+
+    def _take_inventory(self, feeder, debug_name=None, footprint=None):
+        """
+        detect all parts in the current view and merge them into the inventory.
+        returns number of parts detected
+        """
         image = self.eye.get_valid_image()
-        debug.set_image("TrayImage", image)
+        debug.record_image("TrayComponents", image, detector="components", res=self.eye.res, cam_range=self.eye.cam_range, footprint=footprint)
+        if debug_name is not None:
+            debug.set_image(debug_name, image)
 
-        p, a, A = self.picker.find_components(image)
+        p, a, A, s = self.picker.find_components(image, footprint=footprint)
+        for (px, py), angle, area, score in zip(p, a, A, s):
+            x, y = self.eye.get_pos_from_image_indices(px, py)
+            self._remove_from_inventory(feeder, (x, y))
+            feeder["inventory"].append([float(x), float(y), float(angle), float(area), score])
         if len(p):
-            pos = np.array(p[0])
-            pos = tuple((pos / self.eye.res) - (self.eye.cam_range / 2) + robot_pos)
-        else:
-            raise pick.NoPartFoundException("Could not find part to pick")
+            #rough diagonal of the part in mm, used for the search grid spacing
+            size = self.picker.get_footprint_size(footprint) if footprint is not None else None
+            if size is not None:
+                part_size = math.hypot(*size)
+            else:
+                #median, a blob of touching parts or debris must not widen the overlap
+                part_size = math.sqrt(2.5 * float(np.median(A))) / self.eye.res
+            feeder["part_size"] = float(min(part_size, MAX_PART_SIZE_FRACTION * self.eye.cam_range))
+        return len(p)
+
+    def _nearest_in_inventory(self, feeder, pos=None):
+        """ return inventory entry closest to pos (default: camera position)"""
+        inventory = feeder.get("inventory")
+        if not inventory:
+            return None
+        if pos is None:
+            pos = self.eye.robot.pos_logger["x"], self.eye.robot.pos_logger["y"]
+        return min(inventory, key=lambda entry: math.dist(entry[:2], pos))
+
+    def _remove_from_inventory(self, feeder, pos, distance=INVENTORY_MERGE_DISTANCE):
+        inventory = feeder.setdefault("inventory", [])
+        inventory[:] = [entry for entry in inventory if math.dist(entry[:2], pos) > distance]
+
+    def scan(self, feeder, robot, mosaic, footprint=None):
+        """ scan the whole tray into a mosaic and replace the inventory with all parts on it"""
+        robot.light_topdn(False)
+        robot.light_tray(True)
+
+        mosaic.scan(robot, feeder["position"], name="TrayMosaic")
+        index = mosaic.find_parts(self.picker, footprint)
+        x, y, w, h = feeder["position"]
+        feeder["inventory"] = index.query(x, y, w, h)
 
         robot.light_tray(False)
         robot.light_topdn(True)
+        return len(feeder["inventory"])
 
-        #angle in degrees
-        return (pos[0], pos[1], a[0], A[0])
+    def clear_inventory(self, feeder):
+        feeder["inventory"] = []
+
+    def search_near(self, feeder, robot, footprint=None):
+        """
+        look again around the position parts were last found, with the view
+        shifted by half a grid step to each side. A part lying on the border
+        of two sweep views is only seen whole in a shifted view.
+        returns number of parts found (0 if parts were never found on the tray)
+        """
+        pos = feeder.get("last_found_pos")
+        if pos is None:
+            return 0
+
+        robot.light_topdn(False)
+        robot.light_tray(True)
+
+        x, y, w, h = feeder["position"]
+        part_size = min(feeder.get("part_size", AUTO_DETECT_ZONE_MARGIN), MAX_PART_SIZE_FRACTION * self.eye.cam_range)
+        shift = max(self.eye.cam_range - part_size, 1.0) / 2
+        found = 0
+        for dx, dy in ((0, 0), (-shift, 0), (shift, 0), (0, -shift), (0, shift)):
+            robot.drive(min(max(pos[0] + dx, x), x + w), min(max(pos[1] + dy, y), y + h))
+            found = self._take_inventory(feeder, footprint=footprint)
+            if found:
+                break
+
+        robot.light_tray(False)
+        robot.light_topdn(True)
+        return found
 
     def apply_area_slowdown(self, robot, area):
         size = math.sqrt(area)
@@ -106,4 +226,61 @@ class Tray:
         print("area=%f, size=%f, factor=%f"% (area, size, factor))
         # note: if we ever have a second picker the rotating motor needs also a factor of 12 here
         #       and the STM32 Firmware also needs to reset it correctly.
-        robot.feedrate_multiplier(x=tf, y=tf, z=zf, e=rf*12, a=of, b=of, c=of)
\ No newline at end of file
+        robot.feedrate_multiplier(x=tf, y=tf, z=zf, e=rf*12, a=of, b=of, c=of)
+
+
+def plan_search_positions(area, cam_range, head_pos, part_size=AUTO_DETECT_ZONE_MARGIN, priority_pos=None, order=SEARCH_ORDER):
+    """
+    Plan the camera positions to search a tray area (x, y, width, height).
+
+    A part is only detected if it is completely in the view, so neighbouring
+    views overlap by the part size. The positions are ordered either
+    "serpentine" (starting at the corner closest to the head) or "nearest"
+    (greedy nearest neighbour from the head). The view containing
+    priority_pos (e.g. where parts were seen last) is visited first.
+
+    returns array[n, 2]
+    """
+    x, y, w, h = area
+    part_size = min(part_size, MAX_PART_SIZE_FRACTION * cam_range)
+    step = max(cam_range - part_size, 1.0)
+    nx = max(1, int(math.ceil(w / step)))
+    ny = max(1, int(math.ceil(h / step)))
+    xs = x + (np.arange(nx) + 0.5) * w / nx
+    ys = y + (np.arange(ny) + 0.5) * h / ny
+
+    head_pos = np.asarray(head_pos, dtype=np.float64)
+    start = head_pos
+    if priority_pos is not None:
+        start = np.asarray(priority_pos, dtype=np.float64)
+
+    if order == "serpentine":
+        #walk the columns from the end closest to the start
+        if abs(xs[-1] - start[0]) < abs(xs[0] - start[0]):
+            xs = xs[::-1]
+        if abs(ys[-1] - start[1]) < abs(ys[0] - start[1]):
+            ys = ys[::-1]
+        positions = np.array([
+            (xi, yi)
+            for i, xi in enumerate(xs)
+            for yi in (ys if i % 2 == 0 else ys[::-1])
+        ])
+    elif order == "nearest":
+        remaining = np.stack(np.meshgrid(xs, ys), axis=-1).reshape((-1, 2))
+        positions = []
+        current = start
+        while len(remaining):
+            i = np.argmin(np.linalg.norm(remaining - current, axis=1))
+            current = remaining[i]
+            positions.append(current)
+            remaining = np.delete(remaining, i, axis=0)
+        positions = np.array(positions)
+    else:
+        raise ValueError("order not in ['serpentine', 'nearest']")
+
+    if priority_pos is not None:
+        #the view closest to the priority position goes first
+        i = np.argmin(np.linalg.norm(positions - start, axis=1))
+        positions = np.concatenate((positions[i:i+1], np.delete(positions, i, axis=0)))
+
+    return positions
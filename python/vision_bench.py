@@ -0,0 +1,486 @@
+"""
+Headless benchmark of the vision detectors on recorded frames.
+
+The dataset is a directory with images and an 'annotations.json' as written
+by debug.record_image (set DEBUG_RECORD_DIR while running the machine):
+
+    {
+        "BeltHole_123_0.jpg": {
+            "detector": "hole",      # fiducial, hole, holes, components, bottom_up or aruco
+            "res": 60,               # pixel per mm of the projected frame
+            "cam_range": 5,          # frame size in mm
+            "radius": 0.75,          # fiducial/hole radius in mm
+            "truth": [[x, y], ...]   # pixel positions (aruco: marker ids)
+        },
+        ...
+    }
+
+Frames with "truth": null are timed but not scored. bottom_up frames can add
+"angle" (degree, like pick.find_components) to score the rotation, the
+"expected" rotation and the "fold" (see BottomUpAligner.analyze) and
+"flip_x"/"flip_y" of the camera, the truth is then the machine offset in
+pixel from the image center.
+
+usage: python vision_bench.py <dataset> [--repeat N] [--json result.json]
+                              [--baseline result.json] [--max-slowdown 1.2]
+                              [--engine hough,template]
+       python vision_bench.py --check-bottom-up
+       python vision_bench.py --check-belt-fit
+
+With --engine the circle detectors (fiducial, hole, holes) run once per
+circle engine and are reported as e.g. "hole[template]".
+
+--check-bottom-up runs the bottom-up aligner on rendered parts with known
+offsets and rotations for every flip setting and fails if the sign or the
+size of a correction is wrong, or if the corrected part would not land on
+its target (the offset turns with the nozzle).
+
+--check-belt-fit fits belt.fit_belt_holes on hole positions with known
+outcome (outliers, holes off the tape line or out of phase) and fails if a
+fit is wrong or a bad detection is not rejected.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import belt
+import bottom_up
+import camera_cal
+import circle_engine
+import vision_config
+import debug
+import fiducial
+import hole_finder
+import pick
+
+#a detection closer than this to the truth is a hit (pixel)
+HIT_TOLERANCE_PIX = 5
+#detectors built on a circle engine
+CIRCLE_DETECTORS = ("fiducial", "hole", "holes")
+#allowed bottom-up errors on the synthetic frames (pixel, degree)
+CHECK_TOLERANCE_PIX = 1.5
+CHECK_TOLERANCE_DEG = 1.5
+#(dx, dy) in mm and rotation in degree of the synthetic bottom-up parts, optionally the
+#rotation the part should have (default 0)
+CHECK_OFFSETS = [(0.0, 0.0, 0.0), (0.3, -0.2, 20.0), (-0.4, 0.1, -30.0), (0.5, 0.5, 10.0), (-0.2, -0.6, -5.0),
+                 (1.0, 0.0, 10.0), (0.8, -0.6, 80.0), (-1.2, 0.9, -45.0),
+                 #placed at 30 degree, picked 90 degree off and (a 0 degree place) turned by 90
+                 (0.4, 0.3, 32.0, 30.0), (0.2, -0.3, 85.0, -5.0), (0.3, 0.3, 90.0, 0.0)]
+#allowed distance of the corrected part to its target (mm)
+CHECK_TOLERANCE_MM = 0.05
+#belt holes (mm along/across the belt from the current hole, 4mm pitch), holes to predict
+#and the expected positions along the belt, None if the detection must be rejected
+CHECK_BELT_FITS = [
+    ([[4, 0], [8, 0], [12, 0.05]], 3, [4, 8, 12]),
+    ([[4.1, 0]], 1, [4.1]),
+    ([[4, 0], [8, 0], [6, 0], [10, 2]], 2, [4, 8]), #one hole out of pitch, one off the line
+    ([[4, 0], [8, 1.0]], 2, None), #no common tape line
+    ([[6, 0]], 1, None), #half a pitch off the current hole
+    ([[4, 0], [6, 0]], 2, None), #no common pitch phase
+    ([[-4, 0], [0, 0]], 1, None), #only holes of picked parts
+]
+
+
+class ReplayEye:
+    """ Eye replacement which returns a recorded frame instead of driving the camera"""
+
+    def __init__(self, res, cam_range):
+        self.res = res
+        self.cam_range = cam_range
+        self.image = None
+        #machine position == frame position in mm, (0/0) at the upper left corner
+        self.robot_pos = (cam_range / 2, cam_range / 2)
+
+    def get_valid_image(self):
+        return self.image
+
+    def get_pos_from_image_indices(self, index_x, index_y):
+        return (
+            index_x/self.res - self.cam_range/2 + self.robot_pos[0],
+            index_y/self.res - self.cam_range/2 + self.robot_pos[1],
+        )
+
+
+def load_dataset(directory):
+    """ returns list of (filename, grayscale image, annotation)"""
+    with open(os.path.join(directory, "annotations.json"), "r") as f:
+        annotations = json.load(f)
+
+    frames = []
+    for filename, annotation in sorted(annotations.items()):
+        image = cv2.imread(os.path.join(directory, filename), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            print(f"skipping '{filename}', image not readable")
+            continue
+        frames.append((filename, image, annotation))
+    return frames
+
+
+def make_detector(annotation, config=None):
+    """
+    returns a function image -> array[n, 2] of detected pixel positions
+    (aruco: array of marker ids)
+    config : vision settings of the detector (a [vision.*] section), None for the defaults
+    """
+    kind = annotation["detector"]
+
+    if kind == "aruco":
+        def detect(image):
+            _corners, ids = camera_cal.detect_markers(image)
+            return np.zeros((0,), int) if ids is None else ids.flatten()
+        return detect
+
+    eye = ReplayEye(annotation["res"], annotation.get("cam_range", 0))
+
+    def to_pix(positions):
+        return np.asarray(positions, dtype=np.float64).reshape((-1, 2)) * eye.res
+
+    if kind == "fiducial":
+        detector = fiducial.FiducialDetector(eye, radius=annotation.get("radius", 0.7/2), config=config)
+        def run():
+            return to_pix(detector())
+        exception = fiducial.NoFiducialFoundException
+    elif kind == "hole":
+        detector = hole_finder.HoleFinder(eye, config)
+        detector.radius = annotation.get("radius", detector.radius)
+        def run():
+            return to_pix(detector.find_hole())
+        exception = hole_finder.NoBeltHoleFoundException
+    elif kind == "holes":
+        detector = hole_finder.HoleFinder(eye, config)
+        detector.radius = annotation.get("radius", detector.radius)
+        def run():
+            return to_pix(detector.find_holes())
+        exception = hole_finder.NoBeltHoleFoundException
+    elif kind == "bottom_up":
+        aligner = bottom_up.BottomUpAligner(None, {
+            "x": 0, "y": 0, "res": annotation["res"], "crop": annotation.get("crop", 12.0),
+            "flip_x": annotation.get("flip_x", False), "flip_y": annotation.get("flip_y", False),
+        })
+        def run():
+            #machine offset in pixel from the image center and the rotation
+            h, w = eye.image.shape[:2]
+            dx, dy, da, _area = aligner.analyze(eye.image, annotation.get("expected", 0.0), annotation.get("fold", 180.0))
+            return np.array([[dx * aligner.res + w / 2, dy * aligner.res + h / 2, da]])
+        exception = bottom_up.NozzleEmptyException
+    elif kind == "components":
+        picker = pick.Picker(eye, config)
+        def run():
+            p, _a, _A, _s = picker.find_components(eye.image, footprint=annotation.get("footprint"))
+            return np.asarray(p, dtype=np.float64).reshape((-1, 2))
+        exception = pick.NoPartFoundException
+    else:
+        raise ValueError(f"unknown detector '{kind}'")
+
+    def detect(image):
+        eye.image = image
+        try:
+            return run()
+        except exception:
+            return np.zeros((0, 2))
+    return detect
+
+
+def score(kind, detected, truth):
+    """ returns (true positives, false positives, false negatives, list of position errors)"""
+    if kind == "aruco":
+        detected, truth = set(int(i) for i in detected), set(int(i) for i in truth)
+        return len(detected & truth), len(detected - truth), len(truth - detected), []
+
+    if kind == "bottom_up":
+        #the rotation is scored by angle_error()
+        detected = np.asarray(detected, dtype=np.float64).reshape((-1, 3))[:, :2]
+    truth = np.asarray(truth, dtype=np.float64).reshape((-1, 2))
+    unmatched = list(range(len(truth)))
+    tp, fp, errors = 0, 0, []
+    for p in detected:
+        if unmatched:
+            d = np.linalg.norm(truth[unmatched] - p, axis=1)
+            i = int(np.argmin(d))
+            if d[i] <= HIT_TOLERANCE_PIX:
+                errors.append(float(d[i]))
+                del unmatched[i]
+                tp += 1
+                continue
+        fp += 1
+    if kind in ("fiducial", "hole", "bottom_up"):
+        #single result detectors only have to find one of the annotated circles
+        unmatched = [] if tp else unmatched[:1]
+    return tp, fp, len(unmatched), errors
+
+
+def angle_error(detected, truth, symmetry=180):
+    """ degree between the first bottom-up detection and the true angle (under symmetry), None if nothing was detected"""
+    detected = np.asarray(detected, dtype=np.float64).reshape((-1, 3))
+    if not len(detected):
+        return None
+    return abs((detected[0, 2] - truth + symmetry / 2) % symmetry - symmetry / 2)
+
+
+def place_error(measured, truth):
+    """
+    mm between the target and the part placed with the bottom-up correction
+    of StateContext._place_part, measured and truth are (dx, dy, da)
+    """
+    dx, dy, da = measured
+    ox, oy = bottom_up.rotate_offset(dx, dy, da)
+    #the nozzle goes to target - (ox, oy) and turns by -da (e axis), which
+    #turns the true offset by +da in machine x->y direction
+    tx, ty, _ta = truth
+    a = math.radians(da)
+    x = -ox + tx * math.cos(a) - ty * math.sin(a)
+    y = -oy + tx * math.sin(a) + ty * math.cos(a)
+    return math.hypot(x, y)
+
+
+def render_bottom_up(dx, dy, da, res=30.0, flip_x=False, flip_y=False, size=(1.6, 0.8), shape=(480, 640)):
+    """
+    bright part of size (length, width) in mm on a dark background, as the
+    bottom camera sees it at an offset (dx, dy) in mm (machine coordinates)
+    and rotated by da degree (like pick.find_components) on the nozzle
+    """
+    image = np.full(shape, 30, np.uint8)
+    u0, v0 = shape[1] / 2, shape[0] / 2
+    #find_components angles turn from image x towards -y
+    a = math.radians(-da)
+    corners = []
+    for cx, cy in ((1, 1), (-1, 1), (-1, -1), (1, -1)):
+        cx, cy = cx * size[0] / 2, cy * size[1] / 2
+        x = dx + cx * math.cos(a) - cy * math.sin(a)
+        y = dy + cx * math.sin(a) + cy * math.cos(a)
+        u = u0 + (-x if flip_x else x) * res
+        v = v0 + (-y if flip_y else y) * res
+        corners.append((round(u * 16), round(v * 16)))
+    cv2.fillPoly(image, [np.array(corners, np.int32)], 220, cv2.LINE_AA, shift=4)
+    return image
+
+
+def synthetic_bottom_up(offsets=CHECK_OFFSETS, res=30.0):
+    """ rendered bottom-up frames for every flip setting, as (filename, image, annotation)"""
+    frames = []
+    for flip_x in (False, True):
+        for flip_y in (False, True):
+            for dx, dy, da, *expected in offsets:
+                expected = expected[0] if expected else 0.0
+                image = render_bottom_up(dx, dy, da, res, flip_x, flip_y)
+                h, w = image.shape
+                annotation = {
+                    "detector": "bottom_up", "res": res, "flip_x": flip_x, "flip_y": flip_y,
+                    "truth": [[dx * res + w / 2, dy * res + h / 2]], "offset": [dx, dy],
+                    "angle": da - expected, "expected": expected,
+                }
+                name = f"BottomUp_{dx:+.1f}_{dy:+.1f}_{da:+.0f}{'_fx' if flip_x else ''}{'_fy' if flip_y else ''}"
+                frames.append((name, image, annotation))
+    return frames
+
+
+def check_bottom_up(frames=None):
+    """
+    run the bottom-up aligner on frames with known offset and rotation
+    (default: synthetic_bottom_up()), returns a list of failures
+    """
+    failures = []
+    for filename, image, annotation in frames or synthetic_bottom_up():
+        detected = make_detector(annotation)(image)
+        _tp, _fp, _fn, errors = score("bottom_up", detected, annotation["truth"])
+        if not errors:
+            failures.append(f"{filename}: part not found at the true offset, detected {np.round(detected, 2).tolist()}")
+        elif errors[0] > CHECK_TOLERANCE_PIX:
+            failures.append(f"{filename}: offset error {errors[0]:.2f}px")
+        error = angle_error(detected, annotation["angle"])
+        if error is not None and error > CHECK_TOLERANCE_DEG:
+            failures.append(f"{filename}: rotation {detected[0][2]:.1f} instead of {annotation['angle']:.1f} degree")
+        if len(detected) and "offset" in annotation:
+            u, v, da = detected[0]
+            h, w = image.shape[:2]
+            res = annotation["res"]
+            measured = ((u - w / 2) / res, (v - h / 2) / res, da)
+            error = place_error(measured, (*annotation["offset"], annotation["angle"]))
+            if error > CHECK_TOLERANCE_MM:
+                failures.append(f"{filename}: placed {error:.3f}mm off the target")
+    return failures
+
+
+def check_belt_fit(cases=CHECK_BELT_FITS, pitch=4.0):
+    """ fit the belt holes of every case (default: CHECK_BELT_FITS), returns a list of failures"""
+    failures = []
+    for holes, count, expected in cases:
+        try:
+            predicted = belt.fit_belt_holes(holes, (0.0, 0.0), np.array((1.0, 0.0)), pitch, count)
+        except hole_finder.NoBeltHoleFoundException as e:
+            if expected is not None:
+                failures.append(f"{holes}: rejected ({e}) instead of {expected}")
+            continue
+        if expected is None:
+            failures.append(f"{holes}: predicted {np.round(predicted[:, 0], 2).tolist()} instead of a rejection")
+        elif np.max(np.abs(predicted[:, 0] - expected)) > 0.05 or np.max(np.abs(predicted[:, 1])) > 0.1:
+            failures.append(f"{holes}: predicted {np.round(predicted, 2).tolist()} instead of {expected}")
+    return failures
+
+
+def benchmark(frames, repeat=10, engines=None, vision=None):
+    """
+    run every frame through its detector, returns the result dict per detector
+    engines : list of circle engine names to compare, None for the configured engine
+    vision : [vision] settings (see vision_config.load), None for the detector defaults
+    """
+    vision = vision or {}
+    results = {}
+    for filename, image, annotation in frames:
+        kind = annotation["detector"]
+        config = vision.get(vision_config.SECTIONS.get(kind), {})
+        if engines is None or kind not in CIRCLE_DETECTORS:
+            runs = [(kind, config)]
+        else:
+            #the engine parameters of the config only apply to the configured engine
+            runs = [(f"{kind}[{engine}]", config if config.get("engine", "hough") == engine else {"engine": engine})
+                    for engine in engines]
+        for name, c in runs:
+            run_frame(results, name, kind, image, annotation, make_detector(annotation, c), repeat)
+
+    return {name: summarize(r) for name, r in results.items()}
+
+
+def run_frame(results, name, kind, image, annotation, detect, repeat, trace_alloc=True):
+    """ time and score one frame, accumulated into results[name]"""
+    r = results.setdefault(name, {
+        "frames": 0, "latency": [], "alloc_blocks": [], "alloc_peak": [],
+        "tp": 0, "fp": 0, "fn": 0, "errors": [], "angle_errors": [],
+    })
+    r["frames"] += 1
+
+    #warm up (lazy imports, opencv buffers), then time without tracing
+    detected = detect(image)
+    for _ in range(repeat):
+        t = time.perf_counter()
+        detect(image)
+        r["latency"].append(time.perf_counter() - t)
+
+    #allocations are counted in a separate run, tracing distorts the timing
+    if trace_alloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        detect(image)
+        after = tracemalloc.take_snapshot()
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = after.compare_to(before, "filename")
+        r["alloc_blocks"].append(sum(max(s.count_diff, 0) for s in stats))
+        r["alloc_peak"].append(peak)
+
+    if annotation.get("truth") is not None:
+        tp, fp, fn, errors = score(kind, detected, annotation["truth"])
+        r["tp"] += tp
+        r["fp"] += fp
+        r["fn"] += fn
+        r["errors"] += errors
+    if annotation.get("angle") is not None:
+        error = angle_error(detected, annotation["angle"])
+        if error is not None:
+            r["angle_errors"].append(float(error))
+
+
+def summarize(r):
+    latency = np.array(r["latency"]) * 1000
+    scored = r["tp"] + r["fn"]
+    return {
+        "frames": r["frames"],
+        "latency_ms": {
+            "p50": float(np.percentile(latency, 50)),
+            "p90": float(np.percentile(latency, 90)),
+            "p99": float(np.percentile(latency, 99)),
+            "max": float(np.max(latency)),
+        },
+        "alloc_blocks": float(np.mean(r["alloc_blocks"])) if r["alloc_blocks"] else None,
+        "alloc_peak_kib": float(np.mean(r["alloc_peak"]) / 1024) if r["alloc_peak"] else None,
+        "recall": float(r["tp"] / scored) if scored else None,
+        "precision": float(r["tp"] / (r["tp"] + r["fp"])) if r["tp"] + r["fp"] else None,
+        "mean_error_pix": float(np.mean(r["errors"])) if r["errors"] else None,
+        "mean_error_deg": float(np.mean(r["angle_errors"])) if r["angle_errors"] else None,
+    }
+
+
+def print_results(results):
+    print(f"{'detector':<18}{'frames':>7}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'blocks':>9}{'peak KiB':>10}{'recall':>8}{'prec':>8}{'err px':>8}")
+    for kind, r in sorted(results.items()):
+        fmt = lambda v: "-" if v is None else f"{v:.3f}"
+        l = r["latency_ms"]
+        print(f"{kind:<18}{r['frames']:>7}{l['p50']:>9.2f}{l['p90']:>9.2f}{l['p99']:>9.2f}"
+              f"{r['alloc_blocks']:>9.0f}{r['alloc_peak_kib']:>10.0f}"
+              f"{fmt(r['recall']):>8}{fmt(r['precision']):>8}{fmt(r['mean_error_pix']):>8}")
+
+
+def compare(results, baseline, max_slowdown=1.2, max_recall_drop=0.0):
+    """ returns list of regressions against a baseline result"""
+    regressions = []
+    for kind, r in results.items():
+        b = baseline.get(kind)
+        if b is None:
+            continue
+        if r["latency_ms"]["p50"] > b["latency_ms"]["p50"] * max_slowdown:
+            regressions.append(f"{kind}: p50 latency {r['latency_ms']['p50']:.2f}ms > {b['latency_ms']['p50']:.2f}ms * {max_slowdown}")
+        if r["recall"] is not None and b["recall"] is not None and r["recall"] < b["recall"] - max_recall_drop:
+            regressions.append(f"{kind}: recall {r['recall']:.3f} < {b['recall']:.3f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the vision detectors on recorded frames")
+    parser.add_argument("dataset", nargs="?", help="directory with images and annotations.json")
+    parser.add_argument("--repeat", type=int, default=10, help="timed runs per frame")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="fail if the results regress against this result file")
+    parser.add_argument("--max-slowdown", type=float, default=1.2, help="allowed p50 latency factor against the baseline")
+    parser.add_argument("--engine", help=f"comma separated circle engines to compare ({','.join(circle_engine.ENGINES)})")
+    parser.add_argument("--config", help="use the [vision] settings of this config.toml (and its vision.toml) instead of the defaults")
+    parser.add_argument("--check-bottom-up", action="store_true", help="check the bottom-up corrections on synthetic frames")
+    parser.add_argument("--check-belt-fit", action="store_true", help="check the belt hole fit on known hole positions")
+    args = parser.parse_args(argv)
+
+    if args.check_bottom_up:
+        debug.record_dir = None
+        failures = check_bottom_up()
+        for failure in failures:
+            print("FAIL", failure)
+        print(f"bottom-up check: {len(failures)} failures")
+        return 1 if failures else 0
+    if args.check_belt_fit:
+        failures = check_belt_fit()
+        for failure in failures:
+            print("FAIL", failure)
+        print(f"belt fit check: {len(failures)} failures")
+        return 1 if failures else 0
+    if args.dataset is None:
+        parser.error("the dataset is required")
+
+    engines = args.engine.split(",") if args.engine else None
+    vision = vision_config.load(args.config) if args.config else None
+    debug.record_dir = None #never record the replayed frames again
+    results = benchmark(load_dataset(args.dataset), repeat=args.repeat, engines=engines, vision=vision)
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_slowdown)
+        for r in regressions:
+            print("REGRESSION", r)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
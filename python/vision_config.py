@@ -0,0 +1,86 @@
+"""
+Tunable vision settings, read from the [vision.*] sections of config.toml:
+
+    [vision.hole]           # HoleFinder (belt and roll feeders)
+    engine = "hough"        # circle engine and its parameters, see circle_engine.py
+    param1 = 50
+    param2 = 10
+    blur = 5
+    r_tol = 0.2
+
+    [vision.fiducial]       # FiducialDetector
+    engine = "hough"
+    blur = 5
+    binary_threshold = 50
+    r_tol = 0.2
+
+    [vision.components]     # Picker.find_components
+    blur = 11
+    open_kernel = 5
+
+Missing keys keep the defaults of the detector. vision_tune.py writes the
+tuned sections to vision.toml next to config.toml instead of rewriting the
+hand written config, a section in vision.toml replaces the one of config.toml.
+Delete vision.toml to go back to the settings of config.toml.
+"""
+
+import os
+
+import toml
+
+import circle_engine
+
+#config section of each recorded detector type (see debug.record_image)
+SECTIONS = {
+    "fiducial": "fiducial",
+    "hole": "hole",
+    "holes": "hole",
+    "components": "components",
+}
+
+#file next to config.toml with the sections written by vision_tune.py
+OVERRIDE_FILE = "vision.toml"
+
+
+def configure(detector, section):
+    """ set the tunable attributes of a detector from a config section"""
+    section = dict(section or {})
+    if hasattr(detector, "engine"):
+        detector.engine = circle_engine.make_engine_from_config(section)
+    for key, value in section.items():
+        if not hasattr(detector, key):
+            raise ValueError(f"unknown vision setting '{key}' for {type(detector).__name__}")
+        setattr(detector, key, value)
+
+
+def override_path(path="config.toml"):
+    """ the vision.toml belonging to the config file"""
+    return os.path.join(os.path.dirname(path), OVERRIDE_FILE)
+
+
+def load(path="config.toml", config=None):
+    """
+    the [vision] sections of the config file (empty if there are none) with
+    the tuned sections of vision.toml on top
+    config : the already loaded config file, it is only read if None
+    """
+    if config is None:
+        config = toml.load(path)
+    vision = dict(config.get("vision", {}))
+    override = override_path(path)
+    if os.path.exists(override):
+        vision.update(toml.load(override).get("vision", {}))
+    return vision
+
+
+def save(sections, path="config.toml"):
+    """ replace the given [vision.*] sections in the vision.toml of the config file, config.toml is not touched"""
+    override = override_path(path)
+    config = toml.load(override) if os.path.exists(override) else {}
+    vision = config.setdefault("vision", {})
+    for name, section in sections.items():
+        vision[name] = section
+    with open(override, "w") as f:
+        f.write("# written by vision_tune.py, replaces the [vision.*] sections of config.toml\n")
+        toml.dump(config, f)
+    return override
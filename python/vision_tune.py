@@ -0,0 +1,188 @@
+"""
+Offline autotuner for the vision settings.
+
+Sweeps the detector parameters (circle engine and its thresholds, blur
+kernels, r_tol, binary threshold, morphology) over a recorded dataset (see
+vision_bench.py) on all cores, scores accuracy (F1 against the annotated
+truth) against p50 latency and writes the fastest setting on the Pareto
+front within --slack of the best accuracy into the [vision.*] sections of
+vision.toml next to config.toml, which the detectors read at startup on top
+of config.toml (see vision_config.py).
+
+Latencies are measured while the other workers are running, so they are
+only comparable within one run.
+
+usage: python vision_tune.py <dataset> [--config config.toml] [--workers N]
+                             [--repeat N] [--slack 0.0] [--section hole]
+                             [--json tune.json] [--dry-run]
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+
+import debug
+import vision_bench
+import vision_config
+
+#parameters swept for every config section. Circle engine parameters are
+#swept per engine on top of the common parameters.
+COMMON_GRID = {
+    "hole": {
+        "blur": [3, 5, 7],
+        "r_tol": [0.1, 0.2, 0.3],
+    },
+    "fiducial": {
+        "blur": [3, 5, 7],
+        "r_tol": [0.1, 0.2, 0.3],
+        "binary_threshold": [30, 50, 80],
+    },
+    "components": {
+        "blur": [5, 7, 9, 11, 15],
+        "open_kernel": [3, 5, 7],
+    },
+}
+ENGINE_GRID = {
+    "hough": {
+        "param1": [30, 50, 80],
+        "param2": [8, 10, 15, 20],
+    },
+    "template": {
+        "threshold": [0.4, 0.5, 0.6, 0.7],
+    },
+}
+
+#frames of the worker process, loaded once by _init_worker
+_frames = None
+
+
+def _product(grid):
+    keys = list(grid)
+    for values in itertools.product(*(grid[k] for k in keys)):
+        yield dict(zip(keys, values))
+
+
+def candidates(section):
+    """ all settings to try for a config section"""
+    result = []
+    for common in _product(COMMON_GRID[section]):
+        if section == "components":
+            result.append(common)
+            continue
+        for engine, grid in ENGINE_GRID.items():
+            for params in _product(grid):
+                result.append({"engine": engine, **params, **common})
+    return result
+
+
+def _init_worker(dataset):
+    global _frames
+    debug.record_dir = None
+    _frames = vision_bench.load_dataset(dataset)
+
+
+def evaluate(section, config, repeat):
+    """ run all frames of the section with config, returns (config, summary)"""
+    results = {}
+    for _filename, image, annotation in _frames:
+        kind = annotation["detector"]
+        if vision_config.SECTIONS.get(kind) != section:
+            continue
+        detect = vision_bench.make_detector(annotation, dict(config))
+        vision_bench.run_frame(results, section, kind, image, annotation, detect, repeat, trace_alloc=False)
+
+    r = results[section]
+    summary = vision_bench.summarize(r)
+    scored = 2 * r["tp"] + r["fp"] + r["fn"]
+    summary["f1"] = float(2 * r["tp"] / scored) if scored else None
+    return config, summary
+
+
+def pareto_front(evaluated):
+    """ the (config, summary) pairs not beaten in both f1 and p50 latency by another one"""
+    front = []
+    for config, s in evaluated:
+        dominated = any(
+            o["f1"] >= s["f1"] and o["latency_ms"]["p50"] <= s["latency_ms"]["p50"]
+            and (o["f1"] > s["f1"] or o["latency_ms"]["p50"] < s["latency_ms"]["p50"])
+            for _c, o in evaluated
+        )
+        if not dominated:
+            front.append((config, s))
+    front.sort(key=lambda e: e[1]["latency_ms"]["p50"])
+    return front
+
+
+def choose(front, slack=0.0):
+    """ fastest setting within slack of the best f1 (ties by the position error)"""
+    best_f1 = max(s["f1"] for _c, s in front)
+    good = [(c, s) for c, s in front if s["f1"] >= best_f1 - slack]
+    error = lambda s: s["mean_error_pix"] if s["mean_error_pix"] is not None else np.inf
+    return min(good, key=lambda e: (e[1]["latency_ms"]["p50"], error(e[1])))
+
+
+def tune(dataset, sections=None, workers=None, repeat=3, slack=0.0):
+    """ returns {section: (best config, pareto front)} for the sections with annotated frames"""
+    frames = vision_bench.load_dataset(dataset)
+    found = {vision_config.SECTIONS[a["detector"]] for _f, _i, a in frames
+             if a.get("truth") is not None and a["detector"] in vision_config.SECTIONS}
+    sections = [s for s in (sections or COMMON_GRID) if s in found]
+
+    tuned = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dataset,)) as executor:
+        for section in sections:
+            configs = candidates(section)
+            print(f"[{section}] {len(configs)} settings")
+            evaluated = list(executor.map(evaluate, itertools.repeat(section), configs, itertools.repeat(repeat), chunksize=4))
+            front = pareto_front(evaluated)
+            tuned[section] = (choose(front, slack), front)
+    return tuned
+
+
+def print_front(section, best, front):
+    print(f"[{section}] pareto front")
+    print(f"{'p50 ms':>9}{'f1':>8}{'err px':>8}  settings")
+    for config, s in front:
+        mark = "*" if config is best[0] else " "
+        err = "-" if s["mean_error_pix"] is None else f"{s['mean_error_pix']:.3f}"
+        print(f"{s['latency_ms']['p50']:>9.2f}{s['f1']:>8.3f}{err:>8} {mark}{config}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tune the vision settings on recorded frames")
+    parser.add_argument("dataset", help="directory with images and annotations.json")
+    parser.add_argument("--config", default="config.toml", help="config file, the [vision.*] sections go to the vision.toml next to it")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per frame")
+    parser.add_argument("--slack", type=float, default=0.0, help="accepted f1 loss for a faster setting")
+    parser.add_argument("--section", action="append", choices=list(COMMON_GRID), help="only tune this section (repeatable)")
+    parser.add_argument("--json", help="write every pareto front to this file")
+    parser.add_argument("--dry-run", action="store_true", help="do not write the config")
+    args = parser.parse_args(argv)
+
+    tuned = tune(args.dataset, args.section, args.workers, args.repeat, args.slack)
+    if not tuned:
+        print("no annotated frames to tune on")
+        return 1
+
+    for section, (best, front) in tuned.items():
+        print_front(section, best, front)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({section: [{"config": c, "result": s} for c, s in front]
+                       for section, (_best, front) in tuned.items()}, f, indent=4)
+
+    if not args.dry_run:
+        path = vision_config.save({section: best[0] for section, (best, _front) in tuned.items()}, args.config)
+        print(f"wrote [vision.{'], [vision.'.join(tuned)}] to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
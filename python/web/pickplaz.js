@@ -769,6 +769,15 @@ function start() {
                         ctx.stroke()
                     }
 
+                    // placement can not be reached by the nozzle
+                    let out_of_bounds = this.nav.pcb.out_of_bounds
+                    if (out_of_bounds && out_of_bounds.includes(id)) {
+                        ctx.strokeStyle = "orange"
+                        ctx.beginPath();
+                        ctx.rect(-1.5, -1.5, 3, 3)
+                        ctx.stroke()
+                    }
+
                     ctx.restore()
 
                     if (id !== undefined) {